@@ -0,0 +1,251 @@
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import requests
+import streamlit as st
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+import dashboard
+from benchmarks import synthetic
+from config import settings
+from src import data, etl, gpx, processed
+from src.filters import FilterEngine
+from src.markers import MarkerFragments
+from src.spatial import SpatialIndex
+from src.summits import SummitIndex
+
+SCALES = (1, 10, 100)
+
+# Dashboard session state for a spread of typical searches, from everything on the map to narrow combinations
+DEFAULT_STATE = {
+    "region_selector": "All", "munro_slider": (0, 5), "rating_slider": 0.0, "vote_slider": 0, "time_slider": (0.0, 10.0),
+    "distance_slider": (0.0, 25.0), "grade_slider": 5, "bog_slider": 5, "corbett_check": False, "fiona_check": False,
+    "donald_check": False, "sub_2000_check": False, "near_input": "", "near_radius": 20,
+}
+FILTER_STATES = (
+    {},
+    {"region_selector": "Skye"},
+    {"munro_slider": (1, 5)},
+    {"rating_slider": 4.0, "vote_slider": 10},
+    {"time_slider": (2.0, 6.0), "distance_slider": (5.0, 15.0), "grade_slider": 3},
+    {"corbett_check": True, "bog_slider": 3},
+    {"near_input": "NN166712", "near_radius": 30},
+    {"loop_check": True},
+    {"summit_select": ["Ben Lui"]},
+    {"summit_select": ["Ben Lui", "Beinn Dearg", "Sgurr Mhor"], "summit_count": 2},
+    {"region_selector": "Cairngorms", "munro_slider": (2, 5), "time_slider": (4.0, 10.0), "near_input": "57.07, -3.67"},
+)
+
+# Timings are noisy, regressions are only reported when the median is slower by more than this factor and by at
+# least MIN_DIFFERENCE seconds
+DEFAULT_THRESHOLD = 1.25
+MIN_DIFFERENCE = 0.005
+
+
+def timed(fn: Callable, repeat: int = 3, setup: Optional[Callable] = None) -> dict:
+    """Minimum and median wall time in seconds of `repeat` calls of fn, with setup run untimed before each."""
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+class StaticSession:
+
+    def __init__(self, documents: dict[str, bytes]):
+        """Stands in for a requests session, serving documents from memory so gpx.parse is timed without the
+        network."""
+        self.documents = documents
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.documents[url]
+        response.url = url
+        return response
+
+
+@contextmanager
+def patched_settings(**paths) -> Iterator[None]:
+
+    previous = {name: getattr(settings, name) for name in paths}
+    for name, value in paths.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(settings, name, value)
+
+
+def set_filter_state(state: dict) -> None:
+
+    for key, value in {**DEFAULT_STATE, **state}.items():
+        st.session_state[key] = value
+
+
+def run_scale(scale: float, repeat: int = 3, gpx_sample: int = 1000, seed: int = 0) -> dict:
+    """Time each stage of the pipeline on a synthetic catalogue `scale` times the size of the real one. Route
+    parsing does not depend on the catalogue size, so is timed on the first `gpx_sample` routes."""
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        tmp = Path(tmp)
+        files = synthetic.write_catalogue(tmp / "raw", scale=scale, seed=seed)
+        route_files = tmp / "static" / "routes"
+
+        with patched_settings(
+            raw_data_path=tmp / "raw", processed_path=tmp / "processed.parquet",
+            processed_manifest_path=tmp / "manifest.json", spatial_index_path=tmp / "spatial_index.npz",
+            summit_index_path=tmp / "summit_index.npz",
+            route_table_path=tmp / "route_table", routes_path=tmp / "routes", route_files_path=route_files,
+        ):
+
+            results["data.load_walk_data"] = timed(lambda: data.load_walk_data(files), repeat)
+            results["etl.main"] = timed(etl.main, repeat)
+            results["etl.main incremental"] = timed(lambda: etl.main(incremental=True), repeat)
+
+            df = processed.read(settings.processed_path, columns=dashboard.DATA_COLUMNS)
+            index = SpatialIndex.load(settings.spatial_index_path)
+
+            results["SummitIndex"] = timed(lambda: SummitIndex.from_frame(df), repeat)
+            summit_index = SummitIndex.load(settings.summit_index_path)
+
+            results["FilterEngine"] = timed(lambda: FilterEngine(df, index=index, summit_index=summit_index), repeat)
+            engine = FilterEngine(df, index=index, summit_index=summit_index)
+
+            def filter_walks():
+                for state in FILTER_STATES:
+                    set_filter_state(state)
+                    dashboard.filter_walks(df, engine)
+
+            # Cleared every repeat, times evaluating the filters rather than cache lookups
+            results["dashboard.filter_walks"] = timed(filter_walks, repeat, setup=engine.evaluate.cache_clear)
+            results["dashboard.filter_walks"]["calls"] = len(FILTER_STATES)
+
+            route_ids = etl.walk_ids(df).tolist()
+            results["MarkerFragments"] = timed(
+                lambda: MarkerFragments(df, popup_cols=("Popup", "Compact Popup"), route_ids=route_ids), repeat
+            )
+            fragments = MarkerFragments(df, popup_cols=("Popup", "Compact Popup"), route_ids=route_ids)
+            positions = np.arange(len(df))
+            selection = fragments.key(positions)
+
+            results["add_walks_to_map"] = timed(
+                lambda: dashboard.add_walks_to_map(selection, positions, fragments),
+                repeat, setup=dashboard.add_walks_to_map.clear,
+            )
+
+            # With per walk route files markers carry the route ids
+            route_files.mkdir(parents=True)
+            results["add_walks_to_map routes"] = timed(
+                lambda: dashboard.add_walks_to_map(selection, positions, fragments, include_routes=True),
+                repeat, setup=dashboard.add_walks_to_map.clear,
+            )
+
+        records = [record for file in files[:1] for record in data.read_walk_file(file)]
+        for file in files[1:]:
+            if len(records) >= gpx_sample:
+                break
+            records.extend(data.read_walk_file(file))
+
+        session = StaticSession(synthetic.gpx_routes(records[:gpx_sample], seed=seed))
+        results["gpx.parse"] = timed(lambda: [gpx.parse(link, session=session) for link in session.documents], repeat)
+        results["gpx.parse"]["calls"] = len(session.documents)
+
+    for result in results.values():
+        result["walks"] = len(df)
+
+    return results
+
+
+def git_commit() -> Optional[str]:
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales: tuple[float, ...] = SCALES, repeat: int = 3, seed: int = 0) -> dict:
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "results": {f"{scale:g}": run_scale(scale, repeat=repeat, seed=seed) for scale in scales},
+    }
+
+
+def compare(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> tuple[list[str], list[str]]:
+    """Report lines comparing median timings of benchmarks in both result sets, and the benchmarks more than
+    `threshold` times (and MIN_DIFFERENCE seconds) slower in `new`."""
+
+    lines = [f"{'scale':>6} {'benchmark':<28} {'old (s)':>10} {'new (s)':>10} {'ratio':>7}"]
+    regressions = []
+
+    for scale, results in new["results"].items():
+        for name, result in results.items():
+
+            previous = old["results"].get(scale, {}).get(name)
+            if previous is None:
+                continue
+
+            ratio = result["median"] / previous["median"] if previous["median"] else float("inf")
+            significant = abs(result["median"] - previous["median"]) >= MIN_DIFFERENCE
+            flag = ""
+            if significant and ratio > threshold:
+                flag = "  slower"
+                regressions.append(f"{name} at {scale}x")
+            elif significant and ratio < 1 / threshold:
+                flag = "  faster"
+
+            lines.append(f"{scale:>5}x {name:<28} {previous['median']:>10.4f} {result['median']:>10.4f} {ratio:>7.2f}{flag}")
+
+    return lines, regressions
+
+
+def report(results: dict) -> list[str]:
+
+    lines = [f"{'scale':>6} {'benchmark':<28} {'walks':>7} {'min (s)':>10} {'median (s)':>11}"]
+    for scale, scale_results in results["results"].items():
+        for name, result in scale_results.items():
+            lines.append(f"{scale:>5}x {name:<28} {result['walks']:>7} {result['min']:>10.4f} {result['median']:>11.4f}")
+
+    return lines
+
+
+def save(results: dict, path: Path) -> None:
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(results, indent=4))
+
+
+def load(path: Path) -> dict:
+    return json.loads(path.read_text())
@@ -0,0 +1,178 @@
+import json
+import numpy as np
+from pathlib import Path
+from typing import Optional
+from src.grid import grid_to_latlon
+
+# Size of the real catalogue and the average number of points in its routes
+CATALOGUE_SIZE = 1965
+ROUTE_POINTS = 95
+
+BASE_URL = "https://www.walkhighlands.co.uk"
+
+# Regions of the real catalogue with their share of walks and the 100km grid square most of their walks start in
+REGIONS = {
+    "fortwilliam": (156, "NN"), "cairngorms": (150, "NO"), "argyll": (118, "NR"), "perthshire": (110, "NN"),
+    "ullapool": (104, "NC"), "galloway": (98, "NX"), "skye": (94, "NG"), "lochlomond": (82, "NN"),
+    "aberdeenshire": (81, "NJ"), "outer-hebrides": (76, "NB"), "sutherland": (75, "NC"), "glasgow": (75, "NS"),
+    "lochness": (72, "NH"), "torridon": (72, "NG"), "fife-stirling": (71, "NO"), "orkney": (58, "HY"),
+    "shetland": (55, "HU"), "lothian": (55, "NT"), "borders": (54, "NT"), "mull": (49, "NM"), "moray": (47, "NJ"),
+    "islay-jura": (45, "NR"), "arran": (44, "NS"), "kintail": (44, "NG"), "angus": (41, "NO"), "islands": (39, "NM"),
+}
+
+NAME_PREFIXES = ("Ben", "Beinn", "Sgurr", "Meall", "Carn", "Stob", "Glen", "Loch", "Creag", "Bidean", "Cruach", "Mount")
+NAME_WORDS = (
+    "Alder", "More", "Dubh", "Mhor", "Bheag", "Lui", "Nevis", "Ime", "Vane", "Lawers", "Chonzie", "Shee", "Clova",
+    "Affric", "Eilde", "Ghlas", "Liath", "Ruadh", "Buidhe", "Odhar", "Fionn", "Glas", "Dearg", "Challum",
+)
+
+# Share of walks with each kind of summit, and the raw column names the scraper records them under
+HILL_TYPES = {"Munro": 0.2, "Corbett": 0.12, "Donald": 0.03, "Fiona": 0.08, "Sub 2000": 0.1}
+
+
+def hill_name(rng: np.random.Generator) -> str:
+    return f"{rng.choice(NAME_PREFIXES)} {rng.choice(NAME_WORDS)}"
+
+
+def walk_time(rng: np.random.Generator, hours: float) -> str:
+    """Time in one of the forms used on walk pages, e.g. "4 - 5 hours", "45 mins - 1 hour" or "2 hours"."""
+
+    if hours < 1:
+        minutes = int(max(15, round(hours * 60 / 15) * 15))
+        return f"{minutes} mins" if rng.random() < 0.5 else f"{minutes} mins - 1 hour"
+
+    low = round(hours * 2) / 2
+    if rng.random() < 0.2:
+        return f"{low:g} hours"
+
+    return f"{low:g} - {low + rng.choice([0.5, 1, 1.5, 2]):g} hours"
+
+
+def hills(rng: np.random.Generator) -> dict:
+    """Summit columns of a walk, singular for one summit and plural for a comma separated list as scraped."""
+
+    record = {}
+    for hill_type, share in HILL_TYPES.items():
+        if rng.random() < share:
+            count = 1 + rng.poisson(0.4 if hill_type == "Munro" else 0.1)
+            names = ", ".join(hill_name(rng) for _ in range(count))
+            record[hill_type if count == 1 else f"{hill_type}s"] = names
+
+    return record
+
+
+def grid_refs(rng: np.random.Generator, square: str, size: int) -> list[str]:
+    """Six figure grid references within a 100km square, formatted as on walk pages e.g. "NO 565 344"."""
+    return [f"{square} {e:03d} {n:03d}" for e, n in rng.integers(0, 1000, (size, 2)).tolist()]
+
+
+def walk_record(rng: np.random.Generator, region: str, number: int, grid_ref: str, lat: float, lon: float) -> dict:
+    """Raw walk record as written by the scraper."""
+
+    name = f"{hill_name(rng)} {number}"
+    slug = name.lower().replace(" ", "-")
+    link = f"{BASE_URL}/{region}/{slug}.shtml"
+
+    distance = float(np.clip(rng.gamma(2.5, 4), 0.5, 60))
+    hours = distance / 3.5 + rng.random()
+    votes = int(rng.poisson(15))
+
+    return {
+        "Distance": f"{distance:.1f}km ({distance / 1.609:.0f} miles)",
+        "Time": walk_time(rng, hours),
+        "Ascent": f"{int(rng.gamma(2, 250))}m",
+        "Start Grid Ref": grid_ref,
+        "Area0": region,
+        "Area1": f"{region} {rng.integers(1, 6)}",
+        "Name": name,
+        "Rating": f"{rng.uniform(2, 5):.2f}" if votes else "0",
+        "Votes": str(votes),
+        "Grade": int(rng.integers(1, 6)),
+        "Bog": int(rng.integers(1, 6)),
+        "Link": link,
+        "StartPoint": f"https://www.google.com/maps/search/{lat:.5f},{lon:.5f}/",
+        "GPX": f"{BASE_URL}/{region}/profiles/{slug}.gpx",
+        **hills(rng),
+    }
+
+
+def region_sizes(scale: float) -> dict[str, int]:
+    """Walks per region for a catalogue `scale` times the size of the real one, in the real proportions."""
+
+    shares = np.array([count for count, _ in REGIONS.values()], dtype=float)
+    sizes = np.floor(shares / shares.sum() * CATALOGUE_SIZE * scale).astype(int)
+    # Remainder goes to the largest regions so the total is exact
+    sizes[:round(CATALOGUE_SIZE * scale) - sizes.sum()] += 1
+
+    return dict(zip(REGIONS, sizes.tolist()))
+
+
+def write_catalogue(path: Path, scale: float = 1, seed: int = 0) -> list[Path]:
+    """Write raw {region}walks.json files for a synthetic catalogue. The same scale and seed always give the same
+    files. Returns the files written."""
+
+    path.mkdir(parents=True, exist_ok=True)
+    files = []
+    number = 0
+
+    for i, (region, size) in enumerate(region_sizes(scale).items()):
+
+        rng = np.random.default_rng([seed, i])
+        refs = grid_refs(rng, REGIONS[region][1], size)
+        lats, lons = grid_to_latlon(refs)
+
+        records = []
+        for ref, lat, lon in zip(refs, lats.tolist(), lons.tolist()):
+            records.append(walk_record(rng, region, number, ref, lat, lon))
+            number += 1
+
+        file = path / f"{region}walks.json"
+        file.write_text(json.dumps(records, indent=4))
+        files.append(file)
+
+    return files
+
+
+def route_points(rng: np.random.Generator, lat: float, lon: float, n: Optional[int] = None) -> dict[str, np.ndarray]:
+    """Random walk of track points from a start point, a loop back to the start about half of the time, with
+    elevation and a timestamp every 30 seconds."""
+
+    n = n or max(int(rng.poisson(ROUTE_POINTS)), 2)
+    steps = rng.normal(0, 1, (n, 2)).cumsum(axis=0) * 0.0015
+    steps -= steps[0]
+    if rng.random() < 0.5:
+        steps -= np.linspace(0, 1, n)[:, None] * steps[-1]
+
+    return {
+        "lat": lat + steps[:, 0],
+        "lon": lon + steps[:, 1] * 1.7,
+        "ele": np.abs(rng.normal(0, 8, n).cumsum() + rng.uniform(0, 300)),
+        "time": 1.6e9 + np.arange(n) * 30,
+    }
+
+
+def gpx_document(points: dict[str, np.ndarray], name: str = "") -> bytes:
+
+    timestamps = np.datetime_as_string(points["time"].astype("datetime64[s]"), unit="s")
+    track = "".join(
+        f'<trkpt lat="{lat:.6f}" lon="{lon:.6f}"><ele>{ele:.1f}</ele><time>{t}Z</time></trkpt>\n'
+        for lat, lon, ele, t in zip(points["lat"], points["lon"], points["ele"], timestamps)
+    )
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx version="1.1" creator="walkhighlands" xmlns="http://www.topografix.com/GPX/1/1">\n'
+        f"<trk><name>{name}</name><trkseg>\n{track}</trkseg></trk>\n</gpx>\n"
+    ).encode()
+
+
+def gpx_routes(records: list[dict], seed: int = 0) -> dict[str, bytes]:
+    """GPX document for each raw record, keyed by its GPX link and starting at its start point."""
+
+    routes = {}
+    for i, record in enumerate(records):
+        rng = np.random.default_rng([seed, i, 1])
+        lat, lon = map(float, record["StartPoint"].rstrip("/").rsplit("/", 1)[1].split(","))
+        routes[record["GPX"]] = gpx_document(route_points(rng, lat, lon), name=record["Name"])
+
+    return routes
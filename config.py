@@ -7,9 +7,30 @@ class Settings:
     root_path = pathlib.Path(__file__).parent
     data_path = root_path / "data"
     processed_path = data_path / "processed.parquet"
+    # Walks with their routes joined on, from before the route table, read by run_gpx.migrate_route_table
     processed_gpx_path = data_path / "processed_gpx.parquet"
+    # Route points of each walk by walk id (src.routes.write_route_table)
+    route_table_path = data_path / "route_table"
+    routes_path = data_path / "routes"
+    # Served by streamlit static file serving (.streamlit/config.toml) at app/static/routes
+    route_files_path = root_path / "static" / "routes"
+    tiles_path = root_path / "static" / "tiles"
+    spatial_index_path = data_path / "spatial_index.npz"
+    summit_index_path = data_path / "summit_index.npz"
+    processed_manifest_path = data_path / "processed_manifest.json"
+    gpx_checkpoint_path = data_path / "gpx_checkpoint.jsonl"
+    scrape_checkpoint_path = data_path / "scrape_checkpoints"
     raw_data_path = data_path / "raw"
+    http_cache_path = data_path / "http_cache"
+    # Timings, counters and memory of each scrape, GPX and ETL run (src/instrument.py)
+    run_reports_path = data_path / "run_reports"
     request_delay = 0.5
+    request_workers = 4
+    # Cached responses are revalidated after a week, least recently used are evicted beyond 1 GB
+    http_cache_ttl = 7 * 24 * 3600
+    http_cache_size = 2 ** 30
+    # Serve every request from the HTTP cache, failing on anything not cached
+    offline = False
 
 
 settings = Settings()
@@ -1,10 +1,21 @@
 import folium
+import numpy as np
 import pandas as pd
 import streamlit as st
-from folium.plugins import FastMarkerCluster
 from streamlit_folium import st_folium
+from typing import Optional, Sequence
 from utils.streamlit import DirectionalSlider
 from config import settings
+from src.etl import build_popups, walk_ids
+from src import processed
+from src.filters import RANGE_COLUMNS, SUMMIT_COLUMNS, FilterEngine, Filters
+from src.markers import FragmentMarkerCluster, MarkerFragments, script_json
+from src.route_metrics import LOOP_GAP_KM
+from src.routes import RouteStore, read_route_table
+from src.simplify import ROUTE_TOLERANCES, tolerance_for_zoom
+from src.spatial import SpatialIndex, parse_location
+from src.summits import SummitIndex
+from src.tiles import TILE_URL, TILE_ZOOMS, StaticTileLayer
 
 map_width, map_height = 700, 600
 zoom_start = 6.25
@@ -68,6 +79,90 @@ marker_route_callback = (
     """
 )
 
+# Markers carry a walk id, the route is fetched from its static file on click and kept in a small LRU cache
+marker_lazy_route_callback = (
+    """
+    function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]), {color: "red"});
+        var icon = L.AwesomeMarkers.icon({
+            icon: 'info-sign',
+            iconColor: 'white',
+            markerColor: 'green',
+            prefix: 'glyphicon',
+            extraClasses: 'fa-rotate-0'
+        });
+        marker.setIcon(icon);
+        var popupContent = `<div class='display_text' style='width: 100%; height: 100%;'>${row[2]}</div>`;
+        marker.bindPopup(popupContent, {maxWidth: '300'});
+
+        if (!window.walkRoutes) {
+            var base;
+            try {
+                base = new URL('%ROUTE_URL%', window.parent.location.href).href;
+            } catch (e) {
+                base = new URL('%ROUTE_URL%', document.baseURI).href;
+            }
+            window.walkRoutes = {
+                cache: new Map(),
+                load: function (id) {
+                    var cache = this.cache;
+                    if (cache.has(id)) {
+                        var route = cache.get(id);
+                        cache.delete(id);
+                        cache.set(id, route);
+                        return route;
+                    }
+                    var route = fetch(base + id + '.json')
+                        .then(function (response) { return response.ok ? response.json() : null; })
+                        .catch(function () { return null; });
+                    cache.set(id, route);
+                    if (cache.size > %CACHE_SIZE%) {
+                        cache.delete(cache.keys().next().value);
+                    }
+                    return route;
+                },
+                level: function (zoom, lat) {
+                    // Same as simplify.tolerance_for_zoom: keep points above the coarsest tolerance below a pixel
+                    var metresPerPixel = 156543.03 * Math.cos(lat * Math.PI / 180) / Math.pow(2, zoom);
+                    var level = 0;
+                    %TOLERANCES%.forEach(function (t, i) { if (t <= metresPerPixel) { level = i + 1; } });
+                    return level;
+                }
+            };
+        }
+
+        marker.on('click', function() {
+            if (window.lastPath) {
+                window.lastPath.remove();
+                window.lastPath = null;
+            }
+            if (window.lastClickedMarker == marker) {
+                window.lastClickedMarker = null;
+                return;
+            }
+            window.lastClickedMarker = marker;
+            if (!row[3]) {
+                return;
+            }
+            window.walkRoutes.load(row[3]).then(function (route) {
+                // Another marker may have been clicked while the route loaded
+                if (!route || window.lastClickedMarker != marker) {
+                    return;
+                }
+                var level = window.walkRoutes.level(map.getZoom(), row[0]);
+                var path = route.c.filter(function (point, i) { return route.l[i] >= level; });
+                window.lastPath = L.polyline.antPath(path, {color: 'blue', delay: 1500, weight: 5}).addTo(map);
+            });
+        });
+
+        return marker;
+    };
+    """
+    .replace("%ROUTE_URL%", "app/static/routes/")
+    .replace("%CACHE_SIZE%", "100")
+    .replace("%TOLERANCES%", str(list(ROUTE_TOLERANCES)))
+)
+
 # Static filters
 MAX_VALUES = {
     "munro": 5,
@@ -75,58 +170,173 @@ MAX_VALUES = {
     "bog": 5,
     "votes": 100,
     "time": 10.0,
-    "distance": 25.0
+    "distance": 25.0,
+    "elevation": 2000
 }
 
+# Columns of the processed dataset the table, filters and markers use, the rest is never read
+DATA_COLUMNS = (
+    "Name", "Region", "Distance", "Route Distance", "Ascent", "Time", "Start Grid Ref", "Rating", "Votes", "Grade",
+    "Bog", "Munro", *SUMMIT_COLUMNS, *RANGE_COLUMNS, "lat", "lon", "Walk Id", "Link", "Popup", "Compact Popup",
+)
+
+
+@st.cache_resource
+def load_routes() -> Optional[RouteStore]:
+    """Memory mapped route store shared by all sessions, built from the route table when run_gpx has not saved
+    one, None for datasets without routes."""
+
+    if settings.routes_path.is_dir():
+        return RouteStore.load(settings.routes_path)
+
+    table = read_route_table(settings.route_table_path)
+    if table is not None:
+        return RouteStore.from_table(table)
+
 
 @st.cache_data
-def load_data(include_routes: bool = False) -> tuple[pd.DataFrame, pd.DataFrame]:
-    
-    if include_routes:
-        return pd.read_parquet(settings.processed_gpx_path, engine="fastparquet")
-    else:
-        return pd.read_parquet(settings.processed_path, engine="fastparquet")
+def load_data() -> pd.DataFrame:
+    """Walk attributes, routes are attached by walk id when building markers so are never part of the dataset."""
+
+    df = processed.read(settings.processed_path, columns=DATA_COLUMNS)
+
+    # Datasets processed before compact popups were introduced
+    if "Compact Popup" not in df.columns:
+        df["Compact Popup"] = build_popups(df, compact=True)
+
+    return df
+
+
+def lazy_routes_available() -> bool:
+    """Per walk route files written by run_gpx, so routes can be loaded on demand."""
+    return settings.route_files_path.is_dir()
 
 
 @st.cache_resource
-def add_walks_to_map(df, include_routes: bool = False):
+def load_marker_fragments() -> MarkerFragments:
+    """Marker rows of every walk, serialised once per dataset load."""
+
+    df = load_data()
+    return MarkerFragments(df, popup_cols=("Popup", "Compact Popup"), route_ids=walk_ids(df).tolist())
+
+
+@st.cache_resource
+def load_path_fragments(tolerance: Optional[float] = None) -> np.ndarray:
+    """Serialised route of every walk for embedding in markers, simplified to the given tolerance in metres when
+    the route store has one. Walks without a route (or every walk without routes) have none."""
+
+    df = load_data()
+    routes = load_routes()
+    if routes is not None:
+        paths = routes.paths(walk_ids(df), tolerance=tolerance if routes.importance is not None else None)
+    else:
+        paths = [None] * len(df)
+
+    return np.array([script_json(p.astype(float).round(5).tolist() if p is not None else None) for p in paths], dtype=object)
+
+
+@st.cache_resource(max_entries=32)
+def add_walks_to_map(selection: str, _positions: np.ndarray, _fragments: MarkerFragments, include_routes: bool = False,
+                     popup_col: str = "Popup", tolerance: Optional[float] = None, _paths: Optional[np.ndarray] = None):
+    """Marker layer for the walks at `_positions`. Cached by `selection` (MarkerFragments.key) rather than by hashing
+    the walks, arguments starting with an underscore are not hashed."""
 
     fg = folium.FeatureGroup(name="walks")
 
-    if include_routes:
-        return fg.add_child(FastMarkerCluster(df[["lat", "lon", "Popup", "path"]].values.tolist(), callback=marker_route_callback))
+    if include_routes and lazy_routes_available():
+        # Only walk ids are embedded, page size no longer grows with the routes of every matching walk
+        data = _fragments.data(_positions, popup_col=popup_col, route_ids=True)
+        return fg.add_child(FragmentMarkerCluster(data, callback=marker_lazy_route_callback))
+    elif include_routes:
+        data = _fragments.data(_positions, popup_col=popup_col, paths=_paths[_positions])
+        return fg.add_child(FragmentMarkerCluster(data, callback=marker_route_callback))
     else:
-        return fg.add_child(FastMarkerCluster(df[["lat", "lon", "Popup"]].values.tolist(), callback=marker_callback))
-
-
-def filter_walks(df: pd.DataFrame) -> pd.DataFrame:
-
-    filters = [
-        (df["Region"] == st.session_state.region_selector) if st.session_state.region_selector.lower() != "all" else True,
-        df["Munros Climbed"] >= st.session_state.munro_slider[0],
-        df["Munros Climbed"] <= st.session_state.munro_slider[1] if st.session_state.munro_slider[1] < MAX_VALUES["munro"] else True,
-        df["Rating"] >= st.session_state.rating_slider,
-        df["Votes"] >= st.session_state.vote_slider,
-        df["Time"] >= st.session_state.time_slider[0],
-        df["Time"] <= st.session_state.time_slider[1] if st.session_state.time_slider[1] < MAX_VALUES["time"] else True,
-        df["Distance"] >= st.session_state.distance_slider[0],
-        df["Distance"] <= st.session_state.distance_slider[1] if st.session_state.distance_slider[1] < MAX_VALUES["distance"] else True,
-        df["Grade"] <= st.session_state.grade_slider if st.session_state.grade_slider < MAX_VALUES["grade"] else True,
-        df["Bog"] <= st.session_state.bog_slider if st.session_state.bog_slider < MAX_VALUES["bog"] else True,
-        (df["Corbett"].notna() & (df["Corbett"] != "")) if st.session_state.corbett_check else True,
-        (df["Fiona"].notna() & (df["Fiona"] != "")) if st.session_state.fiona_check else True,
-        (df["Donald"].notna() & (df["Donald"] != "")) if st.session_state.donald_check else True,
-        (df["Sub 2000"].notna() & (df["Sub 2000"] != "")) if st.session_state.sub_2000_check else True
-    ]
-    
-    final_condition = filters[0]
-    for condition in filters[1:]:
-        final_condition &= condition
+        return fg.add_child(FragmentMarkerCluster(_fragments.data(_positions, popup_col=popup_col), callback=marker_callback))
+
+
+@st.cache_resource
+def load_spatial_index() -> Optional[SpatialIndex]:
+
+    if settings.spatial_index_path.is_file():
+        return SpatialIndex.load(settings.spatial_index_path)
+
+
+@st.cache_resource
+def load_summit_index() -> Optional[SummitIndex]:
 
-    return df[final_condition]
+    if settings.summit_index_path.is_file():
+        return SummitIndex.load(settings.summit_index_path)
 
 
-def get_filters() -> None:
+def get_location() -> Optional[tuple[float, float]]:
+
+    text = st.session_state.near_input.strip()
+    return parse_location(text) if text else None
+
+
+@st.cache_resource
+def load_filter_engine() -> FilterEngine:
+    """Filter engine for the dataset load_data returns, built once and shared by all sessions."""
+
+    df = load_data()
+
+    # Index saved by the ETL matches the processed data, otherwise build one
+    index = load_spatial_index()
+    if index is None or len(index) != len(df):
+        index = SpatialIndex.from_frame(df)
+
+    # Likewise the summit index, the engine builds one from the summit columns otherwise
+    summit_index = load_summit_index()
+    if summit_index is not None and len(summit_index) != len(df):
+        summit_index = None
+
+    return FilterEngine(df, index=index, summit_index=summit_index)
+
+
+def upper(value: float, key: str) -> Optional[float]:
+    """Slider maximums mean no upper limit."""
+    return value if value < MAX_VALUES[key] else None
+
+
+def get_filter_state() -> Filters:
+
+    state = st.session_state
+    location = get_location()
+    summits = [col for col, key in zip(SUMMIT_COLUMNS, ["corbett_check", "fiona_check", "donald_check", "sub_2000_check"]) if state[key]]
+    summit_names = tuple(state.get("summit_select", ()))
+
+    return Filters(
+        region=state.region_selector if state.region_selector.lower() != "all" else None,
+        munros=(state.munro_slider[0], upper(state.munro_slider[1], "munro")),
+        rating=(state.rating_slider, None),
+        votes=(state.vote_slider, None),
+        time=(state.time_slider[0], upper(state.time_slider[1], "time")),
+        distance=(state.distance_slider[0], upper(state.distance_slider[1], "distance")),
+        grade=(None, upper(state.grade_slider, "grade")),
+        bog=(None, upper(state.bog_slider, "bog")),
+        # Route filters are only shown for datasets with route metrics
+        gap=(None, LOOP_GAP_KM) if state.get("loop_check") else (None, None),
+        elevation_gain=(state.elevation_slider[0], upper(state.elevation_slider[1], "elevation")) if "elevation_slider" in state else (None, None),
+        summits=tuple(summits),
+        summit_names=summit_names,
+        summit_count=min(state.get("summit_count", 1), len(summit_names)) if summit_names else 1,
+        near=(*location, state.near_radius) if location else None,
+    )
+
+
+def filter_positions(engine: FilterEngine) -> np.ndarray:
+
+    return engine.evaluate(get_filter_state())
+
+
+def filter_walks(df: pd.DataFrame, engine: FilterEngine) -> pd.DataFrame:
+
+    return df.iloc[filter_positions(engine)]
+
+
+def get_filters(loops: bool = False, elevation: bool = False, summits: Sequence[str] = ()) -> None:
+    """Sidebar filters, with the loop and elevation gain filters when the dataset has those route metrics, and a
+    search of the given summit names."""
 
     st.sidebar.subheader("Walk Filters")
     
@@ -181,6 +391,34 @@ def get_filters() -> None:
     st.sidebar.checkbox("Donald", key="donald_check")
     st.sidebar.checkbox("Sub 2000",key="sub_2000_check")
 
+    st.sidebar.multiselect("Climbs", summits, key="summit_select", placeholder="Search summits, e.g. Ben Lui")
+    selected = len(st.session_state.get("summit_select", ()))
+    if selected > 1:
+        # Kept within the number of summits when some are removed from the search
+        if st.session_state.get("summit_count", 1) > selected:
+            st.session_state["summit_count"] = selected
+        st.sidebar.number_input("Climbing at least", min_value=1, max_value=selected, key="summit_count",
+                                help="Number of the searched summits a walk climbs")
+
+    if loops or elevation:
+        st.sidebar.subheader("Route Filters")
+    if loops:
+        st.sidebar.checkbox("Loops only", key="loop_check", help=f"Routes ending within {LOOP_GAP_KM} km of their start")
+    if elevation:
+        st.sidebar.slider("Elevation gain (m)",
+                          min_value=0,
+                          max_value=MAX_VALUES["elevation"],
+                          value=(0, MAX_VALUES["elevation"]),
+                          step=50,
+                          key="elevation_slider")
+
+    st.sidebar.subheader("Location")
+    st.sidebar.text_input("Near", key="near_input", placeholder="Grid ref (NN166712) or lat, lon")
+    st.sidebar.slider("Within (km)", min_value=1, max_value=100, value=20, key="near_radius")
+
+    if st.session_state.near_input.strip() and get_location() is None:
+        st.sidebar.warning("Location not recognised, enter an OS grid reference or lat, lon")
+
 
 if __name__ == "__main__":
 
@@ -194,13 +432,23 @@ if __name__ == "__main__":
         """
     )
     st.markdown("##### View GPS paths")
-    st.markdown(f"The 'View routes' checkbox enables walking routes to be visualised when a walk is clicked, but may reduce app performance when there are a large number of walks on the map (automatically turned on for less than {auto_include_routes} walks).")
-    
+    lazy_routes = lazy_routes_available()
+    if lazy_routes:
+        st.markdown("The 'View routes' checkbox enables walking routes to be visualised when a walk is clicked.")
+    else:
+        st.markdown(f"The 'View routes' checkbox enables walking routes to be visualised when a walk is clicked, but may reduce app performance when there are a large number of walks on the map (automatically turned on for less than {auto_include_routes} walks).")
+
     st.sidebar.subheader("GPS paths")
-    include_routes = "routes_check" in st.session_state and st.session_state["num_walks"] < auto_include_routes
+    # Routes loaded on click cost nothing up front, embedded routes are only turned on for a few walks
+    include_routes = lazy_routes or ("routes_check" in st.session_state and st.session_state["num_walks"] < auto_include_routes)
     st.sidebar.checkbox("View routes", key="routes_check", value=include_routes)
+    if settings.tiles_path.is_dir():
+        st.sidebar.checkbox("Show all routes", key="all_routes_check", help="Draw every walking route on the map")
+    st.sidebar.checkbox("Compact popups", key="compact_popup_check", help="Show less walk detail in map popups, which loads faster when many walks are on the map")
     
-    df = load_data(include_routes=st.session_state["routes_check"])
+    # Without per walk route files routes are embedded in the markers
+    embed_routes = st.session_state["routes_check"] and not lazy_routes
+    df = load_data()
 
     unique_regions = ["All"] + sorted(df["Region"].unique().tolist())
     st.selectbox("Region", unique_regions, key="region_selector")
@@ -208,11 +456,31 @@ if __name__ == "__main__":
     if "zoom" not in st.session_state or st.session_state.region_selector.lower() == "all":
         st.session_state["zoom"] = zoom_start
 
-    get_filters()
-    df = filter_walks(df)
+    engine = load_filter_engine()
+    get_filters(
+        loops="Start End Gap" in df.columns and df["Start End Gap"].notna().any(),
+        elevation="Elevation Gain" in df.columns and df["Elevation Gain"].notna().any(),
+        summits=engine.summit_index.names.tolist(),
+    )
+    positions = filter_positions(engine)
+    df = df.iloc[positions]
 
     m = folium.Map(center=center_start)
-    st.session_state["marker_cluster"] = add_walks_to_map(df, include_routes=st.session_state["routes_check"])
+    if st.session_state.get("all_routes_check"):
+        # Pre-rendered tiles (src.tiles), drawn from the lowest and highest built zoom outside that range
+        StaticTileLayer(
+            tiles=TILE_URL, attr="Routes: walkhighlands.co.uk", name="All routes", overlay=True,
+            min_native_zoom=min(TILE_ZOOMS), max_native_zoom=max(TILE_ZOOMS), max_zoom=18
+        ).add_to(m)
+    popup_col = "Compact Popup" if st.session_state["compact_popup_check"] else "Popup"
+    # Route detail follows the zoom the map was last left at, routes loaded on click follow the current zoom
+    tolerance = None if lazy_routes else tolerance_for_zoom(st.session_state.get("map_zoom", st.session_state["zoom"]))
+    fragments = load_marker_fragments()
+    paths = load_path_fragments(tolerance=tolerance) if embed_routes else None
+    st.session_state["marker_cluster"] = add_walks_to_map(
+        fragments.key(positions), positions, fragments,
+        include_routes=st.session_state["routes_check"], popup_col=popup_col, tolerance=tolerance, _paths=paths
+    )
 
     if df.shape[0]:
         st.session_state["center"] = (df["lat"].mean(), df["lon"].mean())
@@ -224,11 +492,15 @@ if __name__ == "__main__":
         st.session_state["zoom"] = zoom_start
         st.session_state["num_walks"] = 0
 
-    df = df[["Name", "Region", "Distance", "Ascent", "Time", "Start Grid Ref", "Rating", "Votes", "Grade", "Bog", "Munros Climbed", "Munro", "Corbett", "Fiona", "Donald", "Sub 2000"]]
-    df = df.rename(columns={"Distance": "Distance (km)", "Ascent": "Ascent (m)", "Time": "Time (avg hrs)"})
+    route_cols = [col for col in ["Route Distance", "Elevation Gain"] if col in df.columns and df[col].notna().any()]
+    df = df[["Name", "Region", "Distance", *route_cols, "Ascent", "Time", "Start Grid Ref", "Rating", "Votes", "Grade", "Bog", "Munros Climbed", "Munro", "Corbett", "Fiona", "Donald", "Sub 2000"]]
+    df = df.rename(columns={
+        "Distance": "Distance (km)", "Route Distance": "GPX Distance (km)", "Elevation Gain": "GPX Ascent (m)",
+        "Ascent": "Ascent (m)", "Time": "Time (avg hrs)"
+    })
 
     # Display
-    st_folium(
+    map_state = st_folium(
         m, 
         feature_group_to_add=st.session_state["marker_cluster"], 
         center=st.session_state["center"], 
@@ -237,5 +509,8 @@ if __name__ == "__main__":
         height=map_height
     )
 
+    if map_state and map_state.get("zoom"):
+        st.session_state["map_zoom"] = map_state["zoom"]
+
     st.markdown(f"Total Walks: {df.shape[0]}")
     st.dataframe(df.reset_index(drop=True))
@@ -0,0 +1,33 @@
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+import streamlit.logger
+from benchmarks import suite
+
+parser = argparse.ArgumentParser(description="Time the pipeline on synthetic walk catalogues")
+parser.add_argument("--scales", type=float, nargs="+", default=suite.SCALES, help="Catalogue sizes as multiples of the real one")
+parser.add_argument("--repeat", type=int, default=3, help="Times each benchmark is run")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic catalogue")
+parser.add_argument("--output", type=Path, default=None, help="Results file, defaults to benchmarks/results/<date>.json")
+parser.add_argument("--compare", type=Path, default=None, help="Earlier results file to compare against")
+parser.add_argument("--threshold", type=float, default=suite.DEFAULT_THRESHOLD,
+                    help="Exit with an error when a benchmark is this many times slower than in --compare")
+args = parser.parse_args()
+
+# Dashboard functions are called outside of a streamlit run, which streamlit warns about on every call
+streamlit.logger.set_log_level("error")
+
+results = suite.run(tuple(args.scales), repeat=args.repeat, seed=args.seed)
+
+output = args.output or Path("benchmarks") / "results" / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+suite.save(results, output)
+print("\n".join(suite.report(results)))
+print(f"Saved results to {output}")
+
+if args.compare is not None:
+    lines, regressions = suite.compare(suite.load(args.compare), results, threshold=args.threshold)
+    print("\n".join(lines))
+    if regressions:
+        print(f"Slower than {args.compare}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -1,3 +1,13 @@
-from src import etl
+import argparse
+from src import etl, instrument
 
-etl.main()
\ No newline at end of file
+parser = argparse.ArgumentParser(description="Process raw walk data")
+parser.add_argument("--incremental", action="store_true", help="Only re-process walks that changed since the last run")
+parser.add_argument("--workers", type=int, default=None, help="Parse raw files in a pool of this many processes")
+parser.add_argument("--csv", action="store_true", help="Also write the processed dataset as CSV")
+instrument.add_arguments(parser)
+args = parser.parse_args()
+
+instrument.start("etl")
+etl.main(incremental=args.incremental, workers=args.workers, csv=args.csv)
+instrument.finish(args.report, metrics_path=args.metrics)
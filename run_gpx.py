@@ -1,78 +1,234 @@
+import argparse
+import json
 import re
 import pandas as pd
-from time import sleep
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Optional
+import requests
+from src.fetch import RateLimiter, describe_error, make_session
+from src.etl import add_route_metrics, build_spatial_index, walk_ids
 from src.gpx import parse, positive_long
+from src.route_metrics import distance_disagreements
+from src.routes import RouteStore, read_route_table, route_table, write_route_table
+from src.simplify import route_importance
+from src import instrument, processed, tiles
 from config import settings
 
 url_pattern = re.compile(r'href=[\'"]?([^\'" >]+)')
 
+# Columns of the processed walks routes are fetched for
+ROUTE_COLUMNS = ("Walk Id", "Link", "GPX")
 
-def process_row(row: pd.Series):
 
-    try:
+def gpx_url(link_html: Optional[str]) -> Optional[str]:
+
+    match = url_pattern.search(link_html) if isinstance(link_html, str) else None
+    return match.group(1) if match else None
+
 
-        match = url_pattern.search(row["GPX"])
-        url = match.group(1)
+def fetch_path(url: Optional[str], session: requests.Session, limiter: RateLimiter) -> dict:
+    """Fetch a single GPX route, returning its path (and elevations when the GPX has them) or the reason it failed."""
+
+    if url is None:
+        return {"url": url, "error": "No GPX link"}
+
+    try:
+        limiter.wait(url)
         print(f"Fetching: {url}")
 
-        gpx_path = parse(url)
-        gpx_path = positive_long(gpx_path)
-        return {
-            "index": row.name,
-            "path": list(zip(gpx_path["lat"].to_list(), gpx_path["lon"].to_list()))
-        }
+        with instrument.stage("gpx.route"):
+            gpx_path = positive_long(parse(url, session=session))
+        instrument.count("gpx.route_points", len(gpx_path))
+        result = {"url": url, "path": gpx_path[["lat", "lon"]].values.tolist()}
+        if "ele" in gpx_path.columns:
+            result["ele"] = gpx_path["ele"].round(1).tolist()
+        return result
     except Exception as e:
-        print(e)
+        return {"url": url, "error": describe_error(e)}
+
+
+def load_checkpoint() -> dict[str, dict]:
+
+    results = {}
+    if settings.gpx_checkpoint_path.is_file():
+        with open(settings.gpx_checkpoint_path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partially written final line from an interrupted run
+                    continue
+                results[result["url"]] = result
+
+    return results
+
+
+def fetch_paths(urls: Iterable[Optional[str]], workers: int = settings.request_workers, checkpoint_every: int = 20) -> dict[str, dict]:
+    """Fetch GPX routes concurrently, limited to one request per `request_delay` to each host. Results are appended
+    to a checkpoint file as they complete, and routes already fetched by an interrupted run are not fetched again."""
+
+    results = load_checkpoint()
+    todo = [url for url in dict.fromkeys(urls) if url is not None and "path" not in results.get(url, {})]
+    instrument.count("gpx.from_checkpoint", len(results))
+
+    session = make_session(pool_size=workers)
+    limiter = RateLimiter(settings.request_delay)
+
+    with open(settings.gpx_checkpoint_path, "a") as fout, ThreadPoolExecutor(max_workers=workers) as executor:
+
+        futures = [executor.submit(fetch_path, url, session, limiter) for url in todo]
+        for i, future in enumerate(as_completed(futures), start=1):
+
+            result = future.result()
+            results[result["url"]] = result
+            fout.write(json.dumps(result) + "\n")
+
+            if "error" in result:
+                instrument.count("gpx.failed")
+                print(f"Failed: {result['url']} ({result['error']})")
+            else:
+                instrument.count("gpx.fetched")
+
+            if i % checkpoint_every == 0:
+                fout.flush()
+
+    return results
+
 
+def report_failures(results: dict[str, dict]) -> None:
 
-def full():
+    failures = [r for r in results.values() if "error" in r]
+    if failures:
+        print(f"{len(failures)} routes failed, see {settings.gpx_checkpoint_path} for reasons")
 
-    walk_data = pd.read_parquet(settings.processed_path)
 
-    all_paths = []
-    # Make requests slowly
-    for _, row in walk_data.iterrows():
+def report_disagreements(walk_data: pd.DataFrame) -> None:
 
-        data = process_row(row)
-        
-        if data is not None:
-            all_paths.append(data)
-        
-        sleep(settings.request_delay)
-        
-    paths_df = pd.DataFrame(all_paths).set_index("index")
-    gpx_walk_data = walk_data.join(paths_df)
+    disagree = distance_disagreements(walk_data)
+    instrument.count("gpx.distance_disagreements", int(disagree.sum()))
+    if disagree.any():
+        print(f"{disagree.sum()} walks have a scraped distance more than 25% off their GPX route length")
 
-    gpx_walk_data.to_parquet(settings.processed_gpx_path, engine="fastparquet")
-    gpx_walk_data.to_csv(settings.processed_gpx_path.with_suffix(".csv"))
 
+def save_routes(table: pa.Table) -> None:
+    """Rebuild everything derived from the route table: the route store, route files, tiles, route metrics of the
+    processed walks and the spatial index."""
 
-def update():
+    with instrument.stage("gpx.route_store"):
+        routes = RouteStore.from_table(table)
+        # Precompute multi resolution simplification so the dashboard can draw routes at the detail the zoom needs
+        routes.importance = route_importance(routes.coords, routes.offsets)
+        routes.save(settings.routes_path)
 
-    gpx_walk_data = pd.read_parquet(settings.processed_gpx_path)
+    # Per walk route files the dashboard loads when a walk is clicked
+    with instrument.stage("gpx.route_files"):
+        routes.write_files(settings.route_files_path)
 
-    for index, row in gpx_walk_data.iterrows():
+    # Tiles of every route, only re-rendered where routes changed
+    with instrument.stage("gpx.tiles"):
+        rendered = tiles.build(routes, settings.tiles_path)
+    instrument.count("gpx.tiles_rendered", rendered)
+    print(f"Rendered {rendered} route tiles")
 
-        if row["path"] is None:
-            data = process_row(row)
-            gpx_walk_data.at[index, "path"] = data["path"]
-            sleep(settings.request_delay)
+    # Refresh route metrics of the processed walks and route bounding boxes in the spatial index
+    with instrument.stage("gpx.route_metrics"):
+        walk_data = add_route_metrics(processed.read(settings.processed_path))
+        processed.write(walk_data, settings.processed_path)
+    report_disagreements(walk_data)
 
-    gpx_walk_data.to_parquet(settings.processed_gpx_path, engine="fastparquet")
-    gpx_walk_data.to_csv(settings.processed_gpx_path.with_suffix(".csv"))
+    with instrument.stage("gpx.spatial_index"):
+        build_spatial_index(walk_data).save(settings.spatial_index_path)
 
 
-def migrate():
+def walk_routes(walk_data: pd.DataFrame, urls: pd.Series, results: dict[str, dict]) -> pa.Table:
+    """Route table rows of the fetched routes of these walks."""
 
-    data = pd.read_parquet(settings.processed_gpx_path)
-    data["path"] = data["path"].apply(lambda x: [list(y) for y in x])
-    data.to_parquet(settings.processed_gpx_path, engine="fastparquet")
-    data.to_csv(settings.processed_gpx_path.with_suffix(".csv"))
+    fetched = urls.map(lambda url: results.get(url, {}))
+    return route_table(walk_ids(walk_data), fetched.map(lambda r: r.get("path")), fetched.map(lambda r: r.get("ele")))
+
+
+def full(workers: int = settings.request_workers):
+    """Fetch the route of every processed walk, replacing the route table."""
+
+    walk_data = processed.read(settings.processed_path, columns=ROUTE_COLUMNS)
+    urls = walk_data["GPX"].map(gpx_url)
+
+    with instrument.stage("gpx.fetch"):
+        results = fetch_paths(urls, workers=workers)
+    report_failures(results)
+
+    table = walk_routes(walk_data, urls, results)
+    if not table.num_rows:
+        print("No routes fetched, the route table is unchanged")
+        return
+
+    with instrument.stage("gpx.write"):
+        write_route_table(settings.route_table_path, table, replace=True)
+    save_routes(table)
+
+    # Full refresh complete, the next one should fetch everything again
+    settings.gpx_checkpoint_path.unlink(missing_ok=True)
+
+
+def update(workers: int = settings.request_workers):
+    """Fetch routes of the processed walks missing from the route table (new walks and earlier failures),
+    upserting only those."""
+
+    walk_data = processed.read(settings.processed_path, columns=ROUTE_COLUMNS)
+    existing = read_route_table(settings.route_table_path)
+    stored = set(existing.column("Walk Id").to_pylist()) if existing is not None else set()
+    walk_data = walk_data[~walk_ids(walk_data).isin(stored)]
+
+    urls = walk_data["GPX"].map(gpx_url)
+    with instrument.stage("gpx.fetch"):
+        results = fetch_paths(urls, workers=workers)
+    report_failures(results)
+
+    table = walk_routes(walk_data, urls, results)
+    instrument.count("gpx.routes_upserted", table.num_rows)
+    if table.num_rows:
+        with instrument.stage("gpx.write"):
+            write_route_table(settings.route_table_path, table)
+        save_routes(read_route_table(settings.route_table_path))
+    else:
+        # Nothing derived from the route table changed
+        print("No new routes")
+
+    settings.gpx_checkpoint_path.unlink(missing_ok=True)
+
+
+def migrate_route_table():
+    """Build the route table from processed_gpx.parquet, where routes were stored as a list of [lat, lon] lists
+    joined onto the walks."""
+
+    gpx_walk_data = pd.read_parquet(settings.processed_gpx_path, engine="fastparquet")
+    table = route_table(walk_ids(gpx_walk_data), gpx_walk_data["path"], gpx_walk_data.get("ele"))
+    write_route_table(settings.route_table_path, table, replace=True)
+    save_routes(table)
+
+
+def migrate_routes():
+    """Rebuild the compact, simplified route store and everything derived from it from the route table."""
+
+    save_routes(read_route_table(settings.route_table_path))
 
 
 if __name__ == "__main__":
-    
-    full()
-    update()
-    # migrate()
-    
+
+    parser = argparse.ArgumentParser(description="Fetch GPX routes of the processed walks")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Only rebuild the route store, route files and tiles from the route table, e.g. on deploy")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrument.start("gpx")
+    if args.rebuild:
+        migrate_routes()
+    else:
+        full()
+        update()
+    instrument.finish(args.report, metrics_path=args.metrics)
+    # migrate_route_table()
+    # migrate_routes()
+
@@ -1,3 +1,17 @@
-from src import scrape
+import argparse
+from src import instrument, scrape
+from config import settings
 
-scrape.main()
\ No newline at end of file
+parser = argparse.ArgumentParser(description="Scrape walk data")
+parser.add_argument("--backend", choices=["http", "selenium"], default="http",
+                    help="Download walk pages over HTTP (browser fallback) or scrape them all in the browser")
+parser.add_argument("--workers", type=int, default=settings.request_workers, help="Number of concurrent crawl workers")
+parser.add_argument("--offline", action="store_true", help="Replay pages from the HTTP cache without network access")
+instrument.add_arguments(parser)
+args = parser.parse_args()
+
+settings.offline = args.offline
+
+instrument.start("scrape")
+scrape.main(backend=args.backend, workers=args.workers)
+instrument.finish(args.report, metrics_path=args.metrics)
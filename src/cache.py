@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from config import settings
+
+# Response headers kept with cached bodies, bodies are stored decoded so content-encoding is dropped
+CACHED_HEADERS = ("content-type", "etag", "last-modified")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    url TEXT PRIMARY KEY, digest TEXT NOT NULL, headers TEXT NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+"""
+
+
+class CacheMiss(requests.ConnectionError):
+    """Offline and the URL is not cached."""
+
+
+class ResponseCache:
+
+    def __init__(self, path: Path = settings.http_cache_path, ttl: float = settings.http_cache_ttl,
+                 max_size: int = settings.http_cache_size):
+        """On disk cache of successful GET responses keyed by URL. Bodies are gzipped and stored by the SHA-256 of
+        their content, so pages served at several URLs are stored once. Entries older than `ttl` seconds are stale
+        and revalidated, and least recently used entries are evicted when the bodies exceed `max_size` bytes."""
+
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        (path / "bodies").mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path / "index.sqlite", check_same_thread=False, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+    def _body_path(self, digest: str) -> Path:
+        return self.path / "bodies" / digest[:2] / f"{digest}.gz"
+
+    def get(self, url: str) -> Optional[dict]:
+        """Cached entry with its body, headers and whether it is still fresh, None if not cached."""
+
+        with self._lock:
+            row = self._db.execute("SELECT digest, headers, stored_at FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE entries SET accessed_at = ? WHERE url = ?", (time.time(), url))
+
+        digest, headers, stored_at = row
+        try:
+            body = gzip.decompress(self._body_path(digest).read_bytes())
+        except FileNotFoundError:
+            return None
+
+        return {"body": body, "headers": json.loads(headers), "fresh": time.time() - stored_at < self.ttl}
+
+    def put(self, url: str, body: bytes, headers: dict) -> None:
+
+        digest = hashlib.sha256(body).hexdigest()
+        body_path = self._body_path(digest)
+        headers = {k: v for k, v in headers.items() if k.lower() in CACHED_HEADERS}
+
+        if not body_path.is_file():
+            body_path.parent.mkdir(exist_ok=True)
+            # Write then rename, so a concurrent or interrupted write never leaves a partial body
+            tmp = body_path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(gzip.compress(body))
+            os.replace(tmp, body_path)
+
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO bodies VALUES (?, ?)", (digest, body_path.stat().st_size))
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (url, digest, json.dumps(headers), now, now))
+            self._evict()
+
+    def touch(self, url: str) -> None:
+        """Mark an entry fresh again after the server confirmed it has not changed."""
+
+        with self._lock:
+            self._db.execute("UPDATE entries SET stored_at = ? WHERE url = ?", (time.time(), url))
+
+    def size(self) -> int:
+
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the stored bodies fit within max_size. Called with the lock held."""
+
+        size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+        if size <= self.max_size:
+            return
+
+        for url, digest in self._db.execute("SELECT url, digest FROM entries ORDER BY accessed_at").fetchall():
+
+            self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            if self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                size -= self._db.execute("SELECT size FROM bodies WHERE digest = ?", (digest,)).fetchone()[0]
+                self._db.execute("DELETE FROM bodies WHERE digest = ?", (digest,))
+                self._body_path(digest).unlink(missing_ok=True)
+
+            if size <= self.max_size:
+                break
+
+
+def cached_response(request: requests.PreparedRequest, entry: dict) -> requests.Response:
+
+    response = requests.Response()
+    response.status_code = 200
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response._content = entry["body"]
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = request.url
+    response.request = request
+    response.from_cache = True
+
+    return response
+
+
+class CachingAdapter(HTTPAdapter):
+
+    def __init__(self, cache: ResponseCache, offline: bool = False, **kwargs):
+        """Transport adapter serving GET requests from a ResponseCache. Stale entries are revalidated with a
+        conditional request, and offline every request is served from the cache or fails with CacheMiss."""
+
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.offline = offline
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+
+        if request.method != "GET":
+            if self.offline:
+                raise CacheMiss(f"Only cached GET requests are available offline: {request.method} {request.url}", request=request)
+            return super().send(request, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None and (entry["fresh"] or self.offline):
+            return cached_response(request, entry)
+        if self.offline:
+            raise CacheMiss(f"Not cached: {request.url}", request=request)
+
+        if entry is not None:
+            headers = CaseInsensitiveDict(entry["headers"])
+            if "etag" in headers:
+                request.headers["If-None-Match"] = headers["etag"]
+            if "last-modified" in headers:
+                request.headers["If-Modified-Since"] = headers["last-modified"]
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.touch(request.url)
+            return cached_response(request, entry)
+
+        if response.status_code == 200:
+            self.cache.put(request.url, response.content, response.headers)
+
+        response.from_cache = False
+        return response
+
+
+def replay_server(cache: ResponseCache, origin: str, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Stub HTTP server replaying cached responses for `origin`, e.g. to point a browser at when offline. Serve with
+    server.serve_forever() in a thread, the bound address is server.server_address."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            entry = cache.get(urljoin(origin, self.path))
+            if entry is None:
+                self.send_error(404, "Not cached")
+                return
+
+            self.send_response(200)
+            for k, v in entry["headers"].items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(entry["body"])))
+            self.end_headers()
+            self.wfile.write(entry["body"])
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
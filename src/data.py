@@ -1,18 +1,65 @@
-import json
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
 from config import settings
 
+try:
+    # Optional, considerably faster decoder for the raw scrape files
+    from orjson import loads
+except ImportError:
+    from json import loads
 
-def load_walk_data() -> pd.DataFrame:
-    file_gen = settings.raw_data_path.glob("*walks.json")
+RAW_FILE_PATTERN = "*walks.json"
 
-    dfs = []  # an empty list to store the data frames
-    for file in file_gen:
-        with open(file) as f:
-            data = json.load(f)
-            dfs.append(pd.DataFrame(data))
 
-    return pd.concat(dfs, ignore_index=True)
+def raw_walk_files() -> list[Path]:
+    return sorted(settings.raw_data_path.glob(RAW_FILE_PATTERN))
+
+
+def read_walk_file(path: Path) -> list[dict]:
+    return loads(path.read_bytes())
+
+
+def iter_walk_files(files: Optional[Iterable[Path]] = None, workers: Optional[int] = None) -> Iterator[tuple[Path, list[dict]]]:
+    """Yield (file, records) for each raw region file in order. Files are parsed one at a time unless workers is
+    given, in which case they are parsed in a process pool (faster for many large files, but no longer one region
+    in memory at a time)."""
+
+    files = raw_walk_files() if files is None else list(files)
+
+    if workers is None or workers <= 1 or len(files) < 2:
+        for file in files:
+            yield file, read_walk_file(file)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from zip(files, executor.map(read_walk_file, files))
+
+
+def records_to_frame(records: list[dict], columns: Optional[list[str]] = None) -> pd.DataFrame:
+    """Build a DataFrame column by column from raw records. Columns default to the union of record keys in order of
+    first appearance, missing values are None."""
+
+    if columns is None:
+        columns = list(dict.fromkeys(key for record in records for key in record))
+
+    return pd.DataFrame({col: [record.get(col) for record in records] for col in columns})
+
+
+def iter_walk_data(files: Optional[Iterable[Path]] = None) -> Iterator[pd.DataFrame]:
+    """Stream raw walk data one region file at a time to keep memory bounded."""
+
+    for _, records in iter_walk_files(files):
+        yield records_to_frame(records)
+
+
+def load_walk_data(files: Optional[Iterable[Path]] = None, workers: Optional[int] = None) -> pd.DataFrame:
+
+    records = []
+    for _, file_records in iter_walk_files(files, workers=workers):
+        records.extend(file_records)
+
+    return records_to_frame(records)
 
 
 if __name__ == "__main__":
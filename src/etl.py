@@ -1,19 +1,35 @@
+import hashlib
 import json
+import numpy as np
 import pandas as pd
 import re
-from OSGridConverter import grid2latlong
-from OSGridConverter.base import OSGridError
+from functools import lru_cache, partial
+from typing import Optional
 from config import settings
+from src import data, instrument, processed, schema
+from src.grid import grid_to_latlon
+from src.route_metrics import METRIC_COLUMNS, walk_metrics
+from src.routes import RouteStore, walk_id
+from src.schema import Column
+from src.spatial import SpatialIndex
+from src.summits import SummitIndex
 
 
-def capitalize_string(string: str, exceptions: list[str] = ['and', 'or', 'the', 'on', 'in', 'of', 'to', 'via', 'near', 'by', 'up', 'from']) -> str:
-    # This regular expression captures words and their trailing punctuation
-    pattern = r"([\w-]+['\w-]*[\.,!?:;]*)(\s*)"
+HREF_PATTERN = r'href="([^"]+)"'
+
+# This regular expression captures words and their trailing punctuation
+CAPITALIZE_PATTERN = re.compile(r"([\w-]+['\w-]*[\.,!?:;]*)(\s*)")
+CAPITALIZE_EXCEPTIONS = frozenset(['and', 'or', 'the', 'on', 'in', 'of', 'to', 'via', 'near', 'by', 'up', 'from'])
+
+
+# Walk names, regions and summits repeat a lot, so results are memoised
+@lru_cache(maxsize=None)
+def capitalize_string(string: str, exceptions: frozenset[str] = CAPITALIZE_EXCEPTIONS) -> str:
     
     capitalized_words = []
     
     # Use findall to get a list of tuples where each tuple contains (word, space)
-    for word, space in re.findall(pattern, string):
+    for word, space in CAPITALIZE_PATTERN.findall(string):
         
         # Capitalize the first word regardless of its presence in the exceptions list
         if not capitalized_words:
@@ -38,107 +54,264 @@ def format_operations(element):
         return round(element, 2)
     else:
         return element
-    
+
+
+def format_column(values: pd.Series, decimals: int = 2) -> pd.Series:
+    """Column-wise equivalent of values.map(format_operations). Numeric columns are rounded in one call, and
+    object columns are formatted once per unique value rather than once per cell. Columns holding only HTML are
+    left as they are."""
+
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.round(decimals)
+    if not pd.api.types.is_object_dtype(values):
+        return values
+
+    codes, uniques = pd.factorize(values)
+    if not len(uniques) or pd.Series(uniques).astype(str).str.startswith("<").all():
+        return values
+
+    formatted = np.array([format_operations(u) for u in uniques], dtype=object)
+    formatted_values = formatted.take(codes)
+    missing = codes < 0
+    formatted_values[missing] = values.to_numpy()[missing]
+
+    return pd.Series(formatted_values, index=values.index, name=values.name)
+
 
 def html_link(link: str, text="click here") -> str:
     return f'<a href="{link}" target="blank">{text}</a>'
 
 
-def series_to_html(row: pd.Series) -> str:
-    return "".join(["<b>" + c + "</b>" + ": " + str(row[c]) + "<br>" for c in row.index])
+def _fixed(values: pd.Series, decimals: int = 2) -> pd.Series:
+    return pd.Series(np.char.mod(f"%.{decimals}f", values.to_numpy(dtype=float)), index=values.index, dtype=object)
 
 
-def main():
-    file_gen = settings.raw_data_path.glob("*walks.json")
+def build_popups(df: pd.DataFrame, compact: bool = False) -> pd.Series:
+    """Build marker popup HTML for all walks at once by concatenating formatted columns. The compact variant keeps
+    only the name, headline stats and walk link to reduce the marker payload sent to the browser."""
 
-    dfs = []  # an empty list to store the data frames
-    for file in file_gen:
-        with open(file) as f:
-            data = json.load(f)
-            dfs.append(pd.DataFrame(data))
+    if compact:
+        return (
+            "<b>" + df["Name"].astype(str) + "</b><br>"
+            + df["Distance"].astype(str) + "km | "
+            + _fixed(df["Time"], 1) + "h | "
+            + df["Ascent"].astype(str) + "m<br>"
+            + df["Link"].astype(str)
+        )
 
-    df = pd.concat(dfs, ignore_index=True)  # concatenate all the data frames in the list.
+    values = {
+        "Name": df["Name"].astype(str),
+        "Distance": df["Distance"].astype(str) + "km",
+        "Time": _fixed(df["Time"]) + " hours (avg)",
+        "Ascent": df["Ascent"].astype(str) + "m",
+        "Rating": _fixed(df["Rating"]) + "/5",
+        "Link": df["Link"].astype(str),
+        "Start Point": df["Start Point"].astype(str),
+        "GPX": df["GPX"].astype(str),
+    }
 
-    # Data cleaning
-    df = df.rename(columns={"Area0": "Region", "Area1": "Subregion", "StartPoint": "Start Point"})
+    popup = pd.Series("", index=df.index, dtype=object)
+    for c, v in values.items():
+        popup += "<b>" + c + "</b>: " + v + "<br>"
 
-    for col in df.columns:
-        # Combining plural columns
-        if col + 's' in df.columns:
-            df[col] = df[col].fillna(df[col + 's'])
-            df = df.drop(columns=col + 's')
+    return popup
 
-    hill_names = ["munro", "corbett", "donald", "fiona", "sub 2000"]
 
-    for hill_name in hill_names:
-        
-        hill_cols = [col for col in df.columns if hill_name in col.lower()]
-        df[hill_cols] = df[hill_cols].fillna("").astype(str)
-        combined_hill_col = df[hill_cols].agg(lambda x: ', '.join(filter(None, x)), axis=1)
-        
-        df.drop(columns=hill_cols, inplace=True)
-        df[hill_name.capitalize()] = combined_hill_col
+def walk_ids(df: pd.DataFrame) -> pd.Series:
+    """Walk id of each processed walk (see src.routes.walk_id), from its link for datasets processed before the id
+    column."""
+
+    if "Walk Id" in df.columns:
+        return df["Walk Id"]
+    return link_from_html(df["Link"]).map(walk_id)
+
+
+def row_fingerprint(record: dict) -> str:
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
 
-    df["Munros Climbed"] = df["Munro"].str.count(",") + 1
-    df.loc[df["Munro"] == "", "Munros Climbed"] = 0
+def link_from_html(links: pd.Series) -> pd.Series:
+    return links.str.extract(HREF_PATTERN, expand=False)
 
+
+def load_manifest() -> dict:
+
+    if not settings.processed_manifest_path.is_file():
+        return {}
+
+    with open(settings.processed_manifest_path) as f:
+        return json.load(f)
+
+
+def first_fingerprints(manifest: dict) -> dict[str, tuple[str, str]]:
+    """Map each walk link to the file it is first seen in and its fingerprint there, duplicate walks listed under
+    several areas keep their first occurrence."""
+
+    first = {}
+    for name, entry in manifest.items():
+        for link, fingerprint in entry["rows"].items():
+            first.setdefault(link, (name, fingerprint))
+
+    return first
+
+
+def munros_climbed(munros: pd.Series) -> pd.Series:
+    return pd.Series(np.where(munros == "", 0, munros.str.count(",") + 1), index=munros.index)
+
+
+def start_latlon(refs: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """Start point of each walk from its grid reference, longitudes made positive (see src.gpx.positive_long)."""
+
+    lat, lon = grid_to_latlon(refs)
+    return lat, np.where(lon < 0, 360 + lon, lon)
+
+
+CLEAN_RENAMES = {"Area0": "Region", "Area1": "Subregion", "StartPoint": "Start Point"}
+HILL_NAMES = ["munro", "corbett", "donald", "fiona", "sub 2000"]
+POPUP_SOURCES = ("Name", "Distance", "Time", "Ascent", "Rating", "Link", "Start Point", "GPX")
+
+# Columns of the processed dataset, each built from raw columns or columns listed before it, see src.schema
+CLEAN_SCHEMA = (
+    Column("Name", lambda names: names, ("Name",)),
+    # From the raw link, before it is made a HTML link
+    Column("Walk Id", lambda links: links.map(walk_id), ("Link",), format=False),
     # Kilometers
-    df["Distance"] = df["Distance"].str.extract(r"^([0-9\.]*)").astype(float)
-    
-    # Does not seem to be used anymore
-    # df["Time"].fillna(df["Time (summer conditions)"], inplace=True)
-    # df.drop(columns="Time (summer conditions)", inplace=True)
-
-    time = df["Time"].str.split("-", expand=True)
-    minute_cells = time.apply(lambda x: x.str.contains("min")).astype(bool)
-    minute_cells[0] = minute_cells[0] | minute_cells[1]
-
-    for c in time.columns:
-        time[c] = time[c].str.extract(r"(\d+\.?\d*)").astype(float)
-
-    time[minute_cells] = time[minute_cells] / 60
-    time[1].fillna(time[0], inplace=True)
-    df["Time"] = time.mean(axis=1)
-
-    df["Start Grid Ref"] = df["Start Grid Ref"].str.replace(" ", "")
-    df["Rating"] = df["Rating"].astype(float)
-    df["Votes"] = df["Votes"].astype(int)
-    df["Ascent"] = df["Ascent"].str.extract(r"(\d+\.?\d*)").astype(int)
-    df["Link"] = df["Link"].apply(lambda x: html_link(x))
-    df["Start Point"] = df["Start Point"].apply(lambda x: html_link(x))
-    df["GPX"] = df["GPX"].apply(lambda x: html_link(x, text="download"))
-
-    coords = {"lat": [], "lon": []}
-    for p in df["Start Grid Ref"]:
-        try:
-            # TODO: This gives wrong longitude for some walks (e.g. castle stalker) but GPX gives correct position, may
-            #   need to use starting point of that instead
-            loc = grid2latlong(p)
-            long = loc.longitude if loc.longitude > 0 else 360 + loc.longitude
-            coords["lat"].append(float(loc.latitude))
-            coords["lon"].append(float(long))
-        except OSGridError:
-            coords["lat"].append(None)
-            coords["lon"].append(None)
-
-    coords = pd.DataFrame(coords)
-    df = pd.concat([df, coords], axis=1)
-    df = df.applymap(format_operations)
-    df["Start Grid Ref"] = df["Start Grid Ref"].str.upper()
-    df = df.dropna(subset=["lat", "lon"])
-    df.reset_index(drop=True, inplace=True)
-
-    # Creating df for marker tooltip
-    popup_df = df[["Name", "Distance", "Time", "Ascent", "Rating", "Link", "Start Point", "GPX"]].copy()
-    popup_df["Distance"] = popup_df["Distance"].apply(lambda x: f"{x}km")
-    popup_df["Ascent"] = popup_df["Ascent"].apply(lambda x: f"{x}m")
-    popup_df["Rating"] = popup_df["Rating"].apply(lambda x: f"{x:.2f}/5")
-    popup_df["Time"] = popup_df["Time"].apply(lambda x: f"{x:.2f} hours (avg)")
-    
-    df["Popup"] = popup_df.apply(series_to_html, axis=1)
+    Column("Distance", schema.leading_number, ("Distance",)),
+    Column("Time", schema.time_hours, ("Time",), stage="time"),
+    Column("Start Grid Ref", lambda refs: refs.str.replace(" ", "").str.upper(), ("Start Grid Ref",), format=False),
+    Column("Rating", lambda ratings: ratings.astype(float), ("Rating",)),
+    Column("Votes", lambda votes: votes.astype(int), ("Votes",)),
+    Column("Ascent", schema.first_int, ("Ascent",)),
+    Column("Link", schema.html_links, ("Link",), format=False),
+    Column("Start Point", schema.html_links, ("Start Point",), format=False),
+    Column("GPX", partial(schema.html_links, text="download"), ("GPX",), format=False),
+    *[Column(hill_name.capitalize(), schema.join_nonempty, match=hill_name, stage="hills") for hill_name in HILL_NAMES],
+    Column("Munros Climbed", munros_climbed, ("Munro",), stage="hills"),
+    # TODO: Some walks (e.g. castle stalker) have an incorrect grid reference on the source page, but GPX gives
+    #   correct position, may need to use starting point of that instead
+    Column(("lat", "lon"), start_latlon, ("Start Grid Ref",), stage="grid"),
+    # Marker popups
+    Column("Popup", lambda *cols: build_popups(pd.concat(cols, axis=1)), POPUP_SOURCES, format=False, stage="popups"),
+    Column("Compact Popup", lambda *cols: build_popups(pd.concat(cols, axis=1), compact=True), POPUP_SOURCES,
+           format=False, stage="popups"),
+)
+
+
+def clean(df: pd.DataFrame) -> pd.DataFrame:
+
+    instrument.count("etl.rows_in", len(df))
+    df = schema.apply(
+        df, CLEAN_SCHEMA, renames=CLEAN_RENAMES, format_column=format_column,
+        stage=lambda name: instrument.stage(f"etl.clean.{name}"), required=("lat", "lon"),
+    )
+    instrument.count("etl.rows_out", len(df))
+    return df
+
+
+def build_spatial_index(df: pd.DataFrame) -> SpatialIndex:
+    """Spatial index over walk start points, with route bounding boxes when the route store exists."""
+
+    route_bboxes = None
+    if settings.routes_path.is_dir():
+        routes = RouteStore.load(settings.routes_path)
+        positions = routes.positions(walk_ids(df))
+        route_bboxes = np.where((positions >= 0)[:, None], routes.bboxes()[positions], np.nan)
+
+    return SpatialIndex.from_frame(df, route_bboxes=route_bboxes)
+
+
+def add_route_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    """Route metric columns (see src.route_metrics) from the route store, NaN for walks without a route and for
+    every walk when there is no store yet."""
+
+    if settings.routes_path.is_dir():
+        metrics = walk_metrics(RouteStore.load(settings.routes_path), walk_ids(df))
+    else:
+        metrics = pd.DataFrame(np.nan, index=df.index, columns=list(METRIC_COLUMNS), dtype=np.float32)
+
+    return df.assign(**{col: metrics[col].to_numpy() for col in METRIC_COLUMNS})
+
+
+def main(incremental: bool = False, workers: Optional[int] = None, csv: bool = False) -> pd.DataFrame:
+    """Process raw walk files into the processed dataset. In incremental mode only walks whose raw record changed
+    since the last run (per the manifest) are cleaned, and are merged into the existing processed dataset by link.
+    Changed raw files are parsed in a process pool when workers is given. A CSV copy of the dataset is only
+    written with `csv`."""
+
+    previous = load_manifest() if incremental and settings.processed_path.is_file() else {}
+
+    manifest, digests, records = {}, {}, {}
+    with instrument.stage("etl.hash"):
+        for file in data.raw_walk_files():
+
+            digest = hashlib.sha256(file.read_bytes()).hexdigest()
+
+            # Placeholder keeps the manifest in file order, entries for changed files are filled in once parsed
+            manifest[file.name] = previous.get(file.name)
+            if manifest[file.name] is None or manifest[file.name]["hash"] != digest:
+                digests[file.name] = digest
+
+    instrument.count("etl.files", len(manifest))
+    instrument.count("etl.files_changed", len(digests))
+
+    with instrument.stage("etl.load"):
+        changed = [settings.raw_data_path / name for name in digests]
+        for file, file_records in data.iter_walk_files(changed, workers=workers):
+
+            records[file.name] = file_records
+            rows = {}
+            for record in file_records:
+                rows.setdefault(record["Link"], row_fingerprint(record))
+
+            manifest[file.name] = {"hash": digests[file.name], "rows": rows}
+
+        current = first_fingerprints(manifest)
+        old = first_fingerprints(previous)
+        stale = {link for link, (_, fingerprint) in current.items() if link not in old or old[link][1] != fingerprint}
+
+        # Walks can move to an unchanged file when removed from the file they were first seen in
+        for name in {current[link][0] for link in stale} - records.keys():
+            records[name] = data.read_walk_file(settings.raw_data_path / name)
+
+        to_clean = {}
+        for name, file_records in records.items():
+            for record in file_records:
+                if record["Link"] in stale and current[record["Link"]][0] == name:
+                    to_clean.setdefault(record["Link"], record)
+
+    dfs = []
+    if previous:
+        with instrument.stage("etl.read_processed"):
+            previous_df = processed.read(settings.processed_path)
+            previous_df.index = link_from_html(previous_df["Link"])
+            dfs.append(previous_df[previous_df.index.isin(current.keys()) & ~previous_df.index.isin(stale)])
+
+    if to_clean:
+        with instrument.stage("etl.clean"):
+            cleaned = clean(data.records_to_frame(list(to_clean.values())))
+            cleaned.index = link_from_html(cleaned["Link"])
+            dfs.append(cleaned)
+
+    with instrument.stage("etl.merge"):
+        df = pd.concat(dfs)
+        df = df.loc[[link for link in current if link in df.index]].reset_index(drop=True)
+
+    with instrument.stage("etl.route_metrics"):
+        df = add_route_metrics(df)
+
+    with instrument.stage("etl.write"):
+        processed.write(df, settings.processed_path, csv=csv)
+
+        with open(settings.processed_manifest_path, "w") as fout:
+            json.dump(manifest, fout)
+
+    with instrument.stage("etl.spatial_index"):
+        build_spatial_index(df).save(settings.spatial_index_path)
+
+    with instrument.stage("etl.summit_index"):
+        SummitIndex.from_frame(df).save(settings.summit_index_path)
 
-    df.to_parquet(settings.processed_path)
-    df.to_csv(settings.processed_path.with_suffix(".csv"))
+    instrument.count("etl.rows_written", len(df))
 
     return df
 
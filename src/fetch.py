@@ -0,0 +1,88 @@
+import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from typing import Optional
+from urllib3.util.retry import Retry
+from src import instrument
+from src.cache import CachingAdapter, ResponseCache
+from config import settings
+
+
+class RateLimiter:
+
+    def __init__(self, delay: float = settings.request_delay, burst: int = 1):
+        """Token bucket per host, refilled with one token every `delay` seconds and holding at most `burst` tokens.
+        Thread safe, so a pool of workers can share one limiter and still respect the delay to each host."""
+
+        self.delay = delay
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def wait(self, url: str) -> None:
+
+        if self.delay <= 0:
+            return
+
+        host = urlsplit(url).netloc
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) / self.delay)
+
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+
+                self._buckets[host] = (tokens, now)
+                remaining = (1 - tokens) * self.delay
+
+            time.sleep(remaining)
+
+
+def make_session(pool_size: int = settings.request_workers, retries: int = 3, cache: bool = True, offline: Optional[bool] = None) -> requests.Session:
+    """Session with a connection pool large enough for `pool_size` concurrent workers, retrying transient server
+    errors with backoff. GET responses go through the on disk HTTP cache unless `cache` is False, and offline
+    (settings.offline by default) are only served from it. Responses are counted in the run report."""
+
+    retry = Retry(total=retries, backoff_factor=settings.request_delay, status_forcelist=[429, 500, 502, 503, 504])
+    pool = dict(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    if cache:
+        offline = settings.offline if offline is None else offline
+        response_cache = ResponseCache(settings.http_cache_path, settings.http_cache_ttl, settings.http_cache_size)
+        adapter = CachingAdapter(response_cache, offline=offline, **pool)
+    else:
+        adapter = HTTPAdapter(**pool)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(record_response)
+
+    return session
+
+
+def record_response(response: requests.Response, *args, **kwargs) -> None:
+    """Session response hook counting requests, cache hits, retries and bytes downloaded."""
+
+    instrument.count("http.responses")
+    if getattr(response, "from_cache", False):
+        instrument.count("http.cache_hits")
+        return
+
+    # Bodies are read by every caller anyway, streamed downloads are not used
+    instrument.count("http.bytes_downloaded", len(response.content))
+    if response.status_code >= 400:
+        instrument.count("http.errors")
+
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        instrument.count("http.retries", len(retries.history))
+
+
+def describe_error(e: Exception) -> str:
+    return f"{type(e).__name__}: {e}"
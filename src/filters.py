@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from typing import NamedTuple, Optional
+from src.spatial import SpatialIndex
+from src.summits import SummitIndex
+
+RANGE_COLUMNS = ("Munros Climbed", "Rating", "Votes", "Time", "Distance", "Grade", "Bog", "Start End Gap", "Elevation Gain")
+SUMMIT_COLUMNS = ("Corbett", "Fiona", "Donald", "Sub 2000")
+
+Range = tuple[Optional[float], Optional[float]]
+
+
+class Filters(NamedTuple):
+    """Filter state, hashable so evaluated filters can be cached. Ranges are inclusive (min, max) with None for
+    an open end, `summits` are the summit columns a walk must have, a walk must climb at least `summit_count` of
+    the named `summit_names`, `near` is (lat, lon, km)."""
+
+    region: Optional[str] = None
+    munros: Range = (None, None)
+    rating: Range = (None, None)
+    votes: Range = (None, None)
+    time: Range = (None, None)
+    distance: Range = (None, None)
+    grade: Range = (None, None)
+    bog: Range = (None, None)
+    gap: Range = (None, None)
+    elevation_gain: Range = (None, None)
+    summits: tuple[str, ...] = ()
+    summit_names: tuple[str, ...] = ()
+    summit_count: int = 1
+    near: Optional[tuple[float, float, float]] = None
+
+
+FILTER_COLUMNS = dict(zip(["munros", "rating", "votes", "time", "distance", "grade", "bog", "gap", "elevation_gain"], RANGE_COLUMNS))
+
+
+class FilterEngine:
+
+    def __init__(self, df: pd.DataFrame, index: Optional[SpatialIndex] = None, summit_index: Optional[SummitIndex] = None,
+                 cache_size: int = 256):
+        """Columnar filtering of the processed walks, built once per dataset. Range columns are kept sorted with
+        the row order so a range is two binary searches, summit columns are a bitmap of flags, named summits are
+        looked up in the summit index (built from the frame when not given) and regions are integer codes. Results
+        are row positions, cached by filter state."""
+
+        self.n = len(df)
+        self.index = index
+        self.summit_index = summit_index if summit_index is not None else SummitIndex.from_frame(df)
+
+        self.sorted_values = {}
+        self.sorted_rows = {}
+        for col in RANGE_COLUMNS:
+            # Route metric columns are missing from datasets processed before them
+            values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float) if col in df.columns else np.full(self.n, np.nan)
+            # NaN sorts last, so never falls within a range, as with pandas comparisons
+            order = np.argsort(values, kind="stable")
+            self.sorted_values[col], self.sorted_rows[col] = values[order], order
+
+        self.summit_bits = {col: np.uint8(1 << i) for i, col in enumerate(SUMMIT_COLUMNS)}
+        self.summit_flags = np.zeros(self.n, dtype=np.uint8)
+        for col, bit in self.summit_bits.items():
+            has_summit = (df[col].notna() & (df[col] != "")).to_numpy()
+            self.summit_flags[has_summit] |= bit
+
+        codes, regions = pd.factorize(df["Region"])
+        self.region_codes = codes.astype(np.int32)
+        self.regions = {region: i for i, region in enumerate(regions)}
+
+        self.evaluate = lru_cache(maxsize=cache_size)(self._evaluate)
+
+    def range_mask(self, col: str, lo: Optional[float], hi: Optional[float]) -> Optional[np.ndarray]:
+        """Rows with lo <= value <= hi, None if the range keeps every row."""
+
+        if lo is None and hi is None:
+            return None
+
+        values = self.sorted_values[col]
+        start = np.searchsorted(values, lo, side="left") if lo is not None else 0
+        end = np.searchsorted(values, hi, side="right") if hi is not None else np.searchsorted(values, np.inf, side="right")
+        if start == 0 and end == self.n:
+            return None
+
+        mask = np.zeros(self.n, dtype=bool)
+        mask[self.sorted_rows[col][start:end]] = True
+        return mask
+
+    def _evaluate(self, filters: Filters) -> np.ndarray:
+        """Sorted positions of the rows passing every filter."""
+
+        mask = np.ones(self.n, dtype=bool)
+
+        if filters.region is not None:
+            # Walks without a region have code -1, so unknown regions get a code no walk has
+            mask &= self.region_codes == self.regions.get(filters.region, len(self.regions))
+
+        for name, col in FILTER_COLUMNS.items():
+            range_mask = self.range_mask(col, *getattr(filters, name))
+            if range_mask is not None:
+                mask &= range_mask
+
+        if filters.summits:
+            required = np.bitwise_or.reduce([self.summit_bits[col] for col in filters.summits])
+            mask &= (self.summit_flags & required) == required
+
+        if filters.summit_names:
+            climbs = np.zeros(self.n, dtype=bool)
+            climbs[self.summit_index.covering(filters.summit_names, filters.summit_count)] = True
+            mask &= climbs
+
+        if filters.near is not None and self.index is not None:
+            near = np.zeros(self.n, dtype=bool)
+            near[self.index.radius(*filters.near)[0]] = True
+            mask &= near
+
+        positions = np.flatnonzero(mask)
+        # Cached arrays are shared between reruns
+        positions.flags.writeable = False
+        return positions
@@ -1,18 +1,73 @@
+import io
 import requests
 import pandas as pd
 import numpy as np
-from bs4 import BeautifulSoup
+from lxml import etree
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
 
+GPX_POINT_TAGS = ("rtept", "trkpt")
 
-def parse(link: str) -> pd.DataFrame:
 
-    response = requests.get(link)
-    soup = BeautifulSoup(response.text, "xml")
-    coords = soup.find_all("rtept")
+def read_points(source: Union[bytes, str, Path, BinaryIO], capacity: int = 1024) -> dict[str, np.ndarray]:
+    """Stream route (rtept) and track (trkpt) points from a GPX document, given as bytes, a file path or a file-like
+    object, into float arrays of lat, lon, ele and time (seconds since epoch). Elevation and time are NaN where a
+    point does not have them."""
 
-    info = [c.attrs for c in coords]
+    if isinstance(source, bytes):
+        # Upper bound on the number of points, so the arrays never need to grow
+        capacity = max(sum(source.count(tag.encode()) for tag in GPX_POINT_TAGS), 1)
+        source = io.BytesIO(source)
+    elif isinstance(source, Path):
+        source = str(source)
 
-    return pd.DataFrame(info).astype(float)
+    coords = np.full((3, capacity), np.nan)
+    times = {}
+    n = 0
+
+    for _, elem in etree.iterparse(source, events=("end",), tag=[f"{{*}}{tag}" for tag in GPX_POINT_TAGS]):
+
+        if n == coords.shape[1]:
+            coords = np.concatenate([coords, np.full_like(coords, np.nan)], axis=1)
+
+        coords[0, n] = float(elem.get("lat"))
+        coords[1, n] = float(elem.get("lon"))
+
+        for child in elem:
+            if not isinstance(child.tag, str):
+                continue
+            tag = etree.QName(child).localname
+            if tag == "ele":
+                coords[2, n] = float(child.text)
+            elif tag == "time":
+                times[n] = child.text
+
+        n += 1
+
+        # Free parsed points so memory stays flat for long tracks
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    time = np.full(n, np.nan)
+    if times:
+        timestamps = pd.to_datetime(list(times.values()), utc=True, errors="coerce")
+        time[list(times)] = (timestamps - pd.Timestamp(0, tz="UTC")).total_seconds()
+
+    return {"lat": coords[0, :n], "lon": coords[1, :n], "ele": coords[2, :n], "time": time}
+
+
+def parse(link: str, session: Optional[requests.Session] = None) -> pd.DataFrame:
+
+    response = (session or requests).get(link, timeout=30)
+    response.raise_for_status()
+    points = read_points(response.content)
+
+    if not len(points["lat"]):
+        raise ValueError("No route points in GPX")
+
+    # Elevation and time are only kept when the route has them
+    return pd.DataFrame({k: v for k, v in points.items() if k in ("lat", "lon") or not np.isnan(v).all()})
 
 
 def get_lat_long_tuples(df: pd.DataFrame) -> list[tuple[float, float]]:
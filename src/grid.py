@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+from typing import Iterable, Union
+
+# Airy 1830 ellipsoid and National Grid projection constants (OSGB36)
+AIRY_A, AIRY_B = 6377563.396, 6356256.909
+F0 = 0.9996012717
+PHI0, LAMBDA0 = np.radians(49), np.radians(-2)
+E0, N0 = 400000, -100000
+
+# WGS84 ellipsoid
+WGS84_A, WGS84_B = 6378137.0, 6356752.314245
+
+# OSGB36 -> WGS84 Helmert parameters (metres, arc seconds, ppm)
+HELMERT_T = np.array([446.448, -125.157, 542.060])
+HELMERT_R = np.radians(np.array([0.1502, 0.2470, 0.8421]) / 3600)
+HELMERT_S = -20.4894e-6
+
+GRID_REF_PATTERN = r"^([A-HJ-Z])([A-HJ-Z])(\d{2,10})$"
+
+
+def _letter_index(letters: pd.Series) -> np.ndarray:
+    # Position in the 25 letter grid alphabet, which omits I
+    index = letters.fillna("A").to_numpy(dtype="U1").view(np.int32) - ord("A")
+    return np.where(index > 7, index - 1, index)
+
+
+def parse_grid_refs(refs: Union[pd.Series, Iterable[str]]) -> tuple[np.ndarray, np.ndarray]:
+    """Convert OS grid references (e.g. "NN166712") to eastings and northings in metres, NaN where invalid."""
+
+    refs = pd.Series(refs, dtype="object")
+    parts = refs.str.replace(r"\s+", "", regex=True).str.upper().str.extract(GRID_REF_PATTERN)
+
+    l1 = _letter_index(parts[0])
+    l2 = _letter_index(parts[1])
+    e100km = ((l1 - 2) % 5) * 5 + l2 % 5
+    n100km = 19 - 5 * (l1 // 5) - l2 // 5
+
+    n_digits = parts[2].str.len().fillna(0).to_numpy(dtype=np.int64)
+    half = n_digits // 2
+    digits = pd.to_numeric(parts[2]).fillna(0).to_numpy(dtype=np.int64)
+    divisor = 10 ** half
+    scale = 10 ** (5 - half)
+
+    easting = (e100km * 100000 + (digits // divisor) * scale).astype(float)
+    northing = (n100km * 100000 + (digits % divisor) * scale).astype(float)
+
+    valid = (
+        parts[2].notna().to_numpy()
+        & (n_digits % 2 == 0)
+        & (e100km >= 0) & (e100km <= 6)
+        & (n100km >= 0) & (n100km <= 12)
+    )
+    easting[~valid] = np.nan
+    northing[~valid] = np.nan
+
+    return easting, northing
+
+
+def _meridional_arc(phi: np.ndarray) -> np.ndarray:
+
+    n = (AIRY_A - AIRY_B) / (AIRY_A + AIRY_B)
+    n2, n3 = n ** 2, n ** 3
+    d, s = phi - PHI0, phi + PHI0
+
+    return AIRY_B * F0 * (
+        (1 + n + 5 / 4 * n2 + 5 / 4 * n3) * d
+        - (3 * n + 3 * n2 + 21 / 8 * n3) * np.sin(d) * np.cos(s)
+        + (15 / 8 * n2 + 15 / 8 * n3) * np.sin(2 * d) * np.cos(2 * s)
+        - 35 / 24 * n3 * np.sin(3 * d) * np.cos(3 * s)
+    )
+
+
+def en_to_osgb36(easting: np.ndarray, northing: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Inverse Transverse Mercator projection from National Grid eastings/northings to OSGB36 lat/lon (radians)."""
+
+    e2 = 1 - AIRY_B ** 2 / AIRY_A ** 2
+    af0 = AIRY_A * F0
+
+    dn = northing - N0
+    phi = np.full_like(dn, PHI0)
+    m = np.zeros_like(dn)
+
+    # Iterate latitude until the meridional arc matches the northing to within 0.01mm
+    for _ in range(20):
+        phi = phi + (dn - m) / af0
+        m = _meridional_arc(phi)
+        if np.all(np.isnan(dn) | (np.abs(dn - m) < 1e-5)):
+            break
+
+    sin_phi, cos_phi, tan_phi = np.sin(phi), np.cos(phi), np.tan(phi)
+    nu = af0 / np.sqrt(1 - e2 * sin_phi ** 2)
+    rho = af0 * (1 - e2) / (1 - e2 * sin_phi ** 2) ** 1.5
+    eta2 = nu / rho - 1
+    t2, t4, t6 = tan_phi ** 2, tan_phi ** 4, tan_phi ** 6
+    sec_phi = 1 / cos_phi
+
+    vii = tan_phi / (2 * rho * nu)
+    viii = tan_phi / (24 * rho * nu ** 3) * (5 + 3 * t2 + eta2 - 9 * t2 * eta2)
+    ix = tan_phi / (720 * rho * nu ** 5) * (61 + 90 * t2 + 45 * t4)
+    x = sec_phi / nu
+    xi = sec_phi / (6 * nu ** 3) * (nu / rho + 2 * t2)
+    xii = sec_phi / (120 * nu ** 5) * (5 + 28 * t2 + 24 * t4)
+    xiia = sec_phi / (5040 * nu ** 7) * (61 + 662 * t2 + 1320 * t4 + 720 * t6)
+
+    de = easting - E0
+    lat = phi - vii * de ** 2 + viii * de ** 4 - ix * de ** 6
+    lon = LAMBDA0 + x * de - xi * de ** 3 + xii * de ** 5 - xiia * de ** 7
+
+    return lat, lon
+
+
+def osgb36_to_wgs84(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Helmert datum shift from OSGB36 to WGS84 lat/lon (radians in, degrees out)."""
+
+    # Geodetic to cartesian on Airy 1830 (ellipsoidal height taken as zero)
+    e2 = 1 - AIRY_B ** 2 / AIRY_A ** 2
+    nu = AIRY_A / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    xyz = np.stack([
+        nu * np.cos(lat) * np.cos(lon),
+        nu * np.cos(lat) * np.sin(lon),
+        nu * (1 - e2) * np.sin(lat),
+    ])
+
+    rx, ry, rz = HELMERT_R
+    rotation = np.array([
+        [1 + HELMERT_S, -rz, ry],
+        [rz, 1 + HELMERT_S, -rx],
+        [-ry, rx, 1 + HELMERT_S],
+    ])
+    x, y, z = HELMERT_T[:, None] + rotation @ xyz
+
+    # Cartesian to geodetic on WGS84
+    e2 = 1 - WGS84_B ** 2 / WGS84_A ** 2
+    p = np.hypot(x, y)
+    phi = np.arctan2(z, p * (1 - e2))
+    for _ in range(10):
+        nu = WGS84_A / np.sqrt(1 - e2 * np.sin(phi) ** 2)
+        phi = np.arctan2(z + e2 * nu * np.sin(phi), p)
+
+    return np.degrees(phi), np.degrees(np.arctan2(y, x))
+
+
+def grid_to_latlon(refs: Union[pd.Series, Iterable[str]]) -> tuple[np.ndarray, np.ndarray]:
+    """Batch convert OS grid references to WGS84 latitude/longitude in degrees, NaN where the reference is invalid."""
+
+    easting, northing = parse_grid_refs(refs)
+    lat, lon = en_to_osgb36(easting, northing)
+
+    return osgb36_to_wgs84(lat, lon)
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+from config import settings
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where only sampled memory is reported
+    resource = None
+
+METRIC_PREFIX = "scottishwalks"
+SAMPLE_INTERVAL = 0.05
+
+
+def current_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, None where it cannot be read."""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes over its lifetime."""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+class RunReport:
+
+    def __init__(self, name: str = "run", sample_interval: Optional[float] = None):
+        """Timings, counters and memory of one pipeline run. Stages are named explicitly (e.g. "etl.clean.hills")
+        and may be entered many times and from several threads, each stage keeps its number of calls, total
+        seconds and the peak resident memory seen while it ran. With a `sample_interval` memory is sampled by a
+        background thread, otherwise only when stages start and end."""
+
+        self.name = name
+        self.started = datetime.now(timezone.utc)
+        self.stages: dict[str, dict] = {}
+        self.counts = Counter()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._open: dict[int, dict] = {}
+        self._peak = current_rss() or 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+        if sample_interval:
+            self._sampler = threading.Thread(target=self._sample_loop, args=(sample_interval,), daemon=True)
+            self._sampler.start()
+
+    def _sample(self) -> None:
+
+        rss = current_rss()
+        if rss is None:
+            return
+
+        with self._lock:
+            self._peak = max(self._peak, rss)
+            for record in self._open.values():
+                record["peak"] = max(record["peak"], rss)
+
+    def _sample_loop(self, interval: float) -> None:
+
+        while not self._stop.wait(interval):
+            self._sample()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+
+        rss = current_rss() or 0
+        record = {"peak": rss}
+        with self._lock:
+            key = id(record)
+            self._open[key] = record
+            self._peak = max(self._peak, rss)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._sample()
+            with self._lock:
+                del self._open[key]
+                stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_rss": 0})
+                stage["calls"] += 1
+                stage["seconds"] += seconds
+                stage["peak_rss"] = max(stage["peak_rss"], record["peak"])
+
+    def count(self, key: str, n: int = 1) -> None:
+
+        with self._lock:
+            self.counts[key] += n
+
+    def close(self) -> None:
+
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def to_dict(self) -> dict:
+
+        self._sample()
+        with self._lock:
+            return {
+                "name": self.name,
+                "started": self.started.isoformat(timespec="seconds"),
+                "seconds": time.perf_counter() - self._start,
+                "peak_rss": max(self._peak, peak_rss() or 0),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counts": dict(self.counts),
+            }
+
+    def to_prometheus(self) -> str:
+        """Report in the Prometheus text exposition format, e.g. for the node exporter textfile collector."""
+
+        report = self.to_dict()
+        run = f'run="{report["name"]}"'
+        metrics = [
+            ("run_seconds", "Wall time of the run", [(run, report["seconds"])]),
+            ("run_peak_rss_bytes", "Peak resident memory of the run", [(run, report["peak_rss"])]),
+            ("stage_seconds", "Total time spent in each stage", [(f'{run},stage="{k}"', v["seconds"]) for k, v in report["stages"].items()]),
+            ("stage_calls", "Times each stage ran", [(f'{run},stage="{k}"', v["calls"]) for k, v in report["stages"].items()]),
+            ("stage_peak_rss_bytes", "Peak resident memory while each stage ran", [(f'{run},stage="{k}"', v["peak_rss"]) for k, v in report["stages"].items()]),
+            ("count", "Run counters", [(f'{run},name="{k}"', v) for k, v in report["counts"].items()]),
+        ]
+
+        lines = []
+        for name, help_text, samples in metrics:
+            lines += [f"# HELP {METRIC_PREFIX}_{name} {help_text}", f"# TYPE {METRIC_PREFIX}_{name} gauge"]
+            lines += [f"{METRIC_PREFIX}_{name}{{{labels}}} {value}" for labels, value in samples]
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+
+        report = self.to_dict()
+        lines = [f"{report['name']}: {report['seconds']:.2f}s, peak memory {report['peak_rss'] / 2 ** 20:.0f} MB"]
+        lines += [
+            f"  {name:<32} {stage['seconds']:>9.3f}s {stage['calls']:>7} calls {stage['peak_rss'] / 2 ** 20:>7.0f} MB"
+            for name, stage in report["stages"].items()
+        ]
+        lines += [f"  {name:<32} {value:>9}" for name, value in report["counts"].items()]
+
+        return "\n".join(lines)
+
+    def save(self, path: Path, metrics_path: Optional[Path] = None) -> None:
+        """Write the report as JSON, and in the Prometheus text format to `metrics_path` when given."""
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), indent=4))
+
+        if metrics_path is not None:
+            metrics_path.parent.mkdir(parents=True, exist_ok=True)
+            # Written then renamed, so a collector never reads a partial file
+            tmp = metrics_path.with_suffix(".tmp")
+            tmp.write_text(self.to_prometheus())
+            os.replace(tmp, metrics_path)
+
+
+# Report of the current run, stages and counts recorded outside of a run (e.g. in tests) go to one never saved
+REPORT = RunReport()
+
+
+def start(name: str, sample_interval: float = SAMPLE_INTERVAL) -> RunReport:
+    """Begin a new run report, sampling memory in the background until it is finished."""
+
+    global REPORT
+    REPORT.close()
+    REPORT = RunReport(name, sample_interval=sample_interval)
+    return REPORT
+
+
+def finish(path: Optional[Path] = None, metrics_path: Optional[Path] = None) -> RunReport:
+    """Stop the current run report, print its summary and save it (see RunReport.save), by default to
+    run_reports_path/{name}-{start time}.json."""
+
+    global REPORT
+    report, REPORT = REPORT, RunReport()
+
+    report.close()
+    print(report.summary())
+    if path is None:
+        path = settings.run_reports_path / f"{report.name}-{report.started:%Y%m%d-%H%M%S}.json"
+    report.save(path, metrics_path=metrics_path)
+
+    return report
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Run report options shared by the run_* scripts."""
+
+    parser.add_argument("--report", type=Path, default=None,
+                        help="Run report JSON file, defaults to data/run_reports/<run>-<start time>.json")
+    parser.add_argument("--metrics", type=Path, default=None,
+                        help="Also write the run report in the Prometheus text format to this file")
+
+
+def stage(name: str):
+    return REPORT.stage(name)
+
+
+def count(key: str, n: int = 1) -> None:
+    REPORT.count(key, n)
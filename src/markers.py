@@ -0,0 +1,90 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+from folium.plugins import FastMarkerCluster
+from folium.template import Template
+from typing import Optional, Sequence
+
+
+def script_json(value) -> str:
+    """JSON safe to embed in a <script>, escaped as jinja's tojson filter does."""
+
+    return (
+        json.dumps(value, separators=(",", ":"))
+        .replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026").replace("'", "\\u0027")
+    )
+
+
+class MarkerFragments:
+
+    def __init__(self, df: pd.DataFrame, popup_cols: Sequence[str] = ("Popup",), route_ids: Optional[Sequence[str]] = None):
+        """Marker rows of every walk serialised once per dataset, so building the marker layer for a filter result
+        is a join of cached strings. Rows are [lat, lon, popup] with the walk's route id or path appended when
+        routes are shown, as the marker callbacks expect."""
+
+        points = [f"{script_json(float(lat))},{script_json(float(lon))}" for lat, lon in zip(df["lat"], df["lon"])]
+        self.heads = {col: [f"[{p},{script_json(popup)}" for p, popup in zip(points, df[col])] for col in popup_cols}
+        self.route_ids = [script_json(i) for i in route_ids] if route_ids is not None else None
+        self._rows = {}
+
+        # Identifies the dataset in cache keys, so layers are never reused across reloads of changed data
+        hashed = pd.util.hash_pandas_object(df[["lat", "lon", *popup_cols]], index=False).to_numpy()
+        self.version = hashlib.blake2b(hashed.tobytes(), digest_size=8).hexdigest()
+
+    def key(self, positions: np.ndarray) -> str:
+        """Compact cache key for the marker layer of the walks at the given positions."""
+        return f"{self.version}-{hashlib.blake2b(np.ascontiguousarray(positions, dtype=np.int64).tobytes(), digest_size=16).hexdigest()}"
+
+    def rows(self, popup_col: str, route_ids: bool = False) -> np.ndarray:
+
+        if (popup_col, route_ids) not in self._rows:
+            heads = self.heads[popup_col]
+            rows = [f"{h},{i}]" for h, i in zip(heads, self.route_ids)] if route_ids else [f"{h}]" for h in heads]
+            self._rows[popup_col, route_ids] = np.array(rows, dtype=object)
+
+        return self._rows[popup_col, route_ids]
+
+    def data(self, positions: np.ndarray, popup_col: str = "Popup", route_ids: bool = False, paths: Optional[Sequence[str]] = None) -> str:
+        """JSON array of the marker rows at the given positions. `paths` are serialised routes for the selected walks,
+        to embed with each marker, otherwise `route_ids` adds the id routes are loaded by."""
+
+        if paths is not None:
+            heads = np.asarray(self.heads[popup_col], dtype=object)[positions]
+            return "[" + ",".join(f"{h},{p}]" for h, p in zip(heads, paths)) + "]"
+
+        return "[" + ",".join(self.rows(popup_col, route_ids)[positions]) + "]"
+
+
+class FragmentMarkerCluster(FastMarkerCluster):
+    """FastMarkerCluster taking its data as a prebuilt JSON array (see MarkerFragments)."""
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                {{ this.callback }}
+
+                var data = {{ this.data_json }};
+                var cluster = L.markerClusterGroup({{ this.options|tojavascript }});
+                {%- if this.icon_create_function is not none %}
+                cluster.options.iconCreateFunction =
+                    {{ this.icon_create_function.strip() }};
+                {%- endif %}
+
+                for (var i = 0; i < data.length; i++) {
+                    var row = data[i];
+                    var marker = callback(row);
+                    marker.addTo(cluster);
+                }
+
+                cluster.addTo({{ this._parent.get_name() }});
+                return cluster;
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, data_json: str, callback: Optional[str] = None, **kwargs):
+
+        super().__init__([], callback=callback, **kwargs)
+        self.data_json = data_json
@@ -0,0 +1,81 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from typing import Iterable, Optional
+
+# Types of the processed dataset columns, other columns (e.g. from older datasets) keep their inferred type. Regions
+# and summits repeat a lot so are dictionary encoded (categoricals in pandas), subregions are nearly unique per walk
+# so are not. Floats compared by the filters stay double precision, route metrics are single precision already.
+SCHEMA = pa.schema([
+    ("Distance", pa.float64()),
+    ("Time", pa.float64()),
+    ("Ascent", pa.int16()),
+    ("Start Grid Ref", pa.string()),
+    ("Region", pa.dictionary(pa.int32(), pa.string())),
+    ("Subregion", pa.string()),
+    ("Name", pa.string()),
+    ("Walk Id", pa.string()),
+    ("Rating", pa.float64()),
+    ("Votes", pa.int16()),
+    ("Grade", pa.int8()),
+    ("Bog", pa.int8()),
+    ("Link", pa.string()),
+    ("Start Point", pa.string()),
+    ("GPX", pa.string()),
+    ("Munro", pa.dictionary(pa.int32(), pa.string())),
+    ("Corbett", pa.dictionary(pa.int32(), pa.string())),
+    ("Donald", pa.dictionary(pa.int32(), pa.string())),
+    ("Fiona", pa.dictionary(pa.int32(), pa.string())),
+    ("Sub 2000", pa.dictionary(pa.int32(), pa.string())),
+    ("Munros Climbed", pa.int8()),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("Popup", pa.string()),
+    ("Compact Popup", pa.string()),
+    ("Route Distance", pa.float32()),
+    ("Start End Gap", pa.float32()),
+    ("Point Density", pa.float32()),
+    ("Elevation Gain", pa.float32()),
+    ("Elevation Loss", pa.float32()),
+    ("Route Min Lat", pa.float32()),
+    ("Route Min Lon", pa.float32()),
+    ("Route Max Lat", pa.float32()),
+    ("Route Max Lon", pa.float32()),
+])
+
+# Row groups carry min/max statistics, so readers filtering on a column can skip groups
+ROW_GROUP_SIZE = 8192
+COMPRESSION = "zstd"
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    """Arrow table of the processed walks with the column types of SCHEMA, raising where a value does not fit
+    (e.g. a grade above 127)."""
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(schema.names):
+        if name in SCHEMA.names:
+            schema = schema.set(i, SCHEMA.field(name))
+
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def write(df: pd.DataFrame, path: Path, csv: bool = False) -> None:
+    """Write the processed walks as typed Parquet, and as CSV next to it when `csv` is set."""
+
+    pq.write_table(to_table(df), path, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION, write_statistics=True)
+
+    if csv:
+        df.to_csv(path.with_suffix(".csv"))
+
+
+def read(path: Path, columns: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """Read the processed walks, only the given columns when listed. Columns missing from the file (e.g. route
+    metrics of datasets processed before them) are left out rather than raising."""
+
+    if columns is not None:
+        available = set(pq.read_schema(path).names)
+        columns = [col for col in dict.fromkeys(columns) if col in available]
+
+    return pq.read_table(path, columns=columns).to_pandas()
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+from src.routes import RouteStore
+from src.spatial import haversine_km
+
+METRIC_COLUMNS = (
+    "Route Distance", "Start End Gap", "Point Density", "Elevation Gain", "Elevation Loss",
+    "Route Min Lat", "Route Min Lon", "Route Max Lat", "Route Max Lon",
+)
+
+# Routes ending within this many km of their start are loops
+LOOP_GAP_KM = 0.5
+
+
+def route_metrics(routes: RouteStore) -> pd.DataFrame:
+    """Metrics of every route in the store at once, indexed by route key: length along the path in km, the gap
+    between start and end in km, points per km, elevation gain and loss in metres (when the store has elevations)
+    and the bounding box. NaN where a route has no points or no elevations."""
+
+    n = len(routes)
+    counts = np.diff(routes.offsets)
+    has_route = counts > 0
+    coords = np.asarray(routes.coords, dtype=float)
+
+    # Route of every point, segments joining the last point of one route to the next are masked out
+    route = np.repeat(np.arange(n), counts)
+    same_route = route[1:] == route[:-1]
+    segment_route = route[1:][same_route]
+    segments = haversine_km(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])[same_route]
+
+    distance = np.where(has_route, np.bincount(segment_route, weights=segments, minlength=n), np.nan)
+
+    gap = np.full(n, np.nan)
+    starts, ends = routes.offsets[:-1][has_route], routes.offsets[1:][has_route] - 1
+    gap[has_route] = haversine_km(coords[starts, 0], coords[starts, 1], coords[ends, 0], coords[ends, 1])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        density = np.where(distance > 0, counts / distance, np.nan)
+
+    gain = loss = np.full(n, np.nan)
+    if routes.ele is not None:
+        ele = np.asarray(routes.ele, dtype=float)
+        climbs = np.nan_to_num(np.diff(ele)[same_route])
+        has_ele = np.bincount(route, weights=np.isfinite(ele), minlength=n) > 0
+        gain = np.where(has_ele, np.bincount(segment_route, weights=np.maximum(climbs, 0), minlength=n), np.nan)
+        loss = np.where(has_ele, np.bincount(segment_route, weights=np.maximum(-climbs, 0), minlength=n), np.nan)
+
+    bboxes = routes.bboxes()
+    columns = [distance, gap, density, gain, loss, *bboxes.T]
+
+    return pd.DataFrame(
+        {col: values.astype(np.float32) for col, values in zip(METRIC_COLUMNS, columns)},
+        index=pd.Index([k.decode() for k in routes.keys.tolist()], name="key"),
+    )
+
+
+def walk_metrics(routes: RouteStore, walk_ids: pd.Series) -> pd.DataFrame:
+    """Route metrics of each walk, in the order given, NaN for walks without a route."""
+
+    metrics = route_metrics(routes)
+    positions = routes.positions(walk_ids)
+    values = np.where((positions >= 0)[:, None], metrics.to_numpy()[positions], np.nan)
+
+    return pd.DataFrame(values.astype(np.float32), columns=list(METRIC_COLUMNS), index=walk_ids.index)
+
+
+def distance_disagreements(df: pd.DataFrame, tolerance: float = 0.25) -> pd.Series:
+    """Walks whose scraped distance differs from the length of their GPX route by more than `tolerance` (a
+    fraction of the scraped distance)."""
+
+    return (df["Route Distance"] - df["Distance"]).abs() > tolerance * df["Distance"]
@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from itertools import repeat
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+from urllib.parse import urlsplit
+from src.simplify import ROUTE_TOLERANCES
+
+ROUTE_FILES = ("coords.npy", "offsets.npy", "keys.npy")
+IMPORTANCE_FILE = "importance.npy"
+ELEVATION_FILE = "ele.npy"
+ROUTE_FILES_MANIFEST = "manifest.json"
+
+# Route table: one row of points per walk, elevations NaN where a GPX had none
+ROUTE_TABLE_SCHEMA = pa.schema([
+    ("Walk Id", pa.string()),
+    ("lat", pa.list_(pa.float32())),
+    ("lon", pa.list_(pa.float32())),
+    ("ele", pa.list_(pa.float32())),
+])
+ROUTE_TABLE_PART = "part-*.parquet"
+# Upserts add a part each, beyond this many they are compacted into one
+MAX_ROUTE_TABLE_PARTS = 8
+
+
+def walk_id(link: str) -> str:
+    """Stable walk id, the walk link path without its extension (area/walk). Keys routes, and names per walk route
+    files."""
+    return urlsplit(link).path.strip("/").rsplit(".", 1)[0]
+
+
+def route_table(walk_ids: Iterable[str], paths: Iterable[Optional[Sequence]],
+                elevations: Optional[Iterable[Optional[Sequence]]] = None) -> pa.Table:
+    """Route table rows of the walks with a path, walks without one are left out."""
+
+    ids, lats, lons, eles = [], [], [], []
+    for key, path, ele in zip(walk_ids, paths, elevations if elevations is not None else repeat(None)):
+
+        # Missing paths may be None or NaN depending on how the frame was read
+        if not isinstance(path, (list, tuple, np.ndarray)) or not len(path):
+            continue
+
+        points = np.asarray(path, dtype=np.float32).reshape(-1, 2)
+        ids.append(key)
+        lats.append(points[:, 0])
+        lons.append(points[:, 1])
+        # Elevations are only kept for routes with one per point
+        has_ele = isinstance(ele, (list, tuple, np.ndarray)) and len(ele) == len(points)
+        eles.append(np.asarray(ele, dtype=np.float32) if has_ele else np.full(len(points), np.nan, np.float32))
+
+    return pa.table([ids, lats, lons, eles], schema=ROUTE_TABLE_SCHEMA)
+
+
+def read_route_table(path: Path) -> Optional[pa.Table]:
+    """Latest route of each walk in the route table at `path`, None when there is none yet."""
+
+    parts = sorted(path.glob(ROUTE_TABLE_PART))
+    if not parts:
+        return None
+
+    table = pa.concat_tables([pq.read_table(part, schema=ROUTE_TABLE_SCHEMA) for part in parts])
+    # Later parts hold the newer route of a walk
+    latest = ~table.column("Walk Id").to_pandas().duplicated(keep="last").to_numpy()
+
+    return table.filter(pa.array(latest))
+
+
+def write_route_table(path: Path, table: pa.Table, replace: bool = False) -> None:
+    """Upsert routes into the route table at `path`. Rows are written as a new part that takes precedence over
+    routes of the same walks in earlier parts, so unchanged routes are not rewritten. `replace` drops the earlier
+    parts instead. An empty table writes nothing."""
+
+    if not table.num_rows:
+        return
+
+    path.mkdir(parents=True, exist_ok=True)
+    parts = sorted(path.glob(ROUTE_TABLE_PART))
+    number = int(parts[-1].stem.split("-")[1]) + 1 if parts else 0
+
+    def write_part(part_table: pa.Table, part_number: int) -> None:
+        # Written then renamed, so readers never see a partial part
+        part = path / f"part-{part_number:05d}.parquet"
+        tmp = part.with_suffix(".tmp")
+        pq.write_table(part_table, tmp, compression="zstd")
+        os.replace(tmp, part)
+
+    write_part(table, number)
+
+    stale = []
+    if replace:
+        stale = parts
+    elif len(parts) + 1 > MAX_ROUTE_TABLE_PARTS:
+        write_part(read_route_table(path), number + 1)
+        stale = parts + [path / f"part-{number:05d}.parquet"]
+
+    for part in stale:
+        part.unlink()
+
+
+class RouteStore:
+
+    def __init__(self, coords: np.ndarray, offsets: np.ndarray, keys: np.ndarray, importance: Optional[np.ndarray] = None,
+                 ele: Optional[np.ndarray] = None):
+        """Ragged array of route paths: a flat (n_points, 2) float32 buffer of [lat, lon] coordinates, with route i
+        stored in coords[offsets[i]:offsets[i + 1]] and identified by keys[i] (UTF-8 bytes). Routes without a path
+        are empty. The optional per point importance (see simplify.route_importance) allows simplified reads, and
+        the optional per point elevation in metres is NaN where a GPX had none."""
+
+        self.coords = coords
+        self.offsets = offsets
+        self.keys = keys
+        self.importance = importance
+        self.ele = ele
+        self._positions = None
+
+    @classmethod
+    def from_paths(cls, keys: Sequence[str], paths: Iterable[Optional[Sequence]],
+                   elevations: Optional[Iterable[Optional[Sequence]]] = None) -> "RouteStore":
+
+        # Missing paths may be None or NaN depending on how the frame was read
+        arrays = [
+            np.asarray(p, dtype=np.float32).reshape(-1, 2) if isinstance(p, (list, tuple, np.ndarray)) else np.empty((0, 2), np.float32)
+            for p in paths
+        ]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        coords = np.concatenate(arrays) if arrays else np.empty((0, 2), np.float32)
+
+        ele = None
+        if elevations is not None:
+            # Elevations are only kept for routes with one per point
+            ele_arrays = [
+                np.asarray(e, dtype=np.float32) if isinstance(e, (list, tuple, np.ndarray)) and len(e) == len(a) else np.full(len(a), np.nan, np.float32)
+                for a, e in zip(arrays, elevations)
+            ]
+            ele = np.concatenate(ele_arrays) if ele_arrays else np.empty(0, np.float32)
+            if not np.isfinite(ele).any():
+                ele = None
+
+        return cls(coords, offsets, np.char.encode(np.asarray(keys, dtype=str), "utf-8"), ele=ele)
+
+    @classmethod
+    def from_table(cls, table: pa.Table) -> "RouteStore":
+        """Store of the routes in a route table (see route_table), keyed by walk id."""
+
+        if not table.num_rows:
+            return cls.from_paths([], [])
+
+        lat, lon, ele = (table.column(col).combine_chunks() for col in ("lat", "lon", "ele"))
+        offsets = np.zeros(table.num_rows + 1, dtype=np.int64)
+        np.cumsum(pc.list_value_length(lat).fill_null(0).to_numpy(), out=offsets[1:])
+        coords = np.column_stack([lat.flatten().to_numpy(), lon.flatten().to_numpy()]).astype(np.float32)
+
+        ele = ele.flatten().to_numpy(zero_copy_only=False).astype(np.float32)
+        if len(ele) != len(coords) or not np.isfinite(ele).any():
+            ele = None
+
+        keys = np.char.encode(np.asarray(table.column("Walk Id").to_pylist(), dtype=str), "utf-8")
+        return cls(coords, offsets, keys, ele=ele)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> "RouteStore":
+        """Load a saved store, memory mapping the arrays by default so processes share one copy via the page cache."""
+
+        mmap_mode = "r" if mmap else None
+        optional = {
+            name: np.load(path / f, mmap_mode=mmap_mode) if (path / f).is_file() else None
+            for name, f in [("importance", IMPORTANCE_FILE), ("ele", ELEVATION_FILE)]
+        }
+
+        return cls(*[np.load(path / f, mmap_mode=mmap_mode) for f in ROUTE_FILES], **optional)
+
+    def save(self, path: Path) -> None:
+
+        path.mkdir(parents=True, exist_ok=True)
+        for f, array in zip(ROUTE_FILES, [self.coords, self.offsets, self.keys]):
+            np.save(path / f, array)
+
+        for f, array in [(IMPORTANCE_FILE, self.importance), (ELEVATION_FILE, self.ele)]:
+            if array is not None:
+                np.save(path / f, array)
+            else:
+                # A stale file from an earlier store would no longer line up with the points
+                (path / f).unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """Zero-copy (n, 2) view of the i-th route."""
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def bboxes(self) -> np.ndarray:
+        """Per route [min_lat, min_lon, max_lat, max_lon], NaN for routes without points."""
+
+        nonempty = np.diff(self.offsets) > 0
+        starts = self.offsets[:-1][nonempty]
+
+        bboxes = np.full((len(self), 4), np.nan)
+        if len(starts):
+            bboxes[nonempty, :2] = np.minimum.reduceat(self.coords, starts, axis=0)
+            bboxes[nonempty, 2:] = np.maximum.reduceat(self.coords, starts, axis=0)
+
+        return bboxes
+
+    def positions(self, keys: Iterable[str]) -> np.ndarray:
+        """Store positions of the given keys, -1 where a key has no route."""
+
+        if self._positions is None:
+            self._positions = {k.decode(): i for i, k in enumerate(self.keys.tolist())}
+
+        return np.array([self._positions.get(k, -1) for k in keys], dtype=np.int64)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+
+        i = self.positions([key])[0]
+        return self[i] if i >= 0 else None
+
+    def simplified(self, i: int, tolerance: float) -> np.ndarray:
+        """The i-th route simplified to within `tolerance` metres."""
+
+        if self.importance is None:
+            raise ValueError("Route store has no importance, rebuild it with run_gpx.migrate_routes()")
+
+        return self[i][self.importance[self.offsets[i]:self.offsets[i + 1]] > tolerance]
+
+    def paths(self, keys: Iterable[str], tolerance: Optional[float] = None) -> list[Optional[np.ndarray]]:
+        """Routes for the given keys, None where a key has no stored route. Full resolution routes are views,
+        simplified ones (when a tolerance in metres is given) are copies."""
+
+        get = self.__getitem__ if tolerance is None else lambda i: self.simplified(i, tolerance)
+        return [get(i) if i >= 0 and self.offsets[i + 1] > self.offsets[i] else None for i in self.positions(keys)]
+
+    def write_files(self, path: Path) -> int:
+        """Write each route to {path}/{walk_id}.json for on demand loading by the dashboard. Files hold the [lat, lon]
+        points ("c") and each point's simplification level ("l"): the number of ROUTE_TOLERANCES it is kept at, so
+        a client draws tolerance ROUTE_TOLERANCES[k] as the points with level > k. A manifest of route hashes is
+        kept with the files, so later writes only rewrite routes that changed and remove the files of routes no
+        longer stored. Returns the number written."""
+
+        manifest_path = path / ROUTE_FILES_MANIFEST
+        if manifest_path.is_file():
+            old = json.loads(manifest_path.read_text())
+        else:
+            # Files written without a manifest are rewritten, and removed unless still stored
+            old = {f.relative_to(path).with_suffix("").as_posix(): None for f in path.rglob("*.json")}
+
+        levels = np.searchsorted(ROUTE_TOLERANCES, self.importance) if self.importance is not None else None
+        hashes = {}
+        written = 0
+
+        for i, key in enumerate(self.keys.tolist()):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            if end == start:
+                continue
+
+            name = walk_id(key.decode())
+            route_levels = levels[start:end] if levels is not None else np.full(end - start, len(ROUTE_TOLERANCES))
+            hashes[name] = hashlib.blake2b(self.coords[start:end].tobytes() + route_levels.tobytes(), digest_size=8).hexdigest()
+            if old.get(name) == hashes[name]:
+                continue
+
+            route = {"c": self.coords[start:end].astype(float).round(5).tolist(), "l": route_levels.tolist()}
+            file = path / f"{name}.json"
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(json.dumps(route, separators=(",", ":")))
+            written += 1
+
+        # Routes of removed walks would otherwise keep being served
+        for name in old.keys() - hashes.keys():
+            (path / f"{name}.json").unlink(missing_ok=True)
+
+        path.mkdir(parents=True, exist_ok=True)
+        manifest_path.write_text(json.dumps(hashes))
+
+        return written
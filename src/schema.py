@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from contextlib import nullcontext
+from typing import Callable, ContextManager, NamedTuple, Optional, Sequence, Union
+
+# Time ranges such as "4 - 5 hours", "45 mins - 1 hour" or "2 hours": the first number of each side of the dash
+# and the rest of that side, which holds the unit
+TIME_PATTERN = r"^[^\d-]*(?P<low>\d+\.?\d*)?(?P<low_unit>[^-]*)(?:-[^\d-]*(?P<high>\d+\.?\d*)?(?P<high_unit>[^-]*))?"
+
+
+class Column(NamedTuple):
+    """Column of a cleaned dataset built by `transform` from its `sources`, passed in order as Series. Sources are
+    columns cleaned earlier in the schema or raw columns, and with `match` every raw column whose name contains it
+    (case insensitive). A transform building several columns at once has a tuple of names and returns a tuple.
+    `format` applies the column formatting (see src.etl.format_column) to the result, `stage` names the run report
+    stage the transform is timed under."""
+
+    name: Union[str, tuple[str, ...]]
+    transform: Callable[..., pd.Series]
+    sources: tuple[str, ...] = ()
+    match: Optional[str] = None
+    format: bool = True
+    stage: str = "casts"
+
+
+def merge_plurals(df: pd.DataFrame, renames: Optional[dict[str, str]] = None) -> dict[str, pd.Series]:
+    """Raw columns by (renamed) name, with plural columns merged into their singular: a walk with one summit is
+    scraped under e.g. "Munro" and with several under "Munros". Plurals without a singular are kept as they are."""
+
+    columns = {(renames or {}).get(col, col): df[col] for col in df.columns}
+    merged = {}
+    for col, values in columns.items():
+        if col + "s" in columns:
+            merged[col] = values.fillna(columns[col + "s"])
+        elif not (col.endswith("s") and col[:-1] in columns):
+            merged[col] = values
+
+    return merged
+
+
+def apply(df: pd.DataFrame, schema: Sequence[Column], renames: Optional[dict[str, str]] = None,
+          format_column: Optional[Callable[[pd.Series], pd.Series]] = None,
+          stage: Optional[Callable[[str], ContextManager]] = None, required: Sequence[str] = ()) -> pd.DataFrame:
+    """Clean a raw frame in one pass over the schema, building each column once and the output frame once. Raw
+    columns the schema does not build are passed through (formatted), unless combined into a `match` column.
+    Columns keep their raw order, followed by those the schema derives (including from several raw columns with
+    `match`) in schema order. Rows missing a value in any `required` column are dropped."""
+
+    stage = stage or (lambda name: nullcontext())
+
+    with stage("plurals"):
+        raw = merge_plurals(df, renames)
+
+    built: dict[str, pd.Series] = {}
+    combined = set()
+    derived = []
+
+    for column in schema:
+
+        names = column.name if isinstance(column.name, tuple) else (column.name,)
+        if column.match is not None:
+            # Raw columns combined into one are replaced by it
+            sources = [col for col in raw if column.match in col.lower()]
+            combined.update(sources)
+        else:
+            sources = list(column.sources)
+        if column.match is not None or any(name not in raw for name in names):
+            derived += names
+
+        with stage(column.stage):
+            values = column.transform(*[built[col] if col in built else raw[col] for col in sources])
+
+        for name, value in zip(names, values if isinstance(column.name, tuple) else (values,)):
+            if not isinstance(value, pd.Series):
+                value = pd.Series(value, index=df.index)
+            if column.format and format_column is not None:
+                with stage("format"):
+                    value = format_column(value)
+            built[name] = value.rename(name)
+
+    with stage("format"):
+        for col in raw:
+            if col not in built and col not in combined:
+                built[col] = format_column(raw[col]) if format_column is not None else raw[col]
+
+    order = [col for col in raw if col in built and col not in derived] + derived
+    out = pd.DataFrame({col: built[col] for col in order}, index=df.index)
+
+    if required:
+        out = out[out[list(required)].notna().all(axis=1)]
+
+    return out.reset_index(drop=True)
+
+
+# Vectorised transforms
+
+def leading_number(values: pd.Series) -> pd.Series:
+    """Number a value starts with, e.g. 6.5 from "6.5km (4 miles)"."""
+    return values.str.extract(r"^([0-9\.]*)", expand=False).astype(float)
+
+
+def first_int(values: pd.Series) -> pd.Series:
+    """First number in a value as an integer, e.g. 850 from "850m"."""
+    return values.str.extract(r"(\d+\.?\d*)", expand=False).astype(int)
+
+
+def time_hours(values: pd.Series) -> pd.Series:
+    """Average hours of a time or time range, where minutes on the upper end of a range apply to both ends
+    ("30 - 45 mins"), and a range missing one end is its other end."""
+
+    parts = values.str.extract(TIME_PATTERN)
+    low, high = parts["low"].astype(float).to_numpy(), parts["high"].astype(float).to_numpy()
+    high_minutes = parts["high_unit"].str.contains("min", na=False).to_numpy()
+    low_minutes = parts["low_unit"].str.contains("min", na=False).to_numpy() | high_minutes
+
+    low = np.where(low_minutes, low / 60, low)
+    high = np.where(high_minutes, high / 60, high)
+    hours = np.where(np.isnan(high), low, np.where(np.isnan(low), high, (low + high) / 2))
+
+    return pd.Series(hours, index=values.index)
+
+
+def join_nonempty(*columns: pd.Series, sep: str = ", ") -> Union[pd.Series, str]:
+    """Element-wise join of the non-empty values of several columns, "" where all are missing or empty."""
+
+    if not columns:
+        return ""
+
+    joined = columns[0].fillna("").astype(str)
+    for col in columns[1:]:
+        col = col.fillna("").astype(str)
+        joined = joined.where(col == "", joined.where(joined == "", joined + sep) + col)
+
+    return joined
+
+
+def html_links(values: pd.Series, text: str = "click here") -> pd.Series:
+    """Anchor tags as src.etl.html_link builds them, for a whole column."""
+    return '<a href="' + values.astype(str) + f'" target="blank">{text}</a>'
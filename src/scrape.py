@@ -2,12 +2,20 @@ import json
 import pandas as pd
 import time
 import re
-import os
-from typing import Iterable
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+from urllib.parse import urljoin, urlsplit, urlunsplit
+import requests
+from lxml import html
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.common.exceptions import NoSuchElementException
+from src import instrument
+from src.fetch import RateLimiter, describe_error, make_session
 from config import settings
 
 BASE_URL = "https://www.walkhighlands.co.uk"
@@ -15,13 +23,16 @@ AREA_LINKS = {}
 WALK_LINKS = set()
 AREA_LINKS_FILE = settings.root_path / "arealinks.json"
 DELAY = 0.5
+# Crawls a failing walk is retried in before it is given up on, until the next crawl
+MAX_WALK_ATTEMPTS = 3
 
 
-def get_walk_data(driver, walk_link: str) -> pd.DataFrame:
+def get_walk_data(driver, walk_link: str, limiter: Optional[RateLimiter] = None) -> pd.DataFrame:
 
     location = get_area_from_link(walk_link)
 
     driver.get(walk_link)
+    STATS.add("walk_page_loads")
 
     try:
         column = driver.find_element(by=By.ID, value="col")
@@ -70,30 +81,270 @@ def get_walk_data(driver, walk_link: str) -> pd.DataFrame:
     data["Bog"] = bog
     data["Link"] = walk_link
     data["StartPoint"] = start_point_url
-    data["GPX"] = get_route_link(driver)
+    data["GPX"] = walk_gpx_link(lambda: get_route_link(driver, walk_link, limiter=limiter))
 
     return data
 
 
-def get_route_link(driver) -> str:
+class CrawlStats:
 
-    hrefs = driver.find_element(by=By.CSS_SELECTOR, value="ul.box").find_elements(by=By.TAG_NAME, value="a")
+    def __init__(self):
+        """Thread safe counts of walks, page loads and how GPX links were resolved, for one crawl. Counts are also
+        added to the run report as scrape.{key}."""
 
-    link = None
-    for h in hrefs:
+        self._lock = threading.Lock()
+        self.counts = Counter()
 
-        link = h.get_attribute("href")
+    def add(self, key: str, n: int = 1) -> None:
 
-        if "download.php" in link or link.endswith("GPX"):
+        with self._lock:
+            self.counts[key] += n
+        instrument.count(f"scrape.{key}", n)
+
+    def reset(self) -> None:
+
+        with self._lock:
+            self.counts.clear()
+
+    def report(self) -> str:
+
+        c = self.counts
+        walks = max(c["walks"], 1)
+        return (
+            f"Scraped {c['walks']} walks: {c['walk_page_loads'] / walks:.2f} page loads and {c['head_requests'] / walks:.2f} "
+            f"HEAD requests per walk, {c['listing_page_loads']} listing pages. GPX links from markup: {c['gpx_from_markup']}, "
+            f"from link pattern: {c['gpx_from_pattern']}, from download page: {c['gpx_from_download_page']}, "
+            f"not found: {c['gpx_not_found']}"
+        )
+
+
+STATS = CrawlStats()
+
+
+class IncompletePage(Exception):
+    """Walk page markup is missing content the browser would render, scrape it with the WebDriver instead."""
+
+
+class GpxLinkNotFound(Exception):
+    """No GPX download link could be resolved for a walk."""
+
+
+def class_xpath(name: str) -> str:
+    """XPath for descendants with the given class, equivalent to By.CLASS_NAME."""
+    return f".//*[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+
+
+def element_text(element) -> str:
+    """Rendered text of an element, as WebElement.text: line breaks kept, other whitespace collapsed."""
+
+    lines = element.text_content().split("\n")
+    return "\n".join(" ".join(line.split()) for line in lines if line.split())
+
+
+def inner_html(element) -> str:
+    return (element.text or "") + "".join(html.tostring(child, encoding="unicode") for child in element)
+
+
+def first(elements: list, description: str):
+
+    if not elements:
+        raise IncompletePage(f"{description} not found")
+    return elements[0]
+
+
+def parse_walk_page(page: str, walk_link: str) -> Optional[dict]:
+    """Walk data from walk page markup, the same fields as get_walk_data except the GPX link, which is on a
+    separate page (see route_page_link). None if the page has no walk description, as with get_walk_data."""
+
+    tree = html.fromstring(page)
+    tree.make_links_absolute(walk_link)
+    # Browsers render <br> as a line break
+    for br in tree.iter("br"):
+        br.tail = "\n" + (br.tail or "")
+
+    column = tree.xpath("//*[@id='col']")
+    if not column:
+        return None
+
+    data = {}
+    for k, v in zip(column[0].xpath(".//dt"), column[0].xpath(".//dd")):
+        k, v = element_text(k), element_text(v)
+        data[k] = ", ".join([data[k], v]) if k in data else v
+
+    wrapper = first(tree.xpath("//*[@id='wrapper']"), "Wrapper")
+    votes = first(wrapper.xpath(class_xpath("votes")), "Votes").xpath(".//span")
+    first(votes, "Vote values")
+
+    start_point_url = None
+    for link in wrapper.xpath(".//a/@href"):
+        start_point_url = link
+        if "www.google.com/maps" in link:
             break
 
+    data = data | get_area_from_link(walk_link)
+
+    data["Name"] = element_text(first(wrapper.xpath(".//h1"), "Name"))
+    data["Rating"] = inner_html(votes[0])
+    data["Votes"] = inner_html(votes[-1])
+    data["Grade"] = len(first(wrapper.xpath(class_xpath("grade")), "Grade").xpath(".//img"))
+    data["Bog"] = len(first(wrapper.xpath(class_xpath("bog")), "Bog").xpath(".//img"))
+    data["Link"] = walk_link
+    data["StartPoint"] = start_point_url
+
+    return data
+
+
+def gpx_link_from_markup(page: str, walk_link: str) -> Optional[str]:
+    """Direct link to a .gpx file in walk page markup, None if the page only links the download page."""
+
+    for link in html.fromstring(page).xpath("//a/@href"):
+        if urlsplit(link).path.lower().endswith(".gpx"):
+            return urljoin(walk_link, link)
+
+    return None
+
+
+def gpx_link_candidate(walk_link: str) -> Optional[str]:
+    """GPX file the download page links to for every walk seen so far: {area}/{walk}.shtml -> {area}/profiles/{walk}.gpx"""
+
+    parts = urlsplit(walk_link)
+    if not parts.path.endswith(".shtml"):
+        return None
+
+    area, walk = parts.path.rsplit("/", 1)
+    return urlunsplit((parts.scheme, parts.netloc, f"{area}/profiles/{walk[:-len('.shtml')]}.gpx", "", ""))
+
+
+def gpx_link_exists(url: str, session: Optional[requests.Session] = None, limiter: Optional[RateLimiter] = None) -> bool:
+    """Cheap HEAD check that a GPX link resolves (following redirects) to a file."""
+
+    if limiter is not None:
+        limiter.wait(url)
+    STATS.add("head_requests")
+
+    try:
+        response = (session or requests).head(url, allow_redirects=True, timeout=30)
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200 and urlsplit(response.url).path.lower().endswith(".gpx")
+
+
+def resolve_gpx_link(page: str, walk_link: str, navigate: Callable[[str], str], session: Optional[requests.Session] = None,
+                     limiter: Optional[RateLimiter] = None) -> str:
+    """GPX download link for a walk, cheapest first: a direct link in the walk page markup, the link derived from
+    the walk link if a HEAD request finds it, and only then `navigate` to the download page and read its button."""
+
+    link = gpx_link_from_markup(page, walk_link)
     if link is not None:
-        driver.get(link)
+        STATS.add("gpx_from_markup")
+        return link
+
+    link = gpx_link_candidate(walk_link)
+    if link is not None and gpx_link_exists(link, session=session, limiter=limiter):
+        STATS.add("gpx_from_pattern")
+        return link
+
+    route_link = route_page_link(page, walk_link)
+    if route_link is None:
+        raise GpxLinkNotFound(f"GPX link not found: {walk_link}")
+
+    STATS.add("gpx_from_download_page")
+    return navigate(route_link)
+
+
+def walk_gpx_link(resolve: Callable[[], str]) -> Optional[str]:
+    """Resolved GPX link, or None after reporting the failure, so the rest of the walk data is still kept."""
+
+    try:
+        return resolve()
+    except GpxLinkNotFound as e:
+        print(e)
+        STATS.add("gpx_not_found")
+        return None
+
+
+def route_page_link(page: str, walk_link: str) -> Optional[str]:
+    """Link to the GPX download page from walk page markup, None if the walk has none."""
+
+    tree = html.fromstring(page)
+    tree.make_links_absolute(walk_link)
+
+    for link in tree.xpath("//ul[contains(concat(' ', normalize-space(@class), ' '), ' box ')]//a/@href"):
+        if "download.php" in link or link.endswith("GPX"):
+            return link
+
+    return None
+
+
+def parse_route_page(page: str, route_link: str) -> str:
+    """GPX file link from the download page markup."""
+
+    tree = html.fromstring(page)
+    tree.make_links_absolute(route_link)
+
+    walk_info = first(tree.xpath("//*[@id='walk_info']"), "Walk info")
+    return first(walk_info.xpath(class_xpath("button2") + "/@href"), "GPX download button")
+
+
+def fetch_page(session: requests.Session, limiter: RateLimiter, url: str) -> str:
+
+    limiter.wait(url)
+    response = session.get(url, timeout=30)
+    response.raise_for_status()
+
+    return response.text
+
+
+def get_walk_data_http(session: requests.Session, limiter: RateLimiter, walk_link: str) -> Optional[dict]:
+    """get_walk_data over a plain HTTP session, raises IncompletePage if the markup lacks what the browser renders."""
+
+    def navigate(route_link: str) -> str:
+        STATS.add("walk_page_loads")
+        return parse_route_page(fetch_page(session, limiter, route_link), route_link)
+
+    page = fetch_page(session, limiter, walk_link)
+    STATS.add("walk_page_loads")
+    data = parse_walk_page(page, walk_link)
+
+    if data is not None:
+        data["GPX"] = walk_gpx_link(lambda: resolve_gpx_link(page, walk_link, navigate, session=session, limiter=limiter))
+        print(f"URL: {data['StartPoint']}")
+
+    return data
+
+
+def scrape_walk(drivers: "DriverPool", walk_link: str, session: Optional[requests.Session] = None, limiter: Optional[RateLimiter] = None) -> Optional[dict]:
+    """Walk data over HTTP when a session is given, falling back to the WebDriver for pages that need JavaScript."""
+
+    limiter = limiter or RateLimiter(DELAY)
+    if session is not None:
+        try:
+            return get_walk_data_http(session, limiter, walk_link)
+        except IncompletePage as e:
+            print(f"{e}, scraping with the browser: {walk_link}")
+
+    limiter.wait(walk_link)
+    return get_walk_data(drivers.get(), walk_link, limiter=limiter)
+
+
+def get_route_link(driver, walk_link: str, limiter: Optional[RateLimiter] = None) -> str:
+    """GPX link for the walk page open in the driver, only navigating to the download page when it can not be
+    resolved from the markup or link (see resolve_gpx_link)."""
+
+    def navigate(route_link: str) -> str:
+
+        driver.get(route_link)
+        STATS.add("walk_page_loads")
         time.sleep(DELAY)
-        button = driver.find_element(by=By.ID, value="walk_info").find_element(by=By.CLASS_NAME, value="button2")
+        try:
+            button = driver.find_element(by=By.ID, value="walk_info").find_element(by=By.CLASS_NAME, value="button2")
+        except NoSuchElementException:
+            raise GpxLinkNotFound(f"GPX download button not found: {route_link}")
+
         return button.get_attribute("href")
-    else:
-        Exception("GPX link not found")
+
+    return resolve_gpx_link(driver.page_source, walk_link, navigate, limiter=limiter)
 
 
 def get_unique_links(element) -> set[str]:
@@ -140,63 +391,268 @@ def recursive(driver, hrefs: Iterable[str]) -> None:
         AREA_LINKS.update(area)
 
 
-def search_areas(driver):
+def make_driver():
+
+    try:
+        return webdriver.Firefox()
+    except Exception as e:
+        print("Firefox webdriver failed, trying Chrome ...")
+        return webdriver.Chrome()
+
+
+class DriverPool:
+
+    def __init__(self):
+        """One WebDriver per worker thread, only started when a worker first needs a browser."""
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._drivers = []
+
+    def get(self):
+
+        driver = getattr(self._local, "driver", None)
+        if driver is None:
+            driver = self._local.driver = make_driver()
+            with self._lock:
+                self._drivers.append(driver)
+
+        return driver
+
+    def quit(self) -> None:
 
-    for area_link, sub_link in AREA_LINKS.items():
+        for driver in self._drivers:
+            driver.quit()
+        self._drivers.clear()
 
-        name = area_link.rstrip("/").split("/")[-1]
-        print(f"Searching walks within area: {area_link}")
 
-        walks = []
-        for sub in sub_link:
-            driver.get(sub)
-            time.sleep(DELAY)
-            walk_table = driver.find_element(by=By.CLASS_NAME, value="table1")
-            walk_links = link_filter(get_unique_links(walk_table))
+def area_name(area_link: str) -> str:
+    return area_link.rstrip("/").split("/")[-1]
 
-            for walk in walk_links:
 
-                walk_data = get_walk_data(driver, walk)
+def absolute_links(element, url: str) -> list[str]:
+    """Unique links within an element, filtered as link_filter and resolved against the page url."""
 
-                if walk_data is not None:
-                    walks.append(walk_data)
+    # Filter before resolving, lxml drops the bare "#" links that link_filter skips
+    return [urljoin(url, link) for link in link_filter(dict.fromkeys(element.xpath(".//a/@href")))]
 
-        with open(f"{settings.raw_data_path}{os.sep}{name}walks.json", 'w') as fout:
-            json.dump(walks, fout)
 
+def parse_walk_links(page: str, sub_link: str) -> list[str]:
+    """Walk links from the walk table of an area listing page."""
 
-def main():
+    return absolute_links(first(html.fromstring(page).xpath(class_xpath("table1")), "Walk table"), sub_link)
 
+
+def discover_areas(session: requests.Session, limiter: RateLimiter) -> dict:
+    """Sub area links of every area in the site navigation, as recursive, over HTTP."""
+
+    nav_bar = first(html.fromstring(fetch_page(session, limiter, BASE_URL)).xpath("//*[@id='nav']"), "Navigation")
+    areas = {}
+    for h in absolute_links(first(nav_bar.xpath(".//li"), "Navigation list"), BASE_URL):
+        area_table = html.fromstring(fetch_page(session, limiter, h)).xpath("//*[@id='arealist']")
+        areas[h] = absolute_links(area_table[0], h) if area_table else ""
+
+    return areas
+
+
+def list_walks(drivers: DriverPool, sub_link: str, limiter: RateLimiter, session: Optional[requests.Session] = None) -> list[str]:
+
+    if session is not None:
+        try:
+            STATS.add("listing_page_loads")
+            with instrument.stage("scrape.listing"):
+                return parse_walk_links(fetch_page(session, limiter, sub_link), sub_link)
+        except IncompletePage as e:
+            print(f"{e}, listing with the browser: {sub_link}")
+
+    with instrument.stage("scrape.listing_browser"):
+        driver = drivers.get()
+        limiter.wait(sub_link)
+        driver.get(sub_link)
+        STATS.add("listing_page_loads")
+        walk_table = driver.find_element(by=By.CLASS_NAME, value="table1")
+
+        return link_filter(get_unique_links(walk_table))
+
+
+def checkpoint_file(name: str) -> Path:
+    return settings.scrape_checkpoint_path / f"{name}walks.jsonl"
+
+
+def load_area_checkpoint(name: str) -> dict[str, dict]:
+    """Walks scraped by an interrupted crawl, by link. Failed walks are recorded with an error and the number of
+    attempts, and retried up to MAX_WALK_ATTEMPTS times."""
+
+    walks = {}
+    if checkpoint_file(name).is_file():
+        with open(checkpoint_file(name)) as f:
+            for line in f:
+                try:
+                    walk = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partially written final line from an interrupted run
+                    continue
+                walks[walk["Link"]] = walk
+
+    return walks
+
+
+def scrape_walk_result(drivers: DriverPool, walk_link: str, limiter: RateLimiter, session: Optional[requests.Session] = None) -> dict:
+    """Walk data, or the reason it could not be scraped. Pages without a walk description are skipped rather than
+    failed, retrying them would find the same page."""
+
+    STATS.add("walks")
     try:
-        driver = webdriver.Firefox()
+        with instrument.stage("scrape.walk"):
+            walk_data = scrape_walk(drivers, walk_link, session=session, limiter=limiter)
     except Exception as e:
-        print("Firefox webdriver failed, trying Chrome ...")
-        driver = webdriver.Chrome()
+        return {"Link": walk_link, "error": describe_error(e)}
+
+    return walk_data if walk_data is not None else {"Link": walk_link, "skipped": "No walk description"}
+
+
+def retry_walk(walk: Optional[dict]) -> bool:
+    """Whether a walk still needs scraping: not yet scraped, or failed fewer than MAX_WALK_ATTEMPTS times."""
+    return walk is None or ("error" in walk and walk.get("attempts", 1) < MAX_WALK_ATTEMPTS)
+
+
+def write_area(name: str, area_walks: dict[str, dict], complete: bool) -> None:
+    """Rewrite an area's raw file with the walks scraped. Walks that failed keep what an earlier crawl scraped, as
+    does every walk in the file when a listing of the area failed (not `complete`)."""
+
+    file = settings.raw_data_path / f"{name}walks.json"
+    previous = {}
+    if file.is_file():
+        with open(file) as fin:
+            previous = {w["Link"]: w for w in json.load(fin)}
+
+    walks = dict(previous) if not complete else {}
+    for link, walk in area_walks.items():
+        if "error" in walk:
+            if link in previous:
+                walks[link] = previous[link]
+        elif "skipped" in walk:
+            walks.pop(link, None)
+        else:
+            walks[link] = walk
 
-    driver.get(BASE_URL)
+    with open(file, "w") as fout:
+        json.dump(list(walks.values()), fout)
 
-    nav_bar = WebDriverWait(driver, 10).until(lambda d: d.find_element(by=By.ID, value="nav"))
-    lists = nav_bar.find_element(by=By.TAG_NAME, value="li")
+
+def search_areas(area_links: dict[str, list[str]], workers: int = settings.request_workers, session: Optional[requests.Session] = None):
+    """Crawl the walks of every area with a pool of workers sharing one rate limit. Each walk is appended to its
+    area's checkpoint as soon as it is scraped, and a restarted crawl only scrapes walks it has not collected or
+    that failed fewer than MAX_WALK_ATTEMPTS times. An area's checkpoint is removed once its crawl is complete,
+    so the next crawl scrapes it again."""
+
+    settings.scrape_checkpoint_path.mkdir(parents=True, exist_ok=True)
+
+    STATS.reset()
+    limiter = RateLimiter(DELAY)
+    drivers = DriverPool()
+    names = {area_link: area_name(area_link) for area_link in area_links}
+    walks = {name: load_area_checkpoint(name) for name in names.values()}
+    checkpoints = {name: open(checkpoint_file(name), "a") for name in names.values()}
+    failed_listings = set()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            # Futures for listing pages map to (area, None), those for walks to (area, walk link)
+            pending = {}
+            for area_link, sub_links in area_links.items():
+                print(f"Searching walks within area: {area_link}")
+                for sub in sub_links:
+                    pending[executor.submit(list_walks, drivers, sub, limiter, session)] = (names[area_link], None)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, walk_link = pending.pop(future)
+
+                    if walk_link is None:
+                        try:
+                            walk_links = future.result()
+                        except Exception as e:
+                            print(f"Listing failed: {name} ({describe_error(e)})")
+                            failed_listings.add(name)
+                            continue
+
+                        for walk in walk_links:
+                            if retry_walk(walks[name].get(walk)):
+                                pending[executor.submit(scrape_walk_result, drivers, walk, limiter, session)] = (name, walk)
+                        continue
+
+                    result = future.result()
+                    if "error" in result:
+                        result["attempts"] = walks[name].get(walk_link, {}).get("attempts", 0) + 1
+                        print(f"Failed: {walk_link} ({result['error']})")
+
+                    walks[name][walk_link] = result
+                    checkpoints[name].write(json.dumps(result) + "\n")
+                    checkpoints[name].flush()
+    finally:
+        for f in checkpoints.values():
+            f.close()
+        drivers.quit()
+
+    with instrument.stage("scrape.write"):
+        for name, area_walks in walks.items():
+            write_area(name, area_walks, complete=name not in failed_listings)
+
+    print(STATS.report())
+
+    failures = sum("error" in w for area_walks in walks.values() for w in area_walks.values()) + len(failed_listings)
+    instrument.count("scrape.failures", failures)
+    if failures:
+        print(f"{failures} walks or listings failed, run again to retry them (walks up to {MAX_WALK_ATTEMPTS} times), see "
+              f"{settings.scrape_checkpoint_path}")
+
+    for name, area_walks in walks.items():
+        # Crawl of the area complete, the next one should scrape everything again
+        if name not in failed_listings and not any(retry_walk(w) for w in area_walks.values()):
+            checkpoint_file(name).unlink(missing_ok=True)
+
+
+def main(backend: str = "http", workers: int = settings.request_workers):
+    """Crawl every area. The "http" backend downloads listings and walk pages with a pooled session and parses the
+    markup, only starting browsers for pages that need JavaScript. Pages are cached (see src.cache), so re-runs only
+    revalidate them. "selenium" scrapes everything in the browser."""
+
+    session = make_session(pool_size=workers) if backend == "http" else None
 
     area_links_path = settings.root_path / AREA_LINKS_FILE
     if area_links_path.is_file():
         with open(area_links_path, 'r') as fin:
             AREA_LINKS.update(json.load(fin))
+    elif session is not None:
+        with instrument.stage("scrape.discover"):
+            AREA_LINKS.update(discover_areas(session, RateLimiter(DELAY)))
+        with open(area_links_path, 'w') as fout:
+            json.dump(AREA_LINKS, fout)
     else:
+        driver = make_driver()
+        driver.get(BASE_URL)
+
+        nav_bar = WebDriverWait(driver, 10).until(lambda d: d.find_element(by=By.ID, value="nav"))
+        lists = nav_bar.find_element(by=By.TAG_NAME, value="li")
+
         recursive(driver, link_filter(get_unique_links(lists)))
         with open(area_links_path, 'w') as fout:
             json.dump(AREA_LINKS, fout)
 
-    search_areas(driver)
+        driver.quit()
 
-    driver.quit()
+    with instrument.stage("scrape.crawl"):
+        search_areas(AREA_LINKS, workers=workers, session=session)
 
 
 def tester(link):
 
     driver = webdriver.Chrome()
     driver.get(link)
-    get_route_link(driver)
+    get_route_link(driver, link)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+import numpy as np
+from typing import Optional
+
+# Simplification levels in metres, a route is drawn at the coarsest level finer than a screen pixel
+ROUTE_TOLERANCES = (5., 15., 50., 150.)
+
+METRES_PER_DEGREE = 111320.
+# Web mercator ground resolution at the equator for zoom level 0
+METRES_PER_PIXEL_Z0 = 156543.03
+
+
+def project(coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Equirectangular projection of [lat, lon] degrees to metres, scaled by each route's mean latitude."""
+
+    lengths = np.diff(offsets)
+    starts, lengths = offsets[:-1][lengths > 0], lengths[lengths > 0]
+
+    lat = coords[:, 0].astype(float)
+    mean_lat = np.add.reduceat(lat, starts) / lengths if len(lat) else lat
+    scale = np.cos(np.radians(np.repeat(mean_lat, lengths)))
+
+    return np.column_stack([coords[:, 1] * scale, lat]) * METRES_PER_DEGREE
+
+
+def route_importance(coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Douglas-Peucker over every route at once. Returns, for each point, the largest tolerance (metres) at which it
+    is kept, so simplifying at tolerance t is the mask importance > t. Route end points are always kept.
+
+    Each pass splits every open segment of every route at its furthest point, so the number of passes is the
+    recursion depth rather than the number of points. A point's importance is capped by that of the segment it
+    splits, which keeps the levels nested and equal to running Douglas-Peucker at each tolerance."""
+
+    n = len(coords)
+    importance = np.zeros(n)
+    if not n:
+        return importance.astype(np.float32)
+
+    xy = project(coords, offsets)
+    lengths = np.diff(offsets)
+    ends = np.concatenate([offsets[:-1][lengths > 0], offsets[1:][lengths > 0] - 1])
+
+    kept = np.zeros(n, dtype=bool)
+    kept[ends] = True
+    importance[ends] = np.inf
+    idx = np.arange(n)
+
+    while not kept.all():
+
+        kept_idx = np.flatnonzero(kept)
+        interior = idx[~kept]
+
+        # Segment each interior point lies on, route end points are kept so segments never span two routes
+        start = kept_idx[np.searchsorted(kept_idx, interior) - 1]
+        end = kept_idx[np.searchsorted(kept_idx, interior)]
+
+        a, b, p = xy[start], xy[end], xy[interior]
+        ab = b - a
+        ab2 = (ab ** 2).sum(axis=1)
+        t = np.divide(((p - a) * ab).sum(axis=1), ab2, out=np.zeros(len(p)), where=ab2 > 0).clip(0, 1)
+        dist = np.hypot(*(p - a - t[:, None] * ab).T)
+
+        # Furthest point of each segment, interior points of a segment are contiguous
+        group_start = np.flatnonzero(np.r_[True, start[1:] != start[:-1]])
+        group_max = np.maximum.reduceat(dist, group_start)
+        group = np.repeat(np.arange(len(group_start)), np.diff(np.r_[group_start, len(dist)]))
+        candidates = np.flatnonzero(dist == group_max[group])
+        selected = candidates[np.unique(group[candidates], return_index=True)[1]]
+
+        limit = np.minimum(importance[start[selected]], importance[end[selected]])
+        importance[interior[selected]] = np.minimum(dist[selected], limit)
+        kept[interior[selected]] = True
+
+    return importance.astype(np.float32)
+
+
+def tolerance_for_zoom(zoom: float, lat: float = 57.) -> Optional[float]:
+    """Coarsest simplification tolerance smaller than one screen pixel at the given zoom, None for full detail."""
+
+    metres_per_pixel = METRES_PER_PIXEL_Z0 * np.cos(np.radians(lat)) / 2 ** zoom
+    fits = [t for t in ROUTE_TOLERANCES if t <= metres_per_pixel]
+
+    return max(fits) if fits else None
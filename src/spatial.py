@@ -0,0 +1,161 @@
+import re
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Optional
+from src.grid import grid_to_latlon
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+LATLON_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def parse_location(text: str) -> Optional[tuple[float, float]]:
+    """Parse an OS grid reference or "lat, lon" into (lat, lon) with a positive longitude, None if neither."""
+
+    match = LATLON_PATTERN.match(text)
+    if match:
+        lat, lon = float(match.group(1)), float(match.group(2))
+    else:
+        lat, lon = (x[0] for x in grid_to_latlon([text]))
+
+    if np.isnan(lat) or np.isnan(lon):
+        return None
+
+    return lat, lon % 360
+
+
+class SpatialIndex:
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, route_bboxes: Optional[np.ndarray] = None, cell_size: float = 0.1):
+        """Grid bucket index over walk start points, queried by walk position (row of the processed dataset).
+        Optional route bounding boxes, (n, 4) arrays of [min_lat, min_lon, max_lat, max_lon] with NaN for walks
+        without a route, are indexed by minimum latitude for viewport intersection queries."""
+
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.cell_size = cell_size
+
+        # Points sorted by grid cell, cell_starts gives the slice of each occupied cell
+        self.origin = (np.nanmin(self.lat), np.nanmin(self.lon)) if len(self.lat) else (0., 0.)
+        rows, cols = self._cell(self.lat, self.lon)
+        self.n_rows = int(np.max(rows)) + 1 if len(rows) else 1
+        self.n_cols = int(np.max(cols)) + 1 if len(cols) else 1
+        keys = rows * self.n_cols + cols
+
+        valid = np.flatnonzero(~np.isnan(self.lat) & ~np.isnan(self.lon))
+        self.order = valid[np.argsort(keys[valid], kind="stable")]
+        self.cell_keys, self.cell_starts = np.unique(keys[self.order], return_index=True)
+        self.cell_ends = np.r_[self.cell_starts[1:], len(self.order)]
+
+        self.route_bboxes = None
+        if route_bboxes is not None:
+            self.route_bboxes = np.asarray(route_bboxes, dtype=float)
+            has_route = np.flatnonzero(~np.isnan(self.route_bboxes[:, 0]))
+            self.route_order = has_route[np.argsort(self.route_bboxes[has_route, 0], kind="stable")]
+            self.route_min_lats = self.route_bboxes[self.route_order, 0]
+            self.route_max_height = np.max(np.diff(self.route_bboxes[has_route][:, [0, 2]], axis=1), initial=0)
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, route_bboxes: Optional[np.ndarray] = None) -> "SpatialIndex":
+        return cls(df["lat"].to_numpy(), df["lon"].to_numpy(), route_bboxes=route_bboxes)
+
+    @classmethod
+    def load(cls, path: Path) -> "SpatialIndex":
+
+        arrays = np.load(path)
+        return cls(arrays["lat"], arrays["lon"], route_bboxes=arrays["route_bboxes"] if "route_bboxes" in arrays else None)
+
+    def save(self, path: Path) -> None:
+
+        arrays = {"lat": self.lat, "lon": self.lon}
+        if self.route_bboxes is not None:
+            arrays["route_bboxes"] = self.route_bboxes
+
+        with open(path, "wb") as fout:
+            np.savez(fout, **arrays)
+
+    def _cell(self, lat, lon) -> tuple[np.ndarray, np.ndarray]:
+
+        rows = np.floor((np.asarray(lat) - self.origin[0]) / self.cell_size)
+        cols = np.floor((np.asarray(lon) - self.origin[1]) / self.cell_size)
+        return np.nan_to_num(rows).astype(np.int64), np.nan_to_num(cols).astype(np.int64)
+
+    def _candidates(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> np.ndarray:
+        """Positions of points in grid cells overlapping the box."""
+
+        (r0, r1), (c0, c1) = self._cell([min_lat, max_lat], [min_lon, max_lon])
+        r0, r1 = max(r0, 0), min(r1, self.n_rows - 1)
+        c0, c1 = max(c0, 0), min(c1, self.n_cols - 1)
+        if c1 < c0 or r1 < r0:
+            return np.empty(0, dtype=np.int64)
+
+        keys = (np.arange(r0, r1 + 1)[:, None] * self.n_cols + np.arange(c0, c1 + 1)).ravel()
+        found = np.searchsorted(self.cell_keys, keys)
+        found = found[(found < len(self.cell_keys)) & (self.cell_keys[np.minimum(found, len(self.cell_keys) - 1)] == keys)]
+
+        if not len(found):
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate([self.order[s:e] for s, e in zip(self.cell_starts[found], self.cell_ends[found])])
+
+    def bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> np.ndarray:
+        """Walks starting inside the box."""
+
+        pos = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        inside = (self.lat[pos] >= min_lat) & (self.lat[pos] <= max_lat) & (self.lon[pos] >= min_lon) & (self.lon[pos] <= max_lon)
+
+        return np.sort(pos[inside])
+
+    def radius(self, lat: float, lon: float, km: float) -> tuple[np.ndarray, np.ndarray]:
+        """Walks starting within `km` of (lat, lon), and their distances, nearest first."""
+
+        dlat = km / KM_PER_DEGREE
+        dlon = km / (KM_PER_DEGREE * max(np.cos(np.radians(min(abs(lat) + dlat, 89.))), 1e-6))
+
+        pos = self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        dist = haversine_km(lat, lon, self.lat[pos], self.lon[pos])
+        within = dist <= km
+        order = np.argsort(dist[within], kind="stable")
+
+        return pos[within][order], dist[within][order]
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """The k walks starting nearest to (lat, lon), and their distances."""
+
+        k = min(k, len(self.order))
+        km = self.cell_size * KM_PER_DEGREE
+        while True:
+            pos, dist = self.radius(lat, lon, km)
+            # Searched everything, or the k-th nearest lies inside the searched circle
+            if len(pos) >= k or len(pos) == len(self.order):
+                return pos[:k], dist[:k]
+            km *= 2
+
+    def routes_in_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> np.ndarray:
+        """Walks whose route bounding box intersects the box."""
+
+        if self.route_bboxes is None:
+            raise ValueError("Spatial index was built without route bounding boxes")
+
+        # Boxes are sorted by minimum latitude, only those starting below the box top and not too far below its bottom
+        lo = np.searchsorted(self.route_min_lats, min_lat - self.route_max_height, side="left")
+        hi = np.searchsorted(self.route_min_lats, max_lat, side="right")
+
+        pos = self.route_order[lo:hi]
+        boxes = self.route_bboxes[pos]
+        hits = (boxes[:, 2] >= min_lat) & (boxes[:, 1] <= max_lon) & (boxes[:, 3] >= min_lon)
+
+        return np.sort(pos[hits])
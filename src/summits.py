@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Iterable, Optional
+
+# Summit columns of the processed dataset, each a comma separated list of the summits of that class a walk climbs
+SUMMIT_CLASSES = ("Munro", "Corbett", "Donald", "Fiona", "Sub 2000")
+
+
+class SummitIndex:
+
+    def __init__(self, names: np.ndarray, classes: np.ndarray, offsets: np.ndarray, rows: np.ndarray, counts: np.ndarray):
+        """Inverted index from summit to walks, queried by walk position (row of the processed dataset). Summit i
+        is names[i] of class SUMMIT_CLASSES[classes[i]], climbed by the walks rows[offsets[i]:offsets[i + 1]]
+        (sorted). counts is the (n_walks, n_classes) number of summits of each class a walk climbs."""
+
+        self.names = np.asarray(names, dtype=str)
+        self.classes = np.asarray(classes, dtype=np.int8)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int16)
+        # Names are matched case insensitively
+        self._ids = {name.lower(): i for i, name in enumerate(self.names.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "SummitIndex":
+        """Index the summit columns present in the frame. Each distinct column value is split once, rather than
+        every walk's."""
+
+        pairs = []
+        for i, col in enumerate(SUMMIT_CLASSES):
+            if col not in df.columns:
+                continue
+
+            codes, uniques = pd.factorize(df[col])
+            names = pd.Series(np.asarray(uniques, dtype=object)).astype(str).str.split(",").explode().str.strip()
+            names = names[names != ""]
+            walks = pd.DataFrame({"row": np.arange(len(df)), "value": codes})
+            pairs.append(walks.merge(pd.DataFrame({"value": names.index, "name": names.to_numpy()}), on="value").assign(cls=i))
+
+        summits = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame({"row": [], "name": [], "cls": []})
+        ids, keys = pd.factorize(summits["name"].str.lower(), sort=True)
+        summits = summits.assign(id=ids).drop_duplicates(["row", "id"])
+
+        # Summits keep the spelling and class they are first listed with
+        first = summits.drop_duplicates("id").sort_values("id")
+        postings = summits.sort_values(["id", "row"])
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(postings["id"].to_numpy(dtype=np.int64), minlength=len(keys)), out=offsets[1:])
+
+        counts = np.zeros((len(df), len(SUMMIT_CLASSES)), dtype=np.int16)
+        np.add.at(counts, (summits["row"].to_numpy(dtype=np.int64), summits["cls"].to_numpy(dtype=np.int64)), 1)
+
+        return cls(first["name"].to_numpy(dtype=str), first["cls"].to_numpy(), offsets, postings["row"].to_numpy(), counts)
+
+    @classmethod
+    def load(cls, path: Path) -> "SummitIndex":
+
+        arrays = np.load(path)
+        return cls(*[arrays[name] for name in ["names", "classes", "offsets", "rows", "counts"]])
+
+    def save(self, path: Path) -> None:
+
+        with open(path, "wb") as fout:
+            np.savez(fout, names=self.names, classes=self.classes, offsets=self.offsets, rows=self.rows, counts=self.counts)
+
+    def summit_class(self, name: str) -> Optional[str]:
+
+        i = self._ids.get(name.strip().lower())
+        return SUMMIT_CLASSES[self.classes[i]] if i is not None else None
+
+    def walks(self, name: str) -> np.ndarray:
+        """Sorted positions of the walks climbing a summit, empty for unknown summits."""
+
+        i = self._ids.get(name.strip().lower())
+        return self.rows[self.offsets[i]:self.offsets[i + 1]] if i is not None else self.rows[:0]
+
+    def covering(self, names: Iterable[str], n: int = 1) -> np.ndarray:
+        """Sorted positions of the walks climbing at least n of the given summits."""
+
+        climbed = np.bincount(np.concatenate([self.walks(name) for name in names] or [self.rows[:0]]), minlength=len(self))
+        return np.flatnonzero(climbed >= max(n, 1))
+
+    def class_counts(self, summit_class: str) -> np.ndarray:
+        """Number of summits of a class (e.g. "Munro") each walk climbs."""
+        return self.counts[:, SUMMIT_CLASSES.index(summit_class)]
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import shutil
+import folium
+import numpy as np
+from folium.template import Template
+from pathlib import Path
+from typing import Iterable
+from PIL import Image, ImageDraw
+from src.routes import RouteStore
+from src.simplify import tolerance_for_zoom
+
+TILE_SIZE = 256
+TILE_ZOOMS = tuple(range(6, 13))
+TILE_MANIFEST = "manifest.json"
+ROUTE_COLOUR = (200, 30, 30)
+ROUTE_WIDTH = 2
+# Relative to the streamlit page, so served under any base URL path
+TILE_URL = "app/static/tiles/{z}/{x}/{y}.png"
+
+
+class StaticTileLayer(folium.TileLayer):
+    """Tile layer of tiles served by streamlit static file serving. Maps are drawn in a component iframe, so the
+    relative URL is resolved against the streamlit page rather than the iframe (as for lazily loaded routes)."""
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.tileLayer(
+                decodeURI(new URL({{ this.tiles|tojson }}, (function () {
+                    try {
+                        return window.parent.location.href;
+                    } catch (e) {
+                        return document.baseURI;
+                    }
+                })()).href),
+                {{ this.options|tojavascript }}
+            );
+        {% endmacro %}
+        """
+    )
+
+
+def to_pixels(lat: np.ndarray, lon: np.ndarray, zoom: int) -> tuple[np.ndarray, np.ndarray]:
+    """Web mercator global pixel coordinates at the given zoom, longitudes may be positive (0 - 360)."""
+
+    lon = np.where(lon > 180, lon - 360, lon)
+    scale = TILE_SIZE * 2 ** zoom
+
+    x = (lon + 180) / 360 * scale
+    y = (1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * scale
+
+    return x, y
+
+
+def tile_ranges(bboxes: np.ndarray, zoom: int) -> np.ndarray:
+    """Inclusive [x0, y0, x1, y1] tile ranges covered by [min_lat, min_lon, max_lat, max_lon] boxes, padded by the
+    route line width."""
+
+    x0, y1 = to_pixels(bboxes[:, 0], bboxes[:, 1], zoom)
+    x1, y0 = to_pixels(bboxes[:, 2], bboxes[:, 3], zoom)
+
+    return (np.column_stack([x0 - ROUTE_WIDTH, y0 - ROUTE_WIDTH, x1 + ROUTE_WIDTH, y1 + ROUTE_WIDTH]) // TILE_SIZE).astype(np.int64)
+
+
+def tiles_in_ranges(ranges: np.ndarray) -> set[tuple[int, int]]:
+    return {(x, y) for x0, y0, x1, y1 in ranges for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)}
+
+
+def route_hashes(routes: RouteStore) -> dict[str, str]:
+
+    return {
+        key.decode(): hashlib.blake2b(routes[i].tobytes(), digest_size=8).hexdigest()
+        for i, key in enumerate(routes.keys.tolist()) if len(routes[i])
+    }
+
+
+def render_tile(paths: Iterable[np.ndarray]) -> Image.Image:
+    """Tile of route lines, each path an (n, 2) array of pixel coordinates relative to the tile."""
+
+    # Two colour palette, index 0 is saved as transparent, which encodes far faster and smaller than RGBA
+    image = Image.new("P", (TILE_SIZE, TILE_SIZE), 0)
+    image.putpalette([0, 0, 0, *ROUTE_COLOUR])
+    draw = ImageDraw.Draw(image)
+    for path in paths:
+        draw.line(path.ravel().tolist(), fill=1, width=ROUTE_WIDTH, joint="curve")
+
+    return image
+
+
+def build(routes: RouteStore, path: Path, zooms: Iterable[int] = TILE_ZOOMS, full: bool = False) -> int:
+    """Render every route onto a pyramid of transparent PNG tiles, path/{z}/{x}/{y}.png, simplified to the detail
+    each zoom shows. A manifest of route hashes and bounding boxes is kept with the tiles, so later builds only
+    re-render tiles touched by routes that were added, changed or removed. Returns the number of tiles rendered."""
+
+    zooms = tuple(zooms)
+    manifest_path = path / TILE_MANIFEST
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.is_file() and not full else None
+    if manifest is not None and tuple(manifest["zooms"]) != zooms:
+        manifest = None
+
+    hashes = route_hashes(routes)
+    bboxes = routes.bboxes()
+    positions = {key: i for i, key in enumerate(k.decode() for k in routes.keys.tolist())}
+
+    if manifest is None:
+        # Full build, tiles of routes that no longer exist would otherwise linger
+        for z in zooms:
+            shutil.rmtree(path / str(z), ignore_errors=True)
+        dirty_boxes = bboxes[[positions[key] for key in hashes]]
+    else:
+        old = manifest["routes"]
+        changed = {key for key in hashes.keys() | old.keys() if hashes.get(key) != old.get(key, {}).get("hash")}
+        dirty_boxes = np.array(
+            [bboxes[positions[key]] for key in changed if key in hashes] + [old[key]["bbox"] for key in changed if key in old]
+        ).reshape(-1, 4)
+
+    has_route = ~np.isnan(bboxes[:, 0])
+    route_rows = np.flatnonzero(has_route)
+    rendered = 0
+
+    for z in zooms:
+
+        dirty = tiles_in_ranges(tile_ranges(dirty_boxes, z))
+        if not dirty:
+            continue
+
+        ranges = tile_ranges(bboxes[has_route], z)
+        tolerance = tolerance_for_zoom(z)
+        x, y = to_pixels(routes.coords[:, 0].astype(float), routes.coords[:, 1].astype(float), z)
+        pixels = np.column_stack([x, y])
+
+        for tx, ty in dirty:
+
+            hits = route_rows[(ranges[:, 0] <= tx) & (ranges[:, 2] >= tx) & (ranges[:, 1] <= ty) & (ranges[:, 3] >= ty)]
+            tile = path / str(z) / str(tx) / f"{ty}.png"
+
+            if not len(hits):
+                tile.unlink(missing_ok=True)
+                continue
+
+            origin = np.array([tx, ty]) * TILE_SIZE
+            paths = []
+            for i in hits:
+                start, end = routes.offsets[i], routes.offsets[i + 1]
+                keep = routes.importance[start:end] > tolerance if tolerance is not None and routes.importance is not None else slice(None)
+                paths.append(pixels[start:end][keep] - origin)
+
+            tile.parent.mkdir(parents=True, exist_ok=True)
+            render_tile(paths).save(tile, transparency=0)
+            rendered += 1
+
+    path.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps({
+        "zooms": zooms,
+        "routes": {key: {"hash": h, "bbox": bboxes[positions[key]].tolist()} for key, h in hashes.items()},
+    }))
+
+    return rendered
@@ -1,7 +1,22 @@
+import io
+import json
+import tempfile
+import threading
+import time
 import unittest
+import folium
+import numpy as np
 import pandas as pd
 import pandas.testing as pdt
-from src import etl, data, gpx
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from config import settings
+from contextlib import contextmanager
+import run_gpx
+from benchmarks import synthetic
+from src import cache, etl, data, fetch, filters, gpx, grid, instrument, markers, processed, route_metrics, routes, schema, scrape, simplify, spatial, summits, tiles
+from src.routes import RouteStore
 
 
 class TestSandbox(unittest.TestCase):
@@ -10,11 +25,199 @@ class TestSandbox(unittest.TestCase):
         self.assertTrue(isinstance(etl.main(), pd.DataFrame))
 
 
+class TestEtl(unittest.TestCase):
+
+    def test_capitalize_string(self):
+
+        self.assertEqual(etl.capitalize_string("the ben of the glen"), "The Ben of the Glen")
+        self.assertEqual(etl.capitalize_string("loch morlich, near aviemore"), "Loch Morlich, near Aviemore")
+
+    def test_format_column(self):
+
+        names = pd.Series(["ben lomond via the ptarmigan", "ben lomond via the ptarmigan", None], name="Name")
+        pdt.assert_series_equal(
+            etl.format_column(names), pd.Series(["Ben Lomond via the Ptarmigan", "Ben Lomond via the Ptarmigan", None], name="Name")
+        )
+        links = pd.Series(['<a href="x">click here</a>'] * 3, name="Link")
+        pdt.assert_series_equal(etl.format_column(links), links)
+        pdt.assert_series_equal(etl.format_column(pd.Series([3.14159, 2.0, np.nan])), pd.Series([3.14, 2.0, np.nan]))
+        pdt.assert_series_equal(etl.format_column(pd.Series([1, 2, 3])), pd.Series([1, 2, 3]))
+
+    def test_build_popups(self):
+
+        inp = pd.DataFrame([{
+            "Name": "Carnoustie Links", "Distance": 6.5, "Time": 1.25, "Ascent": 8, "Rating": 3.67,
+            "Link": etl.html_link("walk"), "Start Point": etl.html_link("map"), "GPX": etl.html_link("gpx", text="download")
+        }])
+
+        self.assertEqual(
+            etl.build_popups(inp)[0],
+            '<b>Name</b>: Carnoustie Links<br><b>Distance</b>: 6.5km<br><b>Time</b>: 1.25 hours (avg)<br><b>Ascent</b>: 8m<br>'
+            '<b>Rating</b>: 3.67/5<br><b>Link</b>: <a href="walk" target="blank">click here</a><br>'
+            '<b>Start Point</b>: <a href="map" target="blank">click here</a><br><b>GPX</b>: <a href="gpx" target="blank">download</a><br>'
+        )
+        self.assertEqual(
+            etl.build_popups(inp, compact=True)[0],
+            '<b>Carnoustie Links</b><br>6.5km | 1.2h | 8m<br><a href="walk" target="blank">click here</a>'
+        )
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_time_hours(self):
+
+        inp = pd.Series(["1 - 1.5 hours", "30 - 45 mins", "45 mins - 1 hour", "2 hours", "3-", None])
+        res = schema.time_hours(inp)
+        np.testing.assert_allclose(res, [1.25, 0.625, 0.875, 2.0, 3.0, np.nan])
+
+    def test_join_nonempty(self):
+
+        inp = [pd.Series(["Ben A", None, "", None]), pd.Series(["Ben B", "Ben C", None, ""])]
+        res = schema.join_nonempty(*inp)
+        self.assertEqual(res.tolist(), ["Ben A, Ben B", "Ben C", "", ""])
+        self.assertEqual(schema.join_nonempty(), "")
+
+    def test_merge_plurals(self):
+
+        inp = pd.DataFrame({"Area0": ["a", "b"], "Munro": ["Ben A", None], "Munros": [None, "Ben B, Ben C"], "Corbetts": ["C", None]})
+        res = schema.merge_plurals(inp, renames={"Area0": "Region"})
+        self.assertEqual(list(res), ["Region", "Munro", "Corbetts"])
+        self.assertEqual(res["Munro"].tolist(), ["Ben A", "Ben B, Ben C"])
+
+    def test_apply(self):
+
+        inp = pd.DataFrame({"Name": ["glen", "ben", "loch"], "Munro": ["Ben A", None, ""], "Munros": [None, "Ben B", None],
+                            "Note": ["a note", None, "x"], "Height": ["850m", "1000m", None]})
+        columns = (
+            schema.Column("Munro", schema.join_nonempty, match="munro", stage="hills"),
+            schema.Column("Height", schema.leading_number, ("Height",)),
+            schema.Column("Label", lambda names, hills: names + ": " + hills, ("Name", "Munro"), format=False),
+        )
+
+        stages = []
+
+        @contextmanager
+        def stage(name):
+            stages.append(name)
+            yield
+
+        res = schema.apply(inp, columns, format_column=etl.format_column, stage=stage, required=("Height",))
+        # Raw columns keep their order, those from several raw columns go last
+        self.assertEqual(res.columns.tolist(), ["Name", "Note", "Height", "Munro", "Label"])
+        self.assertEqual(res["Name"].tolist(), ["Glen", "Ben"])
+        self.assertEqual(res["Label"].tolist(), ["glen: Ben A", "ben: Ben B"])
+        self.assertIn("hills", stages)
+
+
+def raw_walk(name: str, area: str, grid_ref: str = "NO 565 344", **kwargs) -> dict:
+
+    link = f"https://www.walkhighlands.co.uk/{area}/{name.lower().replace(' ', '-')}.shtml"
+
+    return {
+        "Distance": "6.5km (4 miles)", "Time": "1 - 1.5 hours", "Ascent": "8m", "Start Grid Ref": grid_ref,
+        "Area0": area, "Area1": name.lower(), "Name": name, "Rating": "3.67", "Votes": "3", "Grade": 1, "Bog": 2,
+        "Link": link, "StartPoint": "https://www.google.com/maps/search/56.49980,-2.70820/",
+        "GPX": link.replace(".shtml", ".gpx"), **kwargs
+    }
+
+
+class TestIncrementalEtl(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        (tmp / "raw").mkdir()
+
+        self.patches = [
+            mock.patch.object(settings, "raw_data_path", tmp / "raw"),
+            mock.patch.object(settings, "processed_path", tmp / "processed.parquet"),
+            mock.patch.object(settings, "processed_manifest_path", tmp / "manifest.json"),
+            mock.patch.object(settings, "spatial_index_path", tmp / "spatial_index.npz"),
+            mock.patch.object(settings, "summit_index_path", tmp / "summit_index.npz"),
+        ]
+        for p in self.patches:
+            p.start()
+
+        self.write("angus", [raw_walk("Carnoustie", "angus"), raw_walk("Mount Blair", "angus", Munro="Mount Blair")])
+        self.write("arran", [raw_walk("Goatfell", "arran", "NS 013 359"), raw_walk("Mount Blair", "angus")])
+
+    def tearDown(self):
+
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def write(self, region: str, walks: list[dict]):
+
+        with open(settings.raw_data_path / f"{region}walks.json", "w") as fout:
+            json.dump(walks, fout)
+
+    def test_incremental_matches_full(self):
+
+        etl.main()
+        self.write("arran", [raw_walk("Goatfell", "arran", "NS 013 359", Time="45 mins"), raw_walk("Holy Isle", "arran")])
+
+        res = etl.main(incremental=True)
+        settings.processed_manifest_path.unlink()
+        out = etl.main()
+
+        pdt.assert_frame_equal(res, out)
+        self.assertListEqual(res["Name"].tolist(), ["Carnoustie", "Mount Blair", "Goatfell", "Holy Isle"])
+        self.assertEqual(res.loc[2, "Time"], 0.75)
+
+    def test_incremental_keeps_unchanged_rows(self):
+
+        etl.main()
+        processed = pd.read_parquet(settings.processed_path)
+        processed["Popup"] = "kept"
+        processed.to_parquet(settings.processed_path)
+
+        self.write("arran", [raw_walk("Goatfell", "arran", "NS 013 359", Votes="4"), raw_walk("Mount Blair", "angus")])
+        res = etl.main(incremental=True)
+
+        self.assertListEqual(res["Popup"].tolist(), ["kept", "kept", res.loc[2, "Popup"]])
+        self.assertNotEqual(res.loc[2, "Popup"], "kept")
+        self.assertEqual(res.loc[2, "Votes"], 4)
+
+    def test_processed_types(self):
+
+        out = etl.main()
+        self.assertFalse(settings.processed_path.with_suffix(".csv").exists())
+
+        res = processed.read(settings.processed_path)
+        self.assertEqual(res["Region"].dtype, "category")
+        self.assertEqual(res["Grade"].dtype, np.int8)
+        pdt.assert_frame_equal(res, out, check_dtype=False, check_categorical=False)
+
+        # Only the listed columns, missing ones are skipped
+        res = processed.read(settings.processed_path, columns=["Name", "lat", "No Such Column"])
+        self.assertListEqual(res.columns.tolist(), ["Name", "lat"])
+
+        etl.main(incremental=True, csv=True)
+        self.assertTrue(settings.processed_path.with_suffix(".csv").is_file())
+
+
 class TestData(unittest.TestCase):
 
     def test_load_walk_data(self):
         self.assertTrue(isinstance(data.load_walk_data(), pd.DataFrame))
 
+    def test_load_walk_data_files(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+
+            files = [Path(tmp) / "anguswalks.json", Path(tmp) / "arranwalks.json"]
+            for file, walks in zip(files, [[{"Name": "A", "Munro": "X"}], [{"Name": "B"}, {"Name": "C", "Munros": "Y, Z"}]]):
+                with open(file, "w") as fout:
+                    json.dump(walks, fout)
+
+            out = pd.DataFrame({"Name": ["A", "B", "C"], "Munro": ["X", None, None], "Munros": [None, None, "Y, Z"]})
+
+            pdt.assert_frame_equal(data.load_walk_data(files), out)
+            pdt.assert_frame_equal(data.load_walk_data(files, workers=2), out)
+            self.assertListEqual([len(df) for df in data.iter_walk_data(files)], [1, 2])
+
 
 class TestGpx(unittest.TestCase):
 
@@ -46,6 +249,884 @@ class TestGpx(unittest.TestCase):
 
         self.assertListEqual(gpx.get_lat_long_tuples(inp), out)
 
+    def test_read_points(self):
+
+        inp = (
+            b'<?xml version="1.0"?><gpx xmlns="http://www.topografix.com/GPX/1/1">'
+            b'<rte><rtept lat="56.5" lon="-2.7"/><rtept lat="56.6" lon="-2.8"><ele>10</ele></rtept></rte>'
+            b'<trk><trkseg><trkpt lat="57" lon="-3"><ele>3.5</ele><time>1970-01-01T00:01:00Z</time></trkpt></trkseg></trk>'
+            b'</gpx>'
+        )
+
+        out = {
+            "lat": np.array([56.5, 56.6, 57]),
+            "lon": np.array([-2.7, -2.8, -3]),
+            "ele": np.array([np.nan, 10, 3.5]),
+            "time": np.array([np.nan, np.nan, 60]),
+        }
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "route.gpx"
+            path.write_bytes(inp)
+
+            for source in [inp, io.BytesIO(inp), path, str(path)]:
+                res = gpx.read_points(source, capacity=1)
+                for k, v in out.items():
+                    np.testing.assert_array_equal(res[k], v)
+
+
+class TestGrid(unittest.TestCase):
+
+    def test_grid_to_latlon(self):
+
+        # OS worked example and walk start points checked against walkhighlands Google Maps links
+        inp = pd.Series(["TG5140913177", "NO565344", "NB052077", "nn 166 712"])
+
+        out_lat = np.array([52.65798, 56.49980, 57.96110, 56.79609])
+        out_lon = np.array([1.71605, -2.70820, -6.98620, -5.00471])
+
+        lat, lon = grid.grid_to_latlon(inp)
+        np.testing.assert_allclose(lat, out_lat, atol=1e-3)
+        np.testing.assert_allclose(lon, out_lon, atol=1e-3)
+
+    def test_grid_to_latlon_invalid(self):
+
+        inp = pd.Series(["NO565344", "XX123456", "NO56534", None, ""])
+
+        lat, lon = grid.grid_to_latlon(inp)
+        self.assertFalse(np.isnan(lat[0]))
+        self.assertTrue(np.isnan(lat[1:]).all())
+        self.assertTrue(np.isnan(lon[1:]).all())
+
+
+class TestRouteStore(unittest.TestCase):
+
+    def test_round_trip(self):
+
+        paths = [[[56.5, 357.3], [56.6, 357.2]], None, [[57.0, 355.0]]]
+        routes = RouteStore.from_paths(["a", "b", "c"], paths)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            routes.save(Path(tmp))
+            res = RouteStore.load(Path(tmp))
+
+            self.assertEqual(len(res), 3)
+            self.assertIsInstance(res.coords, np.memmap)
+            np.testing.assert_allclose(res.get("a"), paths[0], atol=1e-4)
+            self.assertEqual(res.get("b").shape, (0, 2))
+            self.assertIsNone(res.get("missing"))
+
+            res_paths = res.paths(["c", "b", "missing"])
+            np.testing.assert_allclose(res_paths[0], paths[2], atol=1e-4)
+            self.assertIsNone(res_paths[1])
+            self.assertIsNone(res_paths[2])
+
+            # Views share the flat buffer rather than copying it
+            self.assertTrue(np.shares_memory(res_paths[0], res.coords))
+
+    def test_route_table(self):
+
+        paths = [[[56.5, 357.3], [56.6, 357.2]], None, [[57.0, 355.0]]]
+        table = routes.route_table(["angus/a", "angus/b", "skye/c"], paths, [[10.0, 25.5], None, None])
+        self.assertListEqual(table.column("Walk Id").to_pylist(), ["angus/a", "skye/c"])
+
+        res = RouteStore.from_table(table)
+        np.testing.assert_allclose(res.get("angus/a"), paths[0], atol=1e-4)
+        self.assertIsNone(res.get("angus/b"))
+        np.testing.assert_allclose(res.ele, [10.0, 25.5, np.nan])
+
+        with tempfile.TemporaryDirectory() as tmp:
+
+            # Upserts replace the route of the same walk, other routes are kept, and empty ones write nothing
+            routes.write_route_table(Path(tmp), table)
+            routes.write_route_table(Path(tmp), routes.route_table([], []))
+            self.assertEqual(len(list(Path(tmp).glob(routes.ROUTE_TABLE_PART))), 1)
+            routes.write_route_table(Path(tmp), routes.route_table(["skye/c", "skye/d"], [[[57.1, 355.1]], [[57.2, 355.2]]]))
+            res = RouteStore.from_table(routes.read_route_table(Path(tmp)))
+            self.assertListEqual(sorted(k.decode() for k in res.keys), ["angus/a", "skye/c", "skye/d"])
+            np.testing.assert_allclose(res.get("skye/c"), [[57.1, 355.1]], atol=1e-4)
+
+            # Compacted into one part once there are too many
+            for i in range(routes.MAX_ROUTE_TABLE_PARTS):
+                routes.write_route_table(Path(tmp), routes.route_table(["skye/c"], [[[57.0, 355.0 + i]]]))
+            self.assertLessEqual(len(list(Path(tmp).glob(routes.ROUTE_TABLE_PART))), routes.MAX_ROUTE_TABLE_PARTS)
+            res = RouteStore.from_table(routes.read_route_table(Path(tmp)))
+            self.assertEqual(len(res), 3)
+            np.testing.assert_allclose(res.get("skye/c"), [[57.0, 355.0 + routes.MAX_ROUTE_TABLE_PARTS - 1]], atol=1e-4)
+
+            routes.write_route_table(Path(tmp), routes.route_table(["skye/e"], [[[57.3, 355.3]]]), replace=True)
+            self.assertListEqual(routes.read_route_table(Path(tmp)).column("Walk Id").to_pylist(), ["skye/e"])
+
+    def test_walk_id(self):
+        self.assertEqual(routes.walk_id("https://www.walkhighlands.co.uk/angus/carnoustie.shtml"), "angus/carnoustie")
+
+    def test_write_files(self):
+
+        links = ["https://www.walkhighlands.co.uk/angus/carnoustie.shtml", "https://www.walkhighlands.co.uk/arran/goatfell.shtml"]
+        routes = RouteStore.from_paths(links, [[[56.5, 357.3], [56.55, 357.25], [56.6, 357.2]], None])
+        routes.importance = np.array([np.inf, 20., np.inf], dtype=np.float32)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(routes.write_files(Path(tmp)), 1)
+            route = json.loads((Path(tmp) / "angus" / "carnoustie.json").read_text())
+            self.assertFalse((Path(tmp) / "arran").exists())
+
+            # Unchanged routes are not rewritten, routes no longer stored are removed
+            self.assertEqual(routes.write_files(Path(tmp)), 0)
+            changed = RouteStore.from_paths(links[::-1], [[[57.6, 354.9], [57.7, 354.8]], None])
+            self.assertEqual(changed.write_files(Path(tmp)), 1)
+            self.assertTrue((Path(tmp) / "arran" / "goatfell.json").is_file())
+            self.assertFalse((Path(tmp) / "angus" / "carnoustie.json").exists())
+
+        self.assertEqual(len(route["c"]), 3)
+        # Kept at 5 and 15m tolerances, end points at every tolerance
+        self.assertListEqual(route["l"], [4, 2, 4])
+
+
+class TestRouteMetrics(unittest.TestCase):
+
+    def setUp(self):
+
+        # An out and back route with elevations, a route without any and a single point
+        paths = [[[56.5, 357.3], [56.51, 357.3], [56.5, 357.3]], None, [[56.6, 357.0], [56.6, 357.1]], [[57.0, 355.0]]]
+        elevations = [[100, 150, 120], None, None, [50]]
+        self.routes = RouteStore.from_paths(["a", "b", "c", "d"], paths, elevations)
+
+    def test_route_metrics(self):
+
+        res = route_metrics.route_metrics(self.routes)
+
+        self.assertListEqual(res.index.tolist(), ["a", "b", "c", "d"])
+        np.testing.assert_allclose(res["Route Distance"], [2.224, np.nan, 6.121, 0], atol=1e-3)
+        np.testing.assert_allclose(res["Start End Gap"], [0, np.nan, 6.121, 0], atol=1e-3)
+        np.testing.assert_allclose(res["Point Density"], [3 / 2.224, np.nan, 2 / 6.121, np.nan], rtol=1e-3)
+        np.testing.assert_allclose(res["Elevation Gain"], [50, np.nan, np.nan, 0])
+        np.testing.assert_allclose(res["Elevation Loss"], [30, np.nan, np.nan, 0])
+        np.testing.assert_allclose(res.loc["c", ["Route Min Lat", "Route Min Lon", "Route Max Lat", "Route Max Lon"]], [56.6, 357.0, 56.6, 357.1], atol=1e-4)
+
+    def test_save_elevations(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.routes.save(Path(tmp))
+            np.testing.assert_allclose(RouteStore.load(Path(tmp)).ele, self.routes.ele)
+
+            # Without elevations the stale file is removed
+            RouteStore.from_paths(["a"], [[[56.5, 357.3]]]).save(Path(tmp))
+            self.assertIsNone(RouteStore.load(Path(tmp)).ele)
+
+    def test_walk_metrics(self):
+
+        links = pd.Series(["c", "missing", "a"], index=[5, 6, 7])
+        res = route_metrics.walk_metrics(self.routes, links)
+
+        self.assertListEqual(res.index.tolist(), [5, 6, 7])
+        self.assertTrue(res.loc[6].isna().all())
+        self.assertAlmostEqual(res.loc[7, "Route Distance"], 2.224, places=3)
+
+        df = pd.DataFrame({"Distance": [6.0, 5.0, 3.0], "Route Distance": res["Route Distance"].to_numpy()})
+        self.assertListEqual(route_metrics.distance_disagreements(df).tolist(), [False, False, True])
+
+
+class TestSimplify(unittest.TestCase):
+
+    def test_route_importance(self):
+
+        # Two routes, the second has a 10m and a ~100m deviation from a straight line
+        deg = 1 / simplify.METRES_PER_DEGREE
+        coords = np.array([
+            [56.0, 0.0], [56.0, 0.001],
+            [0.0, 0.0], [10 * deg, 0.001], [0.0, 0.002], [100 * deg, 0.003], [0.0, 0.004],
+        ])
+        offsets = np.array([0, 2, 7])
+
+        res = simplify.route_importance(coords, offsets)
+
+        self.assertTrue(np.isinf(res[[0, 1, 2, 6]]).all())
+        self.assertAlmostEqual(res[5], 100, delta=1)
+        self.assertLess(res[3], 10.01)
+        self.assertAlmostEqual(res[4], 64, delta=1)
+        self.assertListEqual(np.flatnonzero(res > 70).tolist(), [0, 1, 2, 5, 6])
+
+        routes = RouteStore.from_paths(["a", "b"], [coords[:2], coords[2:]])
+        routes.importance = res
+        np.testing.assert_allclose(routes.simplified(1, 70), coords[[2, 5, 6]], atol=1e-6)
+
+    def test_tolerance_for_zoom(self):
+
+        self.assertEqual(simplify.tolerance_for_zoom(6), max(simplify.ROUTE_TOLERANCES))
+        self.assertIsNone(simplify.tolerance_for_zoom(18))
+
+
+class TestSpatial(unittest.TestCase):
+
+    def test_radius_matches_brute_force(self):
+
+        rng = np.random.default_rng(0)
+        lat, lon = rng.uniform(55, 59, 500), rng.uniform(353, 359, 500)
+        lat[10] = np.nan
+        index = spatial.SpatialIndex(lat, lon)
+
+        pos, dist = index.radius(57, 356, 40)
+        expected = np.flatnonzero(spatial.haversine_km(57, 356, lat, lon) <= 40)
+
+        self.assertListEqual(sorted(pos.tolist()), expected.tolist())
+        self.assertTrue((np.diff(dist) >= 0).all())
+
+        nearest, _ = index.nearest(57, 356, k=3)
+        self.assertListEqual(nearest.tolist(), pos[:3].tolist())
+
+    def test_bbox_and_routes(self):
+
+        bboxes = np.array([[56.0, 355.0, 56.5, 355.5], [np.nan] * 4, [57.0, 356.0, 57.1, 356.1]])
+        index = spatial.SpatialIndex([56.0, 56.2, 57.0], [355.0, 355.2, 356.0], route_bboxes=bboxes)
+
+        self.assertListEqual(index.bbox(55.9, 354.9, 56.3, 355.3).tolist(), [0, 1])
+        self.assertListEqual(index.routes_in_bbox(56.4, 355.4, 56.6, 355.6).tolist(), [0])
+        self.assertListEqual(index.routes_in_bbox(56.6, 355.0, 56.9, 357.0).tolist(), [])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            index.save(Path(tmp) / "index.npz")
+            loaded = spatial.SpatialIndex.load(Path(tmp) / "index.npz")
+
+        self.assertListEqual(loaded.routes_in_bbox(57.05, 356.05, 58, 357).tolist(), [2])
+
+    def test_parse_location(self):
+
+        lat, lon = spatial.parse_location("56.8, -5.0")
+        self.assertEqual((lat, lon), (56.8, 355.0))
+
+        lat, lon = spatial.parse_location("NN166712")
+        self.assertAlmostEqual(lat, 56.797, places=2)
+        self.assertGreater(lon, 350)
+
+        self.assertIsNone(spatial.parse_location("garbage"))
+
+
+WALK_PAGE = """<html><body><div id="wrapper">
+<h1>Mount  Blair</h1>
+<p class="votes">Rating <span>3.67</span> from <span>3</span> votes</p>
+<p class="grade"><img src="g.gif"><img src="g.gif"></p>
+<p class="bog x"><img src="b.gif"></p>
+<a href="/angus/">Angus</a><a href="https://www.google.com/maps/search/56.49980,-2.70820/">Map</a>
+<ul class="box"><li><a href="/print.php">Print</a></li><li><a href="/download.php?id=1">Download</a></li></ul>
+<div id="col"><dl>
+<dt>Distance</dt><dd>6.5km (4 miles)</dd><dt>Munro</dt><dd>Mount Blair</dd><dt>Munro</dt><dd>Creag Leacach</dd>
+<dt>Terrain</dt><dd>Good paths<br>some bog</dd>
+</dl></div></div></body></html>"""
+
+ROUTE_PAGE = """<html><body><div id="walk_info"><a class="button2" href="/downloads/mount-blair.gpx">GPX</a></div></body></html>"""
+
+
+class TestSummits(unittest.TestCase):
+
+    def setUp(self):
+
+        self.df = pd.DataFrame({
+            "Munro": ["Ben Lui, Beinn a' Chleibh", "", "Ben Lui", None],
+            "Corbett": pd.Categorical(["", "Ben Ledi", "", "Ben Ledi"]),
+            "Sub 2000": [None, None, "Conic Hill", ""],
+        })
+        self.index = summits.SummitIndex.from_frame(self.df)
+
+    def test_lookup(self):
+
+        self.assertListEqual(self.index.names.tolist(), ["Beinn a' Chleibh", "Ben Ledi", "Ben Lui", "Conic Hill"])
+        self.assertListEqual(self.index.walks("ben lui ").tolist(), [0, 2])
+        self.assertListEqual(self.index.walks("Ben Nevis").tolist(), [])
+        self.assertEqual(self.index.summit_class("Ben Ledi"), "Corbett")
+
+    def test_covering(self):
+
+        names = ["Ben Lui", "Beinn a' Chleibh", "Conic Hill"]
+        self.assertListEqual(self.index.covering(names).tolist(), [0, 2])
+        self.assertListEqual(self.index.covering(names, 2).tolist(), [0, 2])
+        self.assertListEqual(self.index.covering(names, 3).tolist(), [])
+        self.assertListEqual(self.index.covering([]).tolist(), [])
+
+    def test_counts(self):
+
+        np.testing.assert_array_equal(self.index.class_counts("Munro"), [2, 0, 1, 0])
+        np.testing.assert_array_equal(self.index.class_counts("Corbett"), [0, 1, 0, 1])
+        np.testing.assert_array_equal(self.index.class_counts("Donald"), [0, 0, 0, 0])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.index.save(Path(tmp) / "summits.npz")
+            res = summits.SummitIndex.load(Path(tmp) / "summits.npz")
+
+        self.assertListEqual(res.names.tolist(), self.index.names.tolist())
+        self.assertListEqual(res.covering(["Ben Ledi"]).tolist(), [1, 3])
+
+
+class TestFilters(unittest.TestCase):
+
+    def setUp(self):
+
+        self.df = pd.DataFrame({
+            "Region": ["Angus", "Arran", "Angus", "Skye"],
+            "Munros Climbed": [0, 1, 2, 0],
+            "Rating": [3.5, 4.0, np.nan, 5.0],
+            "Votes": [3, 10, 0, 50],
+            "Time": [1.5, 6.0, 8.0, 3.0],
+            "Distance": [6.5, 12.0, 20.0, 8.0],
+            "Grade": [1, 4, 5, 2],
+            "Bog": [2, 3, 1, 0],
+            "Corbett": ["", "Goatfell", "Mount Blair", None],
+            "Fiona": ["", "Goatfell", "", None],
+            "Donald": ["", "", "", ""],
+            "Sub 2000": [None, None, None, "Hill"],
+            "lat": [56.5, 55.6, 56.8, 57.3],
+            "lon": [357.3, 354.8, 356.6, 353.8],
+            "Start End Gap": [0.1, 4.0, np.nan, 0.0],
+        })
+        self.engine = filters.FilterEngine(self.df, index=spatial.SpatialIndex.from_frame(self.df))
+
+    def test_evaluate(self):
+
+        f = filters.Filters
+
+        self.assertListEqual(self.engine.evaluate(f()).tolist(), [0, 1, 2, 3])
+        self.assertListEqual(self.engine.evaluate(f(region="Angus")).tolist(), [0, 2])
+        self.assertListEqual(self.engine.evaluate(f(region="Nowhere")).tolist(), [])
+        # NaN never passes a bounded range, as with pandas comparisons
+        self.assertListEqual(self.engine.evaluate(f(rating=(0, None))).tolist(), [0, 1, 3])
+        self.assertListEqual(self.engine.evaluate(f(time=(2, 7), grade=(None, 4))).tolist(), [1, 3])
+        self.assertListEqual(self.engine.evaluate(f(summits=("Corbett",))).tolist(), [1, 2])
+        self.assertListEqual(self.engine.evaluate(f(summits=("Corbett", "Fiona"))).tolist(), [1])
+        self.assertListEqual(self.engine.evaluate(f(near=(56.5, 357.3, 60))).tolist(), [0, 2])
+        self.assertListEqual(self.engine.evaluate(f(gap=(None, 0.5))).tolist(), [0, 3])
+        # Route metrics missing from the dataset leave no walk within a range
+        self.assertListEqual(self.engine.evaluate(f(elevation_gain=(100, None))).tolist(), [])
+        self.assertListEqual(self.engine.evaluate(f(summit_names=("goatfell",))).tolist(), [1])
+        self.assertListEqual(self.engine.evaluate(f(summit_names=("Goatfell", "Mount Blair"))).tolist(), [1, 2])
+        self.assertListEqual(self.engine.evaluate(f(summit_names=("Goatfell", "Mount Blair"), summit_count=2)).tolist(), [])
+
+    def test_missing_regions(self):
+
+        df = self.df.assign(Region=["Angus", None, None, None])
+        engine = filters.FilterEngine(df)
+
+        self.assertListEqual(engine.evaluate(filters.Filters(region="Nowhere")).tolist(), [])
+        self.assertListEqual(engine.evaluate(filters.Filters(region="Angus")).tolist(), [0])
+
+    def test_cache(self):
+
+        state = filters.Filters(munros=(1, None), summits=("Corbett",))
+        res = self.engine.evaluate(state)
+
+        self.assertIs(self.engine.evaluate(filters.Filters(munros=(1, None), summits=("Corbett",))), res)
+        self.assertFalse(res.flags.writeable)
+
+
+class TestMarkers(unittest.TestCase):
+
+    def test_fragments(self):
+
+        df = pd.DataFrame({"lat": [56.5, 55.6, 57.3], "lon": [357.3, 354.8, 353.8], "Popup": ["<b>A</b>", "B's", "C"]})
+        fragments = markers.MarkerFragments(df, route_ids=["angus/a", "arran/b", "skye/c"])
+        positions = np.array([0, 2])
+
+        data = fragments.data(positions)
+        self.assertNotIn("<", data)
+        self.assertListEqual(json.loads(data), [[56.5, 357.3, "<b>A</b>"], [57.3, 353.8, "C"]])
+        self.assertListEqual(json.loads(fragments.data(positions, route_ids=True))[1], [57.3, 353.8, "C", "skye/c"])
+
+        paths = np.array([markers.script_json([[1.0, 2.0]]), markers.script_json(None)], dtype=object)
+        self.assertListEqual(json.loads(fragments.data(positions, paths=paths))[0], [56.5, 357.3, "<b>A</b>", [[1.0, 2.0]]])
+
+        self.assertEqual(fragments.key(positions), fragments.key(np.array([0, 2])))
+        self.assertNotEqual(fragments.key(positions), fragments.key(np.array([0, 1])))
+        self.assertNotEqual(fragments.key(positions), markers.MarkerFragments(df.assign(lat=df["lat"] + 1)).key(positions))
+
+        m = folium.Map()
+        markers.FragmentMarkerCluster(data).add_to(m)
+        self.assertIn(f"var data = {data};", m.get_root().render())
+
+
+class TestScrape(unittest.TestCase):
+
+    link = "https://www.walkhighlands.co.uk/angus/mount-blair.shtml"
+
+    def test_parse_walk_page(self):
+
+        res = scrape.parse_walk_page(WALK_PAGE, self.link)
+
+        self.assertDictEqual(res, {
+            "Distance": "6.5km (4 miles)", "Munro": "Mount Blair, Creag Leacach", "Terrain": "Good paths\nsome bog",
+            "Area0": "angus", "Area1": "mount-blair", "Name": "Mount Blair", "Rating": "3.67", "Votes": "3",
+            "Grade": 2, "Bog": 1, "Link": self.link, "StartPoint": "https://www.google.com/maps/search/56.49980,-2.70820/"
+        })
+        self.assertIsNone(scrape.parse_walk_page("<html><body></body></html>", self.link))
+
+        with self.assertRaises(scrape.IncompletePage):
+            scrape.parse_walk_page(WALK_PAGE.replace("votes", "stars"), self.link)
+
+    def test_route_link(self):
+
+        route_link = scrape.route_page_link(WALK_PAGE, self.link)
+        self.assertEqual(route_link, "https://www.walkhighlands.co.uk/download.php?id=1")
+        self.assertEqual(scrape.parse_route_page(ROUTE_PAGE, route_link), "https://www.walkhighlands.co.uk/downloads/mount-blair.gpx")
+
+    def test_scrape_walk(self):
+
+        pages = {self.link: WALK_PAGE, "https://www.walkhighlands.co.uk/download.php?id=1": ROUTE_PAGE}
+        session = mock.Mock()
+        session.get.side_effect = lambda url, timeout: mock.Mock(text=pages[url])
+        session.head.return_value = mock.Mock(status_code=404)
+        limiter = fetch.RateLimiter(delay=0)
+        scrape.STATS.reset()
+
+        with mock.patch.object(scrape, "get_walk_data") as get_walk_data:
+            res = scrape.scrape_walk(None, self.link, session=session, limiter=limiter)
+            get_walk_data.assert_not_called()
+
+        self.assertEqual(res["GPX"], "https://www.walkhighlands.co.uk/downloads/mount-blair.gpx")
+        self.assertEqual(scrape.STATS.counts["walk_page_loads"], 2)
+
+        # Incomplete markup falls back to the browser
+        pages[self.link] = WALK_PAGE.replace('id="wrapper"', 'id="app"')
+        drivers = mock.Mock(**{"get.return_value": "driver"})
+        with mock.patch.object(scrape, "get_walk_data", return_value={"Name": "Mount Blair"}) as get_walk_data:
+            res = scrape.scrape_walk(drivers, self.link, session=session, limiter=limiter)
+            get_walk_data.assert_called_once_with("driver", self.link, limiter=limiter)
+
+        self.assertDictEqual(res, {"Name": "Mount Blair"})
+
+    def test_resolve_gpx_link(self):
+
+        gpx_link = "https://www.walkhighlands.co.uk/angus/profiles/mount-blair.gpx"
+        navigate = mock.Mock(return_value="https://www.walkhighlands.co.uk/downloads/mount-blair.gpx")
+        session = mock.Mock()
+        session.head.return_value = mock.Mock(status_code=200, url=gpx_link)
+        scrape.STATS.reset()
+
+        # Direct link in the markup, then the link derived from the walk link, only then the download page
+        page = WALK_PAGE.replace("/download.php?id=1", "profiles/mount-blair.gpx")
+        self.assertEqual(scrape.resolve_gpx_link(page, self.link, navigate, session=session), gpx_link)
+        session.head.assert_not_called()
+
+        self.assertEqual(scrape.resolve_gpx_link(WALK_PAGE, self.link, navigate, session=session), gpx_link)
+        session.head.assert_called_once_with(gpx_link, allow_redirects=True, timeout=30)
+
+        session.head.return_value = mock.Mock(status_code=404, url=gpx_link)
+        self.assertEqual(scrape.resolve_gpx_link(WALK_PAGE, self.link, navigate, session=session), navigate.return_value)
+        navigate.assert_called_once_with("https://www.walkhighlands.co.uk/download.php?id=1")
+
+        # Failures are reported rather than silently returning None
+        no_links = WALK_PAGE.replace("/download.php?id=1", "/print.php")
+        with self.assertRaises(scrape.GpxLinkNotFound):
+            scrape.resolve_gpx_link(no_links, self.link, navigate, session=session)
+        self.assertIsNone(scrape.walk_gpx_link(lambda: scrape.resolve_gpx_link(no_links, self.link, navigate, session=session)))
+
+        self.assertEqual(scrape.STATS.counts["gpx_from_markup"], 1)
+        self.assertEqual(scrape.STATS.counts["gpx_from_pattern"], 1)
+        self.assertEqual(scrape.STATS.counts["gpx_from_download_page"], 1)
+        self.assertEqual(scrape.STATS.counts["gpx_not_found"], 1)
+
+    def test_search_areas_checkpoints(self):
+
+        listing = """<html><body><table class="table1"><tr><td><a href="a.shtml">A</a><a href="b.shtml">B</a><a href="#">Top</a></td></tr></table></body></html>"""
+        base = "https://www.walkhighlands.co.uk/angus/"
+        pages = {base: listing}
+        session = mock.Mock()
+        session.get.side_effect = lambda url, timeout: mock.Mock(text=pages[url])
+
+        def get_walk_data_http(session, limiter, walk_link):
+            if walk_link.endswith("b.shtml") and fail:
+                raise OSError("Connection reset")
+            return {"Name": walk_link[-7], "Link": walk_link}
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(settings, "raw_data_path", Path(tmp)), \
+                mock.patch.object(settings, "scrape_checkpoint_path", Path(tmp) / "checkpoints"), \
+                mock.patch.object(scrape, "DELAY", 0), \
+                mock.patch.object(scrape, "get_walk_data_http", side_effect=get_walk_data_http) as scraper:
+
+            fail = True
+            scrape.search_areas({base: [base]}, workers=2, session=session)
+            self.assertEqual(json.loads((Path(tmp) / "anguswalks.json").read_text()), [{"Name": "a", "Link": base + "a.shtml"}])
+            self.assertTrue(scrape.checkpoint_file("angus").is_file())
+
+            # Restart only scrapes the failed walk, and clears the checkpoint once everything is collected
+            fail = False
+            scraper.reset_mock()
+            scrape.search_areas({base: [base]}, workers=2, session=session)
+
+            scraper.assert_called_once_with(session, mock.ANY, base + "b.shtml")
+            self.assertEqual(len(json.loads((Path(tmp) / "anguswalks.json").read_text())), 2)
+            self.assertFalse(scrape.checkpoint_file("angus").is_file())
+
+    def test_search_areas_failures(self):
+
+        listing = """<html><body><table class="table1"><tr><td><a href="a.shtml">A</a><a href="b.shtml">B</a></td></tr></table></body></html>"""
+        base = "https://www.walkhighlands.co.uk/angus/"
+        raw = [{"Name": "a", "Link": base + "a.shtml"}, {"Name": "b", "Link": base + "b.shtml"}]
+
+        def get(url, timeout):
+            if listing_down:
+                raise ConnectionError("Connection refused")
+            return mock.Mock(text=listing)
+
+        session = mock.Mock(**{"get.side_effect": get})
+
+        def get_walk_data_http(session, limiter, walk_link):
+            if walk_link.endswith("b.shtml") and failing:
+                raise OSError("Connection reset")
+            if walk_link.endswith("a.shtml") and no_description:
+                return None
+            return {"Name": walk_link[-7] + "2", "Link": walk_link}
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(settings, "raw_data_path", Path(tmp)), \
+                mock.patch.object(settings, "scrape_checkpoint_path", Path(tmp) / "checkpoints"), \
+                mock.patch.object(scrape, "DELAY", 0), \
+                mock.patch.object(scrape, "get_walk_data_http", side_effect=get_walk_data_http) as scraper:
+
+            raw_file = Path(tmp) / "anguswalks.json"
+            raw_file.write_text(json.dumps(raw))
+
+            # An area whose listing failed keeps its walks
+            listing_down, failing, no_description = True, True, False
+            scrape.search_areas({base: [base]}, workers=2, session=session)
+            self.assertEqual(json.loads(raw_file.read_text()), raw)
+
+            # Failed walks keep what was scraped before, and are given up on after MAX_WALK_ATTEMPTS crawls
+            listing_down = False
+            for _ in range(scrape.MAX_WALK_ATTEMPTS):
+                self.assertTrue(scrape.checkpoint_file("angus").is_file())
+                scrape.search_areas({base: [base]}, workers=2, session=session)
+                self.assertCountEqual(json.loads(raw_file.read_text()), [{"Name": "a2", "Link": base + "a.shtml"}, raw[1]])
+
+            self.assertEqual(scraper.call_count, 1 + scrape.MAX_WALK_ATTEMPTS)
+            self.assertFalse(scrape.checkpoint_file("angus").is_file())
+
+            # Pages without a walk description are not failures, and no longer listed in the raw file
+            failing, no_description = False, True
+            scrape.search_areas({base: [base]}, workers=2, session=session)
+            self.assertEqual(json.loads(raw_file.read_text()), [{"Name": "b2", "Link": base + "b.shtml"}])
+            self.assertFalse(scrape.checkpoint_file("angus").is_file())
+
+
+class TestTiles(unittest.TestCase):
+
+    @staticmethod
+    def store(shift: float = 0.) -> RouteStore:
+
+        paths = [[[56.50, 357.30], [56.52 + shift, 357.33], [56.55, 357.30]], [[57.10, 355.00], [57.12, 355.05]], None]
+        return RouteStore.from_paths(["a", "b", "c"], paths)
+
+    def test_to_pixels(self):
+
+        x, y = tiles.to_pixels(np.array([0., 56.5]), np.array([0., 355.5]), 0)
+        np.testing.assert_allclose([x[0], y[0]], [128, 128])
+        # Positive longitudes west of Greenwich are in the western half
+        self.assertLess(x[1], 128)
+        self.assertLess(y[1], 128)
+
+    def test_incremental_build(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            self.assertGreater(tiles.build(self.store(), tmp / "tiles", zooms=(8, 12)), 0)
+
+            x, y = tiles.to_pixels(np.array([56.5]), np.array([357.3]), 12)
+            self.assertTrue((tmp / "tiles" / "12" / str(int(x[0] // 256)) / f"{int(y[0] // 256)}.png").is_file())
+
+            # Nothing changed, nothing rendered
+            self.assertEqual(tiles.build(self.store(), tmp / "tiles", zooms=(8, 12)), 0)
+
+            # Only tiles around the moved route are rendered, matching a full build
+            changed = tiles.build(self.store(shift=0.01), tmp / "tiles", zooms=(8, 12))
+            tiles.build(self.store(shift=0.01), tmp / "full", zooms=(8, 12), full=True)
+            incremental = {p.relative_to(tmp / "tiles"): p.read_bytes() for p in (tmp / "tiles").rglob("*.png")}
+            full = {p.relative_to(tmp / "full"): p.read_bytes() for p in (tmp / "full").rglob("*.png")}
+
+            self.assertLess(changed, len(full))
+            self.assertDictEqual(incremental, full)
+
+            # Removed routes are cleared from their tiles
+            removed = RouteStore.from_paths(["a"], [self.store().paths(["a"])[0]])
+            tiles.build(removed, tmp / "tiles", zooms=(8, 12))
+            x, y = tiles.to_pixels(np.array([57.1]), np.array([355.0]), 12)
+            self.assertFalse((tmp / "tiles" / "12" / str(int(x[0] // 256)) / f"{int(y[0] // 256)}.png").exists())
+
+
+class TestFetch(unittest.TestCase):
+
+    def test_rate_limiter(self):
+
+        limiter = fetch.RateLimiter(delay=0.05)
+
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.wait("https://www.walkhighlands.co.uk/a.gpx")
+        limiter.wait("https://example.com/b.gpx")
+
+        # First request to each host is immediate, the rest wait for a token
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def test_report(self):
+
+        report = instrument.RunReport("test", sample_interval=0.01)
+
+        for _ in range(2):
+            with report.stage("etl.clean"):
+                time.sleep(0.02)
+        report.count("etl.rows_in", 5)
+        report.count("etl.rows_in", 3)
+        report.close()
+
+        result = report.to_dict()
+        self.assertEqual(result["stages"]["etl.clean"]["calls"], 2)
+        self.assertGreaterEqual(result["stages"]["etl.clean"]["seconds"], 0.04)
+        self.assertGreater(result["stages"]["etl.clean"]["peak_rss"], 0)
+        self.assertEqual(result["counts"], {"etl.rows_in": 8})
+
+        metrics = report.to_prometheus()
+        self.assertIn('scottishwalks_stage_calls{run="test",stage="etl.clean"} 2', metrics)
+        self.assertIn('scottishwalks_count{run="test",name="etl.rows_in"} 8', metrics)
+
+    def test_run(self):
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(settings, "run_reports_path", Path(tmp)):
+
+            instrument.start("test")
+            with instrument.stage("a"):
+                instrument.count("b")
+            with mock.patch("builtins.print"):
+                report = instrument.finish(metrics_path=Path(tmp) / "test.prom")
+
+            saved = json.loads(next(Path(tmp).glob("test-*.json")).read_text())
+            self.assertEqual(saved["counts"], {"b": 1})
+            self.assertIn("a", saved["stages"])
+            self.assertTrue((Path(tmp) / "test.prom").is_file())
+
+        # Later counts no longer go to the finished report
+        instrument.count("b")
+        self.assertEqual(report.counts["b"], 1)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.requests = []
+        requests_seen = self.requests
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                requests_seen.append((self.path, self.headers.get("If-None-Match")))
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                body = f"<html>{self.path}</html>".encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.origin = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cache.ResponseCache(Path(self.tmp.name), ttl=60, max_size=2 ** 20)
+
+    def tearDown(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def session(self, offline: bool = False):
+
+        session = fetch.make_session(cache=False)
+        session.mount("http://", cache.CachingAdapter(self.cache, offline=offline))
+        return session
+
+    def test_cache_and_revalidate(self):
+
+        session = self.session()
+        url = self.origin + "/walk.shtml"
+
+        first = session.get(url)
+        second = session.get(url)
+
+        self.assertFalse(first.from_cache)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.text, "<html>/walk.shtml</html>")
+        self.assertEqual(len(self.requests), 1)
+
+        # Stale entries are revalidated with the stored ETag
+        self.cache.ttl = 0
+        third = session.get(url)
+
+        self.assertTrue(third.from_cache)
+        self.assertEqual(third.text, first.text)
+        self.assertEqual(self.requests[-1], ("/walk.shtml", '"v1"'))
+
+    def test_offline(self):
+
+        self.session().get(self.origin + "/walk.shtml")
+        offline = self.session(offline=True)
+        self.cache.ttl = 0
+
+        self.assertEqual(offline.get(self.origin + "/walk.shtml").text, "<html>/walk.shtml</html>")
+        with self.assertRaises(cache.CacheMiss):
+            offline.get(self.origin + "/other.shtml")
+        self.assertEqual(len(self.requests), 1)
+
+        server = cache.replay_server(self.cache, self.origin)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        replay = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            self.assertEqual(fetch.make_session(cache=False).get(replay + "/walk.shtml").text, "<html>/walk.shtml</html>")
+            self.assertEqual(fetch.make_session(cache=False, retries=0).get(replay + "/other.shtml").status_code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_eviction(self):
+
+        self.cache.put("https://a/1", b"one" * 100, {"ETag": "1", "Server": "x"})
+        self.cache.put("https://a/2", b"one" * 100, {})
+        size = self.cache.size()
+
+        # Identical bodies are stored once
+        self.assertEqual(len(list(Path(self.tmp.name, "bodies").rglob("*.gz"))), 1)
+        self.assertDictEqual(self.cache.get("https://a/1")["headers"], {"ETag": "1"})
+
+        self.cache.max_size = size + 10
+        self.cache.get("https://a/1")
+        self.cache.put("https://a/3", b"three" * 100, {})
+
+        self.assertIsNotNone(self.cache.get("https://a/3"))
+        self.assertIsNone(self.cache.get("https://a/1"))
+        self.assertLessEqual(self.cache.size(), self.cache.max_size)
+
+
+class TestRunGpx(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patches = [
+            mock.patch.object(settings, "gpx_checkpoint_path", Path(self.tmp.name) / "checkpoint.jsonl"),
+            mock.patch.object(settings, "http_cache_path", Path(self.tmp.name) / "http_cache"),
+            mock.patch.object(settings, "request_delay", 0),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    @staticmethod
+    def fake_parse(url, session=None):
+
+        if "broken" in url:
+            raise ValueError("no route points")
+
+        return pd.DataFrame({"lat": [56.5, 56.6], "lon": [-2.7, -2.8]})
+
+    def test_fetch_paths(self):
+
+        urls = ["https://a/1.gpx", "https://a/broken.gpx", None, "https://a/1.gpx"]
+
+        with mock.patch.object(run_gpx, "parse", side_effect=self.fake_parse) as parse:
+            res = run_gpx.fetch_paths(urls, workers=2)
+
+        self.assertEqual(parse.call_count, 2)
+        self.assertListEqual(res["https://a/1.gpx"]["path"], [[56.5, 357.3], [56.6, 357.2]])
+        self.assertEqual(res["https://a/broken.gpx"]["error"], "ValueError: no route points")
+
+        # Resuming only retries the failure
+        with mock.patch.object(run_gpx, "parse", side_effect=self.fake_parse) as parse:
+            run_gpx.fetch_paths(urls, workers=2)
+
+        parse.assert_called_once()
+        self.assertEqual(parse.call_args[0][0], "https://a/broken.gpx")
+
+    def test_update(self):
+
+        tmp = Path(self.tmp.name)
+        walks = [raw_walk("Carnoustie", "angus"), raw_walk("Goatfell", "arran", "NS 013 359")]
+        paths = {name: tmp / name for name in ["routes", "route_files", "tiles"]}
+
+        with mock.patch.object(settings, "processed_path", tmp / "processed.parquet"), \
+                mock.patch.object(settings, "route_table_path", tmp / "route_table"), \
+                mock.patch.object(settings, "routes_path", paths["routes"]), \
+                mock.patch.object(settings, "route_files_path", paths["route_files"]), \
+                mock.patch.object(settings, "tiles_path", paths["tiles"]), \
+                mock.patch.object(settings, "spatial_index_path", tmp / "spatial_index.npz"):
+
+            processed.write(etl.clean(data.records_to_frame(walks)), settings.processed_path)
+            routes.write_route_table(settings.route_table_path, routes.route_table(["angus/carnoustie"], [[[56.5, 357.3], [56.6, 357.2]]]))
+
+            with mock.patch.object(run_gpx, "parse", side_effect=self.fake_parse) as parse:
+                run_gpx.update(workers=1)
+
+            # Only the walk without a route is fetched, and added as a part of its own
+            parse.assert_called_once()
+            self.assertIn("goatfell", parse.call_args[0][0])
+            self.assertEqual(len(list(settings.route_table_path.glob(routes.ROUTE_TABLE_PART))), 2)
+
+            store = RouteStore.load(settings.routes_path)
+            self.assertListEqual(sorted(k.decode() for k in store.keys), ["angus/carnoustie", "arran/goatfell"])
+            self.assertFalse(processed.read(settings.processed_path)["Route Distance"].isna().any())
+
+            # Nothing left to fetch, so nothing is written or rebuilt
+            with mock.patch.object(run_gpx, "parse", side_effect=self.fake_parse) as parse, \
+                    mock.patch.object(run_gpx, "save_routes") as save_routes:
+                run_gpx.update(workers=1)
+
+            parse.assert_not_called()
+            save_routes.assert_not_called()
+            self.assertEqual(len(list(settings.route_table_path.glob(routes.ROUTE_TABLE_PART))), 2)
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_catalogue(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            files = synthetic.write_catalogue(Path(tmp) / "a", scale=0.1, seed=1)
+            again = synthetic.write_catalogue(Path(tmp) / "b", scale=0.1, seed=1)
+            self.assertListEqual([f.read_bytes() for f in files], [f.read_bytes() for f in again])
+
+            df = etl.clean(data.load_walk_data(files))
+
+        # Every generated walk survives cleaning with a position in Scotland and a time
+        self.assertEqual(len(df), round(synthetic.CATALOGUE_SIZE * 0.1))
+        self.assertTrue(df["lat"].between(54, 61).all())
+        self.assertFalse(df["Time"].isna().any())
+        self.assertTrue((df["Munros Climbed"] > 1).any())
+
+    def test_gpx_routes(self):
+
+        records = [{"GPX": "https://a/1.gpx", "Name": "A", "StartPoint": "https://www.google.com/maps/search/56.5,-2.7/"}]
+        routes = synthetic.gpx_routes(records)
+
+        points = gpx.read_points(routes["https://a/1.gpx"])
+        self.assertEqual((points["lat"][0], points["lon"][0]), (56.5, -2.7))
+        self.assertFalse(np.isnan(points["time"]).any())
+        self.assertEqual(routes, synthetic.gpx_routes(records))
+
 
 if __name__ == '__main__':
     unittest.main()